@@ -0,0 +1,72 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ast
+from typing import Dict, List, Set
+
+
+def call_graph(fn_defs: Dict[str, ast.FunctionDef]):
+    """Maps the name of each function in fn_defs to the names of the functions
+    in fn_defs that it calls."""
+    graph = {}
+    for name, fn_def in fn_defs.items():
+        graph[name] = set(node.func.id for node in ast.walk(fn_def)
+                          if isinstance(node, ast.Call) and
+                          isinstance(node.func, ast.Name) and
+                          node.func.id in fn_defs)
+    return graph
+
+
+def strongly_connected_components(graph: Dict[str, Set[str]]):
+    """Returns the strongly connected components of the graph (with Tarjan's
+    algorithm), callees before callers.
+
+    The search keeps an explicit stack so that large call graphs don't exceed
+    the recursion limit."""
+    index, lowlink, on_stack = {}, {}, set()
+    stack: List[str] = []
+    components: List[Set[str]] = []
+    for root in sorted(graph):
+        if root in index:
+            continue
+        work = [(root, iter(sorted(graph[root])))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(sorted(graph[successor]))))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.add(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
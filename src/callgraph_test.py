@@ -0,0 +1,51 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ast
+import unittest
+
+import callgraph
+
+
+class TestCallGraph(unittest.TestCase):
+
+    def test_call_graph(self):
+        source = """
+def a(n):
+    return b(n) + len(n)
+
+def b(n):
+    return a(n - 1) + b(n - 2)
+
+def c(n):
+    return 1
+        """.strip()
+        fn_defs = {fn.name: fn for fn in ast.parse(source).body}
+        self.assertEqual({"a": {"b"}, "b": {"a", "b"}, "c": set()},
+                         callgraph.call_graph(fn_defs))
+
+    def test_strongly_connected_components(self):
+        graph = {
+            "main": {"even", "leaf"},
+            "even": {"odd"},
+            "odd": {"even", "leaf"},
+            "leaf": set(),
+            "self": {"self"},
+        }
+        self.assertEqual([{"leaf"}, {"even", "odd"}, {"main"}, {"self"}],
+                         callgraph.strongly_connected_components(graph))
+
+
+if __name__ == '__main__':
+    unittest.main()
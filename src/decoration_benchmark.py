@@ -0,0 +1,61 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times decorating a generated fiber with many loops around calls.
+
+Run from this directory: python decoration_benchmark.py [loops] [repeats]
+"""
+
+import linecache
+import sys
+import time
+
+import fiber
+
+
+def loops_source(loops: int) -> str:
+    """Returns the source of a function with the given number of for loops,
+    each of which calls the function in a bool expression branch."""
+    lines = ["def big(n, lst):", "    total = 0"]
+    for i in range(loops):
+        lines += [f"    for i{i} in range(n):",
+                  f"        if i{i} % 3 == 0 and lst:",
+                  f"            total = total + big(n - 1, lst[1:]) * {i}",
+                  f"        else:",
+                  f"            total = total + len(lst) + {i}"]
+    lines.append("    return total")
+    return "\n".join(lines) + "\n"
+
+
+def time_decoration(loops=150, repeats=5) -> float:
+    """Returns the best time in seconds to decorate the generated function."""
+    source = loops_source(loops)
+    filename = f"<decoration_benchmark {loops}>"
+    # fiber reads the function's source through inspect, which uses linecache.
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+    namespace = {}
+    exec(compile(source, filename, "exec"), namespace)
+    best = float("inf")
+    for _ in range(repeats):
+        fiber.FIBER_FN_NAME_MAP.pop("big", None)
+        start = time.perf_counter()
+        fiber.fiber(locals={})(namespace["big"])
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    loops = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"{loops} loops: {time_decoration(loops, repeats):.3f}s")
@@ -0,0 +1,32 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import decoration_benchmark
+import fiber
+import trampoline
+
+
+class TestDecorationBenchmark(unittest.TestCase):
+    def test_decorated_loops_match_python(self):
+        self.assertGreater(decoration_benchmark.time_decoration(loops=3, repeats=1), 0)
+        namespace = {}
+        exec(decoration_benchmark.loops_source(3), namespace)
+        big = fiber.FIBER_FN_NAME_MAP["big"].fn
+        self.assertEqual(namespace["big"](3, [1, 2]), trampoline.run(big, [3, [1, 2]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -39,6 +39,18 @@ def promote_call_expressions(expression: ast.AST, fns: Container[str], name_iter
     return new_expression
 
 
+def replace_call_expressions(expression: ast.AST, fns: Container[str], replace):
+    """Given a expression, replaces call expressions to functions in fns with
+    replace(call), where the call's arguments have already been replaced."""
+    def map_attributes(field, expression):
+        return replace_call_expressions(expression, fns, replace)
+
+    new_expression = utils.map_expression(expression, map_attributes)
+    if isinstance(expression, ast.Call) and isinstance(expression.func, ast.Name) and expression.func.id in fns:
+        return replace(new_expression)
+    return new_expression
+
+
 def make_and_if(name: str, expression: ast.AST, body):
     return ast.If(
         test=utils.make_lookup(name),
@@ -55,15 +67,18 @@ def make_or_if(name: str, expression: ast.AST, body):
     )
 
 
-def promote_boolean_expression_operands(expression: ast.AST, name_iter, lines):
+def promote_boolean_expression_operands(expression: ast.AST, name_iter, lines, fns=None):
     """Given a expression, transforms boolean expressions by promoting their
     operands to temporary values assigned to by if expressions.  Returns the
     resulting temporary variable, and appends to lines the corresponding if
     expressions that populate the variable.
+
+    If fns is given, boolean expressions without calls to fns are kept.
     """
     def map_attributes(field, expression):
         # If the expression is a boolop, append if statements to lines.
-        if isinstance(expression, ast.BoolOp):
+        if isinstance(expression, ast.BoolOp) and \
+                (fns is None or utils.calls_any(expression, fns)):
             assert len(expression.values) > 0
             maker = make_or_if if isinstance(
                 expression.op, ast.Or) else make_and_if
@@ -75,10 +90,11 @@ def promote_boolean_expression_operands(expression: ast.AST, name_iter, lines):
                     utils.make_assign(name, child),
                     name_iter,
                     body,
+                    fns,
                 ))
                 lines.append(maker(name, child, body))
             return utils.make_lookup(name)
-        return promote_boolean_expression_operands(expression, name_iter, lines)
+        return promote_boolean_expression_operands(expression, name_iter, lines, fns)
 
     # Recursively map the expression's attributes (e.g. subexpressions).
     return utils.map_expression(expression, map_attributes)
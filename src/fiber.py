@@ -14,14 +14,20 @@
 
 import ast
 from collections import ChainMap
-from dataclasses import dataclass
+import copy
+from dataclasses import dataclass, field
 import inspect
-from typing import Any, Container, Dict, List, Set, Union
+import itertools
+from typing import Any, Callable, Container, Dict, List, Set, Union
 import textwrap
 
+import callgraph
+import expressions
 import jumps
+import liveness
 import mappers
 import utils
+import views
 
 
 def get_tree(fn):
@@ -39,6 +45,23 @@ def fn_call_names(stmt: ast.AST, fns: Container[str]):
                 yield node.func.id
 
 
+def calling_stmts(block: ast.AST, fns: Container[str]):
+    """Returns the set of statements in the block (recursively) that contain a
+    call to a function in fns, computed in one bottom-up pass."""
+    stmts = set()
+
+    def helper(node):
+        calls = isinstance(node, ast.Call) and \
+            isinstance(node.func, ast.Name) and node.func.id in fns
+        for child in ast.iter_child_nodes(node):
+            calls = helper(child) or calls
+        if calls and isinstance(node, ast.stmt):
+            stmts.add(node)
+        return calls
+    helper(block)
+    return stmts
+
+
 def make_prev_dict(block: ast.AST):
     prev_dict = {}
 
@@ -60,7 +83,10 @@ class CallOp:
     func: Any
     args: List[Any]
     kwargs: Dict[Any, Any]
-    ret_variable: str
+    # The function to resume the caller with; None resumes the same function.
+    continuation: Any = None
+    # The caller's new frame, if the caller was entered without one.
+    frame: Any = None
 
 
 @dataclass
@@ -75,10 +101,18 @@ class RetOp:
     value: Any
 
 
+@dataclass
+class YieldOp:
+    value: Any
+    # The function to resume the fiber with; None resumes the same function.
+    continuation: Any = None
+
+
 OP_MAP = {
     CallOp.__name__: CallOp,
     TailCallOp.__name__: TailCallOp,
     RetOp.__name__: RetOp,
+    YieldOp.__name__: YieldOp,
 }
 
 
@@ -88,12 +122,17 @@ def matches_call(call: Union[ast.expr, None], fns: Container[str]):
         and call.func.id in fns
 
 
+def is_frame_access(target: ast.AST):
+    return isinstance(target, ast.Subscript) and \
+        isinstance(target.value, ast.Name) and \
+        target.value.id == "frame"
+
+
 def matches_callop(stmt: ast.AST, fns: Container[str]):
+    # Unlifted (fast) locals store call results to a name, not the frame.
     return isinstance(stmt, ast.Assign) and \
         len(stmt.targets) == 1 and \
-        isinstance(target := stmt.targets[0], ast.Subscript) and \
-        isinstance(target.value, ast.Name) and \
-        target.value.id == "frame" and \
+        (is_frame_access(target := stmt.targets[0]) or isinstance(target, ast.Name)) and \
         matches_call(stmt.value, fns)
 
 
@@ -105,14 +144,13 @@ def matches_retop(stmt: ast.AST, fns: Container[str]):
     return isinstance(stmt, ast.Return)
 
 
-def is_pc_assign(stmt: ast.AST):
+def is_pc_assign(stmt: ast.AST, pc_key: Union[str, int] = jumps.PC_LOCAL_NAME):
     return isinstance(stmt, ast.Assign) and \
         len(stmt.targets) == 1 and \
-        isinstance(target := stmt.targets[0], ast.Subscript) and \
-        isinstance(target.value, ast.Name) and \
-        target.value.id == "frame" and \
-        isinstance(name := target.slice, ast.Constant) and \
-        name.value == jumps.PC_LOCAL_NAME and \
+        ((is_frame_access(target := stmt.targets[0]) and
+          isinstance(name := target.slice, ast.Constant) and
+          name.value == pc_key) or
+         (isinstance(target, ast.Name) and target.id == jumps.PC_LOCAL_NAME)) and \
         isinstance(stmt.value, ast.Constant) and \
         isinstance(stmt.value.value, int)
 
@@ -122,8 +160,10 @@ def is_tail_call(stmt: ast.AST):
         isinstance(stmt.value, ast.Call)
 
 
-def make_callop_expr(variable: ast.Constant, call: ast.Call):
-    return ast.Return(
+def make_callop_expr(call: ast.Call, continuation: str = None, frame: ast.AST = None):
+    if call.func.id == mappers.YIELD_NAME:
+        return make_yieldop_expr(call.args[0], continuation)
+    expr = ast.Return(
         value=ast.Call(
             func=utils.make_lookup(CallOp.__name__),
             args=[],
@@ -134,10 +174,23 @@ def make_callop_expr(variable: ast.Constant, call: ast.Call):
                     elts=call.args, ctx=ast.Load())),
                 ast.keyword(arg="kwargs", value=ast.Dict(
                     keys=[ast.Constant(k.arg) for k in call.keywords], values=[k.value for k in call.keywords])),
-                ast.keyword(arg="ret_variable", value=variable),
             ]
         )
     )
+    if continuation is not None:
+        expr.value.keywords.append(ast.keyword(
+            arg="continuation", value=utils.make_lookup(continuation)))
+    if frame is not None:
+        expr.value.keywords.append(ast.keyword(arg="frame", value=frame))
+    return expr
+
+
+def make_yieldop_expr(value: ast.AST, continuation: str = None):
+    keywords = [ast.keyword(arg="value", value=value)]
+    if continuation is not None:
+        keywords.append(ast.keyword(arg="continuation", value=utils.make_lookup(continuation)))
+    return ast.Return(value=ast.Call(
+        func=utils.make_lookup(YieldOp.__name__), args=[], keywords=keywords))
 
 
 def make_tailcallop_expr(call: ast.Call):
@@ -169,21 +222,34 @@ def make_retop_expr(value: ast.AST):
     )
 
 
-def make_arguments():
+def make_arguments(ret=True):
+    """Creates the parameters of a compiled fiber: the frame and, if ret is
+    True, the return value of the call that the fiber is resumed after."""
     return ast.arguments(
         posonlyargs=[],
-        args=[ast.arg(arg="frame")],
+        args=[ast.arg(arg="frame"), *([ast.arg(arg=RET_LOCAL_NAME)] if ret else [])],
         kwonlyargs=[],
         kwarg=None,
         vararg=None,
-        defaults=[],
+        defaults=[ast.Constant(None)] if ret else [],
         kw_defaults=[],
     )
 
 
-def fix_fn_def(fn_tree: ast.FunctionDef, fn):
-    fn_tree.name = f"__fiberfn_{fn.__name__}"
-    fn_tree.args = make_arguments()
+def fiber_fn_name(fn, pc=0):
+    """Returns the name of the compiled function that resumes fn at pc."""
+    return f"__fiberfn_{fn.__name__}" + (f"__{pc}" if pc else "")
+
+
+def fiber_entry_name(fn):
+    """Returns the name of the compiled function that enters fn without a
+    frame."""
+    return f"__fiberentry_{fn.__name__}"
+
+
+def fix_fn_def(fn_tree: ast.FunctionDef, fn, pc=0, ret=True):
+    fn_tree.name = fiber_fn_name(fn, pc)
+    fn_tree.args = make_arguments(ret)
 
 
 def fiber_locals(fn_tree: ast.FunctionDef):
@@ -192,84 +258,957 @@ def fiber_locals(fn_tree: ast.FunctionDef):
     return local_vars
 
 
-def insert_jumps(fn_tree: ast.FunctionDef, prev_dict, fns):
-    prev_dict = make_prev_dict(fn_tree)
-    body, _ = jumps.insert_jumps(
-        fn_tree.body, jump_to=lambda stmt: needs_jump(stmt, prev_dict, fns))
-    return body
+def frame_locals(fn_tree: ast.FunctionDef, fns):
+    """Returns the fiber locals that are stored in the heap frame. Temporaries
+    that are never live across a call to the trampoline stay Python locals."""
+    def is_call(stmt): return matches_callop(stmt, fns)
+    analysis = liveness.Liveness(is_call)
+    analysis.analyze(fn_tree)
+    crossing = set().union(*(live for stmt, live in analysis.live_out.items()
+                             if is_call(stmt)))
+    return set(name for name in fiber_locals(fn_tree)
+               if not utils.is_temporary(name) or name in crossing)
+
+
+def frame_materializations(fn_tree: ast.FunctionDef, fns, frame_vars):
+    """Returns a dict that maps each call to the sorted frame locals that are
+    live across it, which a fiber entered without a frame stores in the frame
+    it creates at the call. Returns None if a local that is live across a call
+    may be unassigned when the call is made."""
+    def is_call(stmt): return matches_callop(stmt, fns)
+    analysis = liveness.Liveness(is_call)
+    analysis.analyze(fn_tree)
+    materializations = {}
+    for call, assigned in liveness.definitely_assigned(fn_tree, is_call).items():
+        live = (analysis.live_out[call] & frame_vars) - {jumps.PC_LOCAL_NAME}
+        if not live <= assigned:
+            return None
+        materializations[call] = sorted(live)
+    return materializations
+
+
+def read_return_values(fn_tree: ast.FunctionDef, fns):
+    """Assigns the return value of each call to the trampoline from the
+    RET_LOCAL_NAME parameter right after the call, where the fiber resumes."""
+    def mapper(stmt):
+        if matches_callop(stmt, fns):
+            return [stmt, utils.make_assign(stmt.targets[0].id, utils.make_lookup(RET_LOCAL_NAME))]
+        return [stmt]
+    return mappers.map_scope(fn_tree, mapper)
 
 
-def lift_locals_to_frame(fn_tree: ast.FunctionDef):
-    local_vars = fiber_locals(fn_tree)
-    return mappers.map_scope(fn_tree, mappers.lift_to_frame_m(
-        name_fn=lambda x: x if x in local_vars else None))
+def frame_slots(fn_tree: ast.FunctionDef, local_vars=None):
+    """Assigns every fiber local (or only local_vars, if given) a fixed index
+    in a list frame.
+
+    The pc is always slot 0, followed by the parameters in declaration order
+    and then the remaining locals in sorted order (so that the layout, and the
+    generated code, is deterministic)."""
+    if local_vars is None:
+        local_vars = fiber_locals(fn_tree)
+    params = [name for name in utils.arg_names(fn_tree)
+              if name != jumps.PC_LOCAL_NAME]
+    rest = sorted(local_vars - set(params) - {jumps.PC_LOCAL_NAME})
+    pc = [jumps.PC_LOCAL_NAME] if jumps.PC_LOCAL_NAME in local_vars else []
+    return {name: i for i, name in enumerate([*pc, *params, *rest])}
 
 
-def needs_jump(stmt: ast.AST, prev_dict, fns):
-    if not stmt in prev_dict:
-        return False
+def insert_jumps(fn_tree: ast.FunctionDef, prev_dict, fns):
+    calling = calling_stmts(fn_tree, fns)
+    body, _ = jumps.insert_jumps(
+        fn_tree.body, jump_to=lambda stmt: needs_jump(stmt, prev_dict, calling))
+    return jumps.simplify_jumps(body, yields=lambda stmt: matches_callop(stmt, fns))
 
-    # Check whether the child function is a trampoline.
-    fn_calls = list(fn_call_names(prev_dict[stmt], fns))
-    if not fn_calls:
-        return False
-    for name in fn_calls:
-        if not (name in FIBER_FN_NAME_MAP or name in fns):
-            return False
 
-    return not is_tail_call(prev_dict[stmt])
+def lift_locals_to_frame(fn_tree: ast.FunctionDef, local_vars, slots=None):
+    """Rewrites accesses of local_vars to frame accesses. If slots is given,
+    locals are replaced by their integer index in a list frame instead of by
+    name."""
+    return mappers.map_scope(fn_tree, mappers.lift_to_frame_m(
+        name_fn=lambda x: frame_key(x, slots) if x in local_vars else None))
+
+
+def frame_key(name: str, slots):
+    return name if slots is None else slots[name]
+
+
+def stored_names(stmt: ast.AST):
+    """Returns the names a simple statement (or a block's test) writes to."""
+    if isinstance(stmt, ast.If) or isinstance(stmt, ast.While):
+        stmt = stmt.test
+    elif isinstance(stmt, ast.For):
+        stmt = stmt.target
+    elif utils.is_block(stmt):
+        return set()
+    return set(node.id for node in ast.walk(stmt)
+               if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store))
+
+
+def crossing_locals(fn_tree: ast.FunctionDef, fns):
+    """Finds the locals that must be stored in the heap frame because they are
+    live across a call to the trampoline.
+
+    Returns the set of frame variables, a map from each call statement to the
+    (sorted) variables that must be spilled to the frame before the call, and
+    a map from each call statement to the frame variables that are dead
+    during the call. Parameters are written to the frame by the trampoline,
+    so they only need to be spilled if the function also assigns to them."""
+    def is_call(stmt): return matches_callop(stmt, fns)
+    analysis = liveness.Liveness(is_call)
+    analysis.analyze(fn_tree)
+    calls = [stmt for stmt in analysis.live_out if is_call(stmt)]
+
+    written = set()
+    for stmt in analysis.live_out:
+        if not is_call(stmt):
+            written |= stored_names(stmt)
+
+    frame_vars = set(utils.arg_names(fn_tree)) | {jumps.PC_LOCAL_NAME}
+    spills = {}
+    for call in calls:
+        crossing = analysis.live_out[call]
+        frame_vars |= crossing
+        spills[call] = sorted(crossing & written)
+    dead = {call: frame_vars - analysis.live_out[call] - {jumps.PC_LOCAL_NAME}
+            for call in calls}
+    return frame_vars, spills, dead
+
+
+def make_frame_store(name: str, slots, value=None):
+    return ast.Assign(
+        targets=[ast.Subscript(value=utils.make_lookup(expressions.FRAME_LOCAL_NAME),
+                               slice=ast.Constant(frame_key(name, slots)), ctx=ast.Store())],
+        value=utils.make_lookup(name) if value is None else value)
+
+
+def make_frame_reloads(fn_tree: ast.FunctionDef, frame_vars, slots):
+    """Creates statements that load every frame variable into a local.
+
+    Dict frames only contain parameters and the pc until the other variables
+    are first spilled, so those are loaded with get."""
+    always_bound = set(utils.arg_names(fn_tree)) | {jumps.PC_LOCAL_NAME}
+    order = slots if slots is not None else frame_slots(fn_tree, frame_vars)
+    reloads = []
+    for name in order:
+        frame = utils.make_lookup(expressions.FRAME_LOCAL_NAME)
+        key = ast.Constant(frame_key(name, slots))
+        if slots is not None or name in always_bound:
+            value = ast.Subscript(value=frame, slice=key, ctx=ast.Load())
+        else:
+            value = ast.Call(func=ast.Attribute(value=frame, attr="get", ctx=ast.Load()),
+                             args=[key], keywords=[])
+        reloads.append(utils.make_assign(name, value))
+    return reloads
+
+
+def needs_jump(stmt: ast.AST, prev_dict, calling):
+    """Returns whether stmt follows a statement in calling (see calling_stmts)
+    that isn't a tail call, so that it must be resumed at."""
+    prev = prev_dict.get(stmt)
+    return prev is not None and prev in calling and not is_tail_call(prev)
+
+
+def compile_env(fn, local_vars):
+    leaves = [(name, metadata.fn) for name, metadata in FIBER_FN_NAME_MAP.items()
+              if metadata.leaf]
+    return dict([*fn.__globals__.items(), *OP_MAP.items(), (SLICE_VIEW_NAME, views.slice_view),
+                 *local_vars.items(), *leaves])
+
+
+def param_defaults(fn, fn_args: ast.arguments, local_vars):
+    """Returns the values of the parameter defaults of fn_args, the parameters
+    of fn after the rewrites, by name. Defaults of fn's own parameters are the
+    values Python evaluated when fn was defined; the defaults of parameters
+    that rewrites added are evaluated once here."""
+    params = inspect.signature(fn).parameters
+    positional = [*fn_args.posonlyargs, *fn_args.args]
+    env, values = None, {}
+    for arg, default in [*zip(reversed(positional), reversed(fn_args.defaults)),
+                         *zip(fn_args.kwonlyargs, fn_args.kw_defaults)]:
+        if default is None:
+            continue  # A required keyword only parameter.
+        param = params.get(arg.arg)
+        if param is not None and param.default is not inspect.Parameter.empty:
+            values[arg.arg] = param.default
+            continue
+        if env is None:
+            env = compile_env(fn, local_vars)
+        values[arg.arg] = eval(compile(ast.fix_missing_locations(ast.Expression(default)),
+                                       f"<fiber> {inspect.getfile(fn)}", "eval"), env)
+    return values
 
 
-def compile_tree(tree: ast.AST, fn, local_vars):
+def compile_tree(tree: ast.AST, fn, local_vars, env=None):
     tree = ast.fix_missing_locations(tree)
     code = compile(tree, f"<fiber> {inspect.getfile(fn)}", "exec")
     results = {}
-    exec(code, dict([*fn.__globals__.items(), *
-         OP_MAP.items(), *local_vars.items()]), results)
+    if env is None:
+        env = compile_env(fn, local_vars)
+    exec(code, env, results)
+    # Let the compiled functions refer to each other (e.g. continuations).
+    env.update(results)
     results[tree.body[0].name].__fibercode__ = ast.unparse(tree)
     return results[tree.body[0].name]
 
 
+# Holds the operation to return to the trampoline while dead locals are cleared.
+OP_LOCAL_NAME = "__op"
+RET_LOCAL_NAME = "__ret"
+
+
 # This is hacky...
 
 @dataclass
 class FiberMetadata:
     fn_def: ast.FunctionDef
     fn: Any
+    # Maps locals to list indexes for slot frames; None for dict frames.
+    slots: Union[Dict[str, int], None] = None
+    # Whether the frame stores a pc (the continuations backend doesn't).
+    has_pc: bool = True
+    # Whether fn is a generator function (the generator backend).
+    generator: bool = False
+    # Whether fn is a plain Python function because it calls no other fibers.
+    leaf: bool = False
+    # The compiled function definition and its environment, for fibers that
+    # merge_sccs can merge (jumps backend with dict frames).
+    fn_tree: Union[ast.FunctionDef, None] = None
+    env: Union[Dict[str, Any], None] = None
+    # The index of the function in its merged group, stored in the frame.
+    group_id: Union[int, None] = None
+    # Resume counts, while the fiber is being profiled.
+    profile: Union["Profile", None] = None
+    # Runs the fiber with its arguments as Python locals until it returns or
+    # first calls a fiber, and only then creates its frame (lazy_frames).
+    entry: Any = None
+    # The plain recursive version of the fiber, which trampoline.run calls
+    # instead (native_depth).
+    native: Any = None
+    # The handler table (see jumps.throw_pcs), if the fiber calls fibers in
+    # try statements.
+    handlers: Union[Dict[int, int], None] = None
+    # Whether the fiber yields values, so trampoline.run returns an iterator.
+    streaming: bool = False
+    # The values of the parameters' defaults (see param_defaults).
+    defaults: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class Profile:
+    """Counts the resumes of a fiber per pc, and calls recompile with the
+    counts once there have been threshold resumes."""
+    threshold: int
+    recompile: Callable[[Dict[int, int]], None]
+    pc_key: Union[str, int]
+    counts: Dict[int, int] = field(default_factory=dict)
+    resumes: int = 0
+
+    def record(self, frame):
+        if self.resumes >= self.threshold:
+            return  # Frames of the old function may still be on the stack.
+        pc = frame[self.pc_key]
+        self.counts[pc] = self.counts.get(pc, 0) + 1
+        self.resumes += 1
+        if self.resumes == self.threshold:
+            self.recompile(self.counts)
+
+
+def profile_dispatch(body, counts: Dict[int, int], yields):
+    """Creates a body that dispatches on the pc to a copy of body specialized
+    to each pc in counts, most frequent first. All other pcs run body
+    specialized to them in a final branch."""
+    pcs = jumps.resume_pcs(body, yields)
+    hot = sorted((pc for pc in counts if pc in pcs), key=lambda pc: -counts[pc])
+    cold = pcs - set(hot)
+    dispatch = jumps.simplify_jumps(body, yields, cold) if cold else []
+    if not cold:
+        # The least frequent pc doesn't need a check.
+        dispatch = jumps.simplify_jumps(body, yields, {hot.pop()})
+    for pc in reversed(hot):
+        dispatch = [ast.If(test=jumps.make_range_test(pc, pc + 1),
+                           body=jumps.simplify_jumps(body, yields, {pc}), orelse=dispatch)]
+    return dispatch
 
 
 FIBER_FN_NAME_MAP = {}
 FIBER_FN_COMPILED_MAP = {}
 
 
-def add_trampoline_returns(block: ast.AST, fns: Container[str]):
+def is_leaf(name: str):
+    return name in FIBER_FN_NAME_MAP and FIBER_FN_NAME_MAP[name].leaf
+
+
+def mutate_blocks(block: ast.AST, fn):
+    """Calls fn, which mutates the body of a block, on the block, on its else
+    and finally blocks (if any) and on its except handlers."""
+    fn(block)
+    for field in ("orelse", "finalbody"):
+        if getattr(block, field, None):
+            inner = ast.If(test=ast.Constant(value=True), body=getattr(block, field), orelse=[])
+            fn(inner)
+            setattr(block, field, inner.body)
+    for handler in getattr(block, "handlers", []):
+        fn(handler)
+
+
+def add_trampoline_returns(block: ast.AST, fns: Container[str], slots=None, call_stores=None,
+                           continuation_name=None, call_frames=None):
     """Recursively mutates the block by replacing a function call or a return
-    statement with a return to a trampoline. Also moves the PC assignment to
-    before the return to the trampoline.
+    statement with a return to a trampoline. Also moves the PC assignment after
+    a call to before the return to the trampoline.
+
+    If call_stores is given, locals have not been lifted to the frame;
+    call_stores maps each call to the frame stores (including the pc) that run
+    before returning to the trampoline. Statements between a call and its pc
+    assignment run after the call's arguments are evaluated.
+
+    If continuation_name is given, calls pass the function named
+    continuation_name(pc) to resume at instead of storing the pc.
+
+    If call_frames is given, the fiber has no frame yet; call_frames maps each
+    call to the locals that calls pass to the trampoline, with the pc, as the
+    frame to resume.
 
     We assume that all recursive calls have been lifted to temporaries, and
     tail calls are in `return call()` form (trivial temporary eliminated)."""
     assert utils.is_block(block)
-    # Make a shallow copy, as we mutate the list as we iterate (by swapping).
-    body = block.body
-    for index, stmt in enumerate(list(body)):
+    pc_key = jumps.PC_LOCAL_NAME if slots is None else slots.get(jumps.PC_LOCAL_NAME)
+    body, stmts = [], iter(block.body)
+    for stmt in stmts:
         if utils.is_block(stmt):
-            add_trampoline_returns(stmt, fns)
+            mutate_blocks(stmt, lambda b: add_trampoline_returns(
+                b, fns, slots, call_stores, continuation_name, call_frames))
+            body.append(stmt)
             continue
         if matches_callop(stmt, fns):
-            replaced = make_callop_expr(stmt.targets[0].slice, stmt.value)
+            stores = call_stores[stmt] if call_stores is not None else []
         elif matches_tailcallop(stmt, fns):
-            replaced = make_tailcallop_expr(stmt.value)
+            body.append(make_tailcallop_expr(stmt.value))
+            continue
         elif matches_retop(stmt, fns):
-            replaced = make_retop_expr(stmt.value)
+            body.append(make_retop_expr(stmt.value))
+            continue
         else:
+            body.append(stmt)
             continue
-        assert index + 1 < len(body)
-        assert is_pc_assign(body[index + 1])
-        body[index], body[index + 1] = body[index+1], replaced
+        deferred, pc_assign = [], next(stmts, None)
+        while pc_assign is not None and not is_pc_assign(pc_assign, pc_key):
+            deferred.append(pc_assign)
+            pc_assign = next(stmts, None)
+        assert pc_assign is not None
+        if call_frames is not None:
+            names = call_frames.get(stmt, [])
+            replaced = make_callop_expr(stmt.value, frame=ast.Dict(
+                keys=[ast.Constant(name) for name in [*names, jumps.PC_LOCAL_NAME]],
+                values=[*map(utils.make_lookup, names), pc_assign.value]))
+        elif continuation_name is None:
+            replaced = make_callop_expr(stmt.value)
+            stores = [pc_assign, *stores]
+        else:
+            replaced = make_callop_expr(stmt.value, continuation_name(pc_assign.value.value))
+        if deferred:
+            body.extend([*stores,
+                         utils.make_assign(OP_LOCAL_NAME, replaced.value),
+                         *deferred,
+                         ast.Return(value=utils.make_lookup(OP_LOCAL_NAME))])
+        else:
+            body.extend([*stores, replaced])
+    block.body = body
+
+
+def reads_pc(block: ast.AST):
+    return any(isinstance(node, ast.Name) and node.id == jumps.PC_LOCAL_NAME and
+               isinstance(node.ctx, ast.Load) for node in ast.walk(block))
+
+
+def remove_pc_stores(block: ast.AST, fns):
+    """Recursively mutates the block to remove pc stores, except for the ones
+    after calls that determine where the call resumes."""
+    body = []
+    for stmt in block.body:
+        if utils.is_block(stmt):
+            remove_pc_stores(stmt, fns)
+        if not (is_pc_assign(stmt) and not (body and matches_callop(body[-1], fns))):
+            body.append(stmt)
+    block.body = body
+
+
+def make_clears(names):
+    return [utils.make_assign(name, ast.Constant(None)) for name in sorted(names)]
+
 
+def clear_dead_locals(block: ast.AST, analysis: liveness.Liveness, fns):
+    """Recursively mutates the block to set each local to None after the
+    statement that last reads it (or that assigns it, if it is never read), so
+    that suspended frames do not keep dead values alive.
 
-def fiber(fns: Container[str] = None, *, locals, recursive=True):
+    Returns a map from each call to the locals that die at that call. These
+    must be cleared after the call's arguments are evaluated, so they are
+    inserted by insert_call_clears after jumps are inserted."""
+    call_clears = {}
+
+    def helper(stmts):
+        new_stmts = []
+        for index, stmt in enumerate(stmts):
+            new_stmts.append(stmt)
+            for field in ("body", "orelse", "finalbody"):
+                if isinstance(getattr(stmt, field, None), list):
+                    setattr(stmt, field, helper(getattr(stmt, field)))
+            for handler in getattr(stmt, "handlers", []):
+                handler.body = helper(handler.body)
+
+            if utils.is_block(stmt):
+                dead = analysis.live_in[stmt] - analysis.live_out[stmt]
+            elif isinstance(stmt, (ast.Return, ast.Break, ast.Continue, ast.Raise)):
+                continue
+            elif matches_callop(stmt, fns):
+                # The call's own target is only assigned when it resumes.
+                dead = analysis.uses(stmt) - analysis.live_out[stmt]
+            else:
+                # Locals that are assigned but never read also die here.
+                dead = (analysis.uses(stmt) | liveness.defs(stmt)) - analysis.live_out[stmt]
+            if matches_callop(stmt, fns):
+                call_clears[stmt] = dead
+            elif index + 1 < len(stmts) and isinstance(stmts[index + 1], ast.Return):
+                # The frame is discarded when we return anyway.
+                continue
+            else:
+                new_stmts.extend(make_clears(dead))
+        return new_stmts
+
+    block.body = helper(block.body)
+    return call_clears
+
+
+def insert_call_clears(block: ast.AST, call_clears):
+    """Recursively mutates the block to clear the locals that die at each call
+    right after the call (before its pc assignment)."""
+    body = []
+    for stmt in block.body:
+        body.append(stmt)
+        if utils.is_block(stmt):
+            mutate_blocks(stmt, lambda b: insert_call_clears(b, call_clears))
+        body.extend(make_clears(call_clears.get(stmt, ())))
+    block.body = body
+
+
+def bind_tail_call(fn_tree: ast.FunctionDef, call: ast.Call):
+    """Returns a list of (parameter, value) pairs that call binds, in argument
+    evaluation order, or None if the call can't be bound statically."""
+    fn_args = fn_tree.args
+    if fn_args.vararg or fn_args.kwarg or \
+            any(isinstance(arg, ast.Starred) for arg in call.args) or \
+            any(keyword.arg is None for keyword in call.keywords):
+        return None
+    positional = [arg.arg for arg in fn_args.posonlyargs + fn_args.args]
+    if len(call.args) > len(positional):
+        return None
+    bound = list(zip(positional, call.args))
+    keyword_names = set(positional[len(fn_args.posonlyargs):]) | \
+        set(arg.arg for arg in fn_args.kwonlyargs)
+    for keyword in call.keywords:
+        if keyword.arg not in keyword_names or \
+                keyword.arg in (name for name, _ in bound):
+            return None
+        bound.append((keyword.arg, keyword.value))
+
+    defaults = dict(zip(reversed(positional), reversed(fn_args.defaults)))
+    defaults.update((arg.arg, default) for arg, default in
+                    zip(fn_args.kwonlyargs, fn_args.kw_defaults) if default is not None)
+    for name in positional + [arg.arg for arg in fn_args.kwonlyargs]:
+        if name in (bound_name for bound_name, _ in bound):
+            continue
+        if not isinstance(defaults.get(name), ast.Constant):
+            return None
+        bound.append((name, ast.Constant(defaults[name].value)))
+    return bound
+
+
+def make_rebind(bound):
+    """Returns statements that assign the values to the parameters as if they
+    were assigned simultaneously."""
+    stmts, deferred = [], []
+    for i, (name, value) in enumerate(bound):
+        if isinstance(value, ast.Name) and value.id == name:
+            continue
+        if any(name in liveness.uses(later) for _, later in bound[i + 1:]):
+            # A later argument still reads the old value.
+            stmts.append(utils.make_assign(f"__tail_{name}__", value))
+            deferred.append(utils.make_assign(
+                name, utils.make_lookup(f"__tail_{name}__")))
+        else:
+            stmts.append(utils.make_assign(name, value))
+    return stmts + deferred
+
+
+def self_tail_calls_to_loop(fn_tree: ast.FunctionDef, name: str):
+    """Rewrites self tail calls outside of loops into rebinding the parameters
+    and restarting the function body, which is wrapped in a while True loop.
+
+    Returns fn_tree unchanged if there are no such tail calls."""
+    rewritten = False
+
+    def rewrite(stmts):
+        nonlocal rewritten
+        result = []
+        for stmt in stmts:
+            if isinstance(stmt, ast.If):
+                stmt = ast.If(test=stmt.test, body=rewrite(stmt.body),
+                              orelse=rewrite(stmt.orelse))
+            elif matches_tailcallop(stmt, {name}) and \
+                    (bound := bind_tail_call(fn_tree, stmt.value)) is not None:
+                rewritten = True
+                result.extend(make_rebind(bound))
+                stmt = ast.Continue()
+            result.append(stmt)
+        return result
+
+    body = rewrite(fn_tree.body)
+    if not rewritten:
+        return fn_tree
+    if isinstance(body[-1], ast.Continue):
+        body.pop()
+    elif not isinstance(body[-1], ast.Return):
+        body.append(ast.Return(value=ast.Constant(None)))
+    fn_tree = ast.FunctionDef(**dict(ast.iter_fields(fn_tree)))
+    fn_tree.body = [ast.While(test=ast.Constant(True), body=body, orelse=[])]
+    return fn_tree
+
+
+def returns_in_loop(stmts):
+    """Returns whether a return statement in stmts is inside a loop."""
+    return any(isinstance(node, ast.Return) for stmt in stmts for loop in ast.walk(stmt)
+               if isinstance(loop, (ast.For, ast.While)) for node in ast.walk(loop))
+
+
+def inline_call(stmt: ast.Assign, bound, fn_tree: ast.FunctionDef, name_iter, suffix):
+    """Returns statements that run fn_tree's body in place of stmt, a call to
+    it that binds the parameters to bound. Locals are renamed with suffix and
+    temporaries to new names from name_iter. The body is wrapped in a while
+    True loop, and its returns assign the result to stmt's target and break
+    out of the loop."""
+    target = stmt.targets[0].id
+    renames = {name: next(name_iter) if utils.is_temporary(name) else f"{name}__{suffix}"
+               for name in sorted(utils.local_vars(fn_tree))}
+
+    class Rename(ast.NodeTransformer):
+        def visit_Name(self, node):
+            return ast.Name(id=renames.get(node.id, node.id), ctx=node.ctx)
+
+        def visit_Return(self, node):
+            value = ast.Constant(None) if node.value is None else self.visit(node.value)
+            return [utils.make_assign(target, value), ast.Break()]
+
+    body = [Rename().visit(copy.deepcopy(body_stmt)) for body_stmt in fn_tree.body]
+    body = [new_stmt for stmts in body for new_stmt in (stmts if isinstance(stmts, list) else [stmts])]
+    if not isinstance(body[-1], ast.Break):
+        body += [utils.make_assign(target, ast.Constant(None)), ast.Break()]
+    return [utils.make_assign(renames[name], value) for name, value in bound] + \
+        [ast.While(test=ast.Constant(True), body=body, orelse=[])]
+
+
+def unroll_self_calls(fn_tree: ast.FunctionDef, name: str, levels: int, name_iter):
+    """Inlines the calls that fn_tree, the function called name, makes to itself
+    levels deep, so that only every (levels + 1)th level of the recursion
+    returns to the trampoline.
+
+    Calls must be in `x = name(...)` form (see promote_to_temporary_m). The
+    function is not unrolled if its body returns from inside a loop, where a
+    return can't be rewritten into a break."""
+    if levels <= 0 or returns_in_loop(fn_tree.body):
+        return fn_tree
+    copies = itertools.count(1)
+
+    def rewrite(stmts, depth):
+        result = []
+        for stmt in stmts:
+            if matches_callop(stmt, {name}) and isinstance(stmt.targets[0], ast.Name) and \
+                    (bound := bind_tail_call(fn_tree, stmt.value)) is not None:
+                inlined = inline_call(stmt, bound, fn_tree, name_iter, next(copies))
+                result.extend(rewrite(inlined, depth - 1) if depth > 1 else inlined)
+                continue
+            if isinstance(stmt, (ast.If, ast.While)):
+                stmt = type(stmt)(test=stmt.test, body=rewrite(stmt.body, depth),
+                                  orelse=rewrite(stmt.orelse, depth))
+            result.append(stmt)
+        return result
+
+    new_tree = ast.FunctionDef(**dict(ast.iter_fields(fn_tree)))
+    new_tree.body = rewrite(fn_tree.body, levels)
+    return new_tree
+
+
+IMPURE_NODES = (ast.Call, ast.NamedExpr, ast.Lambda, ast.Await, ast.Yield, ast.YieldFrom,
+                ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.Starred)
+
+
+def base_cases(fn_def: ast.FunctionDef):
+    """Returns the (test, value) pairs of the `if test: return value`
+    statements that fn_def's body starts with, where test and value only read
+    parameters and don't call functions."""
+    params = set(utils.arg_names(fn_def))
+
+    def is_simple(expression):
+        return all(not isinstance(node, IMPURE_NODES) and
+                   (not isinstance(node, ast.Name) or node.id in params)
+                   for node in ast.walk(expression))
+
+    cases = []
+    for stmt in fn_def.body:
+        if not (isinstance(stmt, ast.If) and not stmt.orelse and len(stmt.body) == 1 and
+                isinstance(stmt.body[0], ast.Return)):
+            break
+        value = stmt.body[0].value or ast.Constant(None)
+        if not (is_simple(stmt.test) and is_simple(value)):
+            break
+        cases.append((stmt.test, value))
+    return cases
+
+
+def short_circuit_call(stmt: ast.Assign, fn_def: ast.FunctionDef, name_iter):
+    """Returns statements that evaluate the base cases of fn_def (see
+    base_cases) for the call stmt makes to it inline, and only make the call
+    if none of them apply, or None if the call can't be bound statically.
+    Arguments are evaluated once, into temporaries."""
+    cases, call = base_cases(fn_def), stmt.value
+    if not cases or (bound := bind_tail_call(fn_def, call)) is None:
+        return None
+    temps = {id(value): next(name_iter) for _, value in bound
+             if not isinstance(value, ast.Constant)}
+    stmts = [utils.make_assign(temps[id(value)], value) for _, value in bound
+             if id(value) in temps]
+    values = {name: utils.make_lookup(temps[id(value)]) if id(value) in temps else value
+              for name, value in bound}
+
+    class Bind(ast.NodeTransformer):
+        def visit_Name(self, node):
+            return copy.deepcopy(values[node.id])
+
+    def arg(value):
+        return utils.make_lookup(temps[id(value)]) if id(value) in temps else value
+
+    def assign(value):
+        return ast.Assign(targets=copy.deepcopy(stmt.targets), value=value)
+    # The base cases don't call functions, so they can be an if/elif chain;
+    # the call itself is only in the body of an if, where it can be resumed.
+    call_n = next(name_iter)
+    chain = [utils.make_assign(call_n, ast.Constant(True))]
+    for test, value in reversed(cases):
+        chain = [ast.If(test=Bind().visit(copy.deepcopy(test)),
+                        body=[assign(Bind().visit(copy.deepcopy(value))),
+                              utils.make_assign(call_n, ast.Constant(False))],
+                        orelse=chain)]
+    block = chain + [ast.If(test=utils.make_lookup(call_n), body=[assign(ast.Call(
+        func=call.func, args=[arg(value) for value in call.args],
+        keywords=[ast.keyword(arg=keyword.arg, value=arg(keyword.value))
+                  for keyword in call.keywords]))], orelse=[])]
+    return stmts + block
+
+
+def short_circuit_calls(fn_tree: ast.FunctionDef, fn_defs, name_iter):
+    """Rewrites each `x = f(...)` call to a function in fn_defs, which maps
+    names to their definitions, to check f's base cases (see
+    short_circuit_call) before calling it."""
+    def rewrite(stmts):
+        result = []
+        for stmt in stmts:
+            if matches_callop(stmt, fn_defs) and \
+                    (inlined := short_circuit_call(stmt, fn_defs[stmt.value.func.id],
+                                                   name_iter)) is not None:
+                result.extend(inlined)
+                continue
+            if isinstance(stmt, (ast.If, ast.While)):
+                stmt = type(stmt)(test=stmt.test, body=rewrite(stmt.body),
+                                  orelse=rewrite(stmt.orelse))
+            result.append(stmt)
+        return result
+
+    new_tree = ast.FunctionDef(**dict(ast.iter_fields(fn_tree)))
+    new_tree.body = rewrite(fn_tree.body)
+    return new_tree
+
+
+TRY_RESULT_NAME = "__result"
+
+
+def untail_calls_in_try(fn_tree: ast.FunctionDef, fns: Container[str]):
+    """Rewrites `return value` statements in try statements where value calls a
+    function in fns to assign value to TRY_RESULT_NAME first, as the try
+    statement must still handle exceptions that the call raises (so it can't
+    be a tail call)."""
+    def in_try(stmts):
+        new_stmts = []
+        for stmt in stmts:
+            if isinstance(stmt, ast.Return) and stmt.value is not None and \
+                    utils.calls_any(stmt.value, fns):
+                new_stmts += [utils.make_assign(TRY_RESULT_NAME, stmt.value),
+                              ast.Return(value=utils.make_lookup(TRY_RESULT_NAME))]
+                continue
+            new_stmts.append(rewrite(stmt, in_try))
+        return new_stmts
+
+    def outside_try(stmts):
+        return [rewrite(stmt, in_try if isinstance(stmt, ast.Try) else outside_try)
+                for stmt in stmts]
+
+    def rewrite(stmt, block_fn):
+        if not utils.is_supported_scope(stmt):
+            return stmt
+        kwargs = dict(ast.iter_fields(stmt))
+        for field in ("body", "orelse", "finalbody"):
+            if field in kwargs:
+                kwargs[field] = block_fn(kwargs[field])
+        if "handlers" in kwargs:
+            kwargs["handlers"] = [ast.ExceptHandler(type=handler.type, name=handler.name,
+                                                    body=block_fn(handler.body))
+                                  for handler in kwargs["handlers"]]
+        return type(stmt)(**kwargs)
+
+    fn_tree = ast.FunctionDef(**dict(ast.iter_fields(fn_tree)))
+    fn_tree.body = outside_try(fn_tree.body)
+    return fn_tree
+
+
+SUSPENDED_LOCAL_NAME = "__suspended"
+
+
+def is_suspend(stmt: ast.AST):
+    """Returns whether stmt returns a call or a yield to the trampoline."""
+    return isinstance(stmt, ast.Return) and (
+        isinstance(value := stmt.value, ast.Name) and value.id == OP_LOCAL_NAME or
+        isinstance(value, ast.Call) and isinstance(value.func, ast.Name) and
+        value.func.id in (CallOp.__name__, YieldOp.__name__))
+
+
+def suspend_in_finally(fn_tree: ast.FunctionDef):
+    """Skips the finally blocks of try statements when the fiber returns a call
+    to the trampoline from their body, as the fiber is only suspended. The
+    fiber sets the Python local SUSPENDED_LOCAL_NAME before such returns."""
+    found = False
+
+    def visit(stmts, flagging):
+        nonlocal found
+        new_stmts = []
+        for stmt in stmts:
+            if flagging and is_suspend(stmt):
+                new_stmts.append(utils.make_assign(SUSPENDED_LOCAL_NAME, ast.Constant(True)))
+            if not utils.is_supported_scope(stmt):
+                new_stmts.append(stmt)
+                continue
+            guarded = isinstance(stmt, ast.Try) and bool(stmt.finalbody) and \
+                any(is_suspend(node) for s in stmt.body for node in ast.walk(s))
+            kwargs = dict(ast.iter_fields(stmt))
+            for field in ("body", "orelse"):
+                kwargs[field] = visit(kwargs[field], flagging or guarded)
+            if guarded:
+                found = True
+                kwargs["finalbody"] = [ast.If(test=utils.make_not(utils.make_lookup(
+                    SUSPENDED_LOCAL_NAME)), body=stmt.finalbody, orelse=[])]
+            new_stmts.append(type(stmt)(**kwargs))
+        return new_stmts
+
+    fn_tree.body = visit(fn_tree.body, False)
+    if found:
+        fn_tree.body.insert(0, utils.make_assign(SUSPENDED_LOCAL_NAME, ast.Constant(False)))
+
+
+SLICE_VIEW_NAME = "__slice_view"
+
+
+def slice_args_to_views(fn_tree: ast.FunctionDef, name: str):
+    """Rewrites slices of parameters passed to self calls (e.g. name(lst[1:]))
+    to slice a view of the parameter instead, so that the call doesn't copy."""
+    params = set(utils.arg_names(fn_tree))
+
+    def view(arg):
+        if isinstance(arg, ast.Subscript) and isinstance(arg.slice, ast.Slice) and \
+                isinstance(arg.value, ast.Name) and arg.value.id in params:
+            return ast.Subscript(value=utils.make_call(SLICE_VIEW_NAME, arg.value),
+                                 slice=arg.slice, ctx=ast.Load())
+        return arg
+
+    def replace(call):
+        return ast.Call(func=call.func, args=[view(arg) for arg in call.args],
+                        keywords=[ast.keyword(arg=keyword.arg, value=view(keyword.value))
+                                  for keyword in call.keywords])
+    return mappers.map_scope(fn_tree, mappers.replace_calls_m({name}, replace))
+
+
+ACCUMULATOR_NAME = "__acc"
+ASSOCIATIVE_OPS = (ast.Add, ast.Mult, ast.BitAnd, ast.BitOr, ast.BitXor)
+
+
+def accumulated_return(stmt: ast.AST, name: str, fns: Container[str]):
+    """Returns (call, op, operand) if stmt is `return name(...) op operand`,
+    where op is associative and operand doesn't call a function in fns."""
+    if isinstance(stmt, ast.Return) and \
+            isinstance(value := stmt.value, ast.BinOp) and \
+            isinstance(value.op, ASSOCIATIVE_OPS) and \
+            matches_call(value.left, {name}) and \
+            not any(fn_call_names(value.right, fns)):
+        return value.left, value.op, value.right
+    return None
+
+
+def introduce_accumulator(fn_tree: ast.FunctionDef, name: str, fns: Container[str]):
+    """Rewrites `return name(...) op operand` into a tail call that passes
+    the pending `op operand` in an accumulator parameter, so that linear
+    recursion through an associative op runs in constant stack space.
+
+    The accumulator is a keyword only parameter that is None in the outermost
+    call; every other return combines its value with the accumulator. By
+    associativity, (name(...) op operand) op acc == name(..., operand op acc).
+
+    Returns fn_tree unchanged if the rewrite doesn't apply: every return that
+    calls name must be a tail call or accumulate with the same op."""
+    returns = [node for stmt in fn_tree.body for node in ast.walk(stmt)
+               if isinstance(node, ast.Return)]
+    accumulated = [match for stmt in returns if (match := accumulated_return(stmt, name, fns))]
+    if not accumulated or len(set(type(op) for _, op, _ in accumulated)) != 1 or \
+            ACCUMULATOR_NAME in utils.local_vars(fn_tree):
+        return fn_tree
+    for stmt in returns:
+        if not accumulated_return(stmt, name, fns) and not matches_tailcallop(stmt, {name}) and \
+                name in fn_call_names(stmt, {name}):
+            return fn_tree
+    op = accumulated[0][1]
+
+    def acc():
+        return utils.make_lookup(ACCUMULATOR_NAME)
+
+    def with_acc(call: ast.Call, value: ast.AST):
+        return ast.Return(value=ast.Call(func=call.func, args=call.args, keywords=[
+            *call.keywords, ast.keyword(arg=ACCUMULATOR_NAME, value=value)]))
+
+    def if_no_acc(body: ast.AST, orelse: ast.AST):
+        test = ast.Compare(left=acc(), ops=[ast.Is()], comparators=[ast.Constant(None)])
+        return [ast.If(test=test, body=[body], orelse=[]), orelse]
+
+    def rewrite(stmt):
+        if match := accumulated_return(stmt, name, fns):
+            call, _, operand = match
+            return if_no_acc(with_acc(call, operand),
+                             with_acc(call, ast.BinOp(left=operand, op=op, right=acc())))
+        if matches_tailcallop(stmt, {name}):
+            return [with_acc(stmt.value, acc())]
+        if isinstance(stmt, ast.Return) and stmt.value is not None:
+            return if_no_acc(stmt, ast.Return(value=ast.BinOp(left=stmt.value, op=op, right=acc())))
+        return [stmt]
+
+    def rewrite_block(stmts):
+        new_stmts = []
+        for stmt in stmts:
+            for field in ("body", "orelse", "finalbody"):
+                if isinstance(stmt, ast.FunctionDef) or not isinstance(getattr(stmt, field, None), list):
+                    continue
+                setattr(stmt, field, rewrite_block(getattr(stmt, field)))
+            for handler in getattr(stmt, "handlers", []):
+                handler.body = rewrite_block(handler.body)
+            new_stmts.extend(rewrite(stmt))
+        return new_stmts
+
+    fn_tree.body = rewrite_block(fn_tree.body)
+    fn_tree.args = ast.arguments(**dict(ast.iter_fields(fn_tree.args)))
+    fn_tree.args.kwonlyargs = [*fn_tree.args.kwonlyargs, ast.arg(arg=ACCUMULATOR_NAME)]
+    fn_tree.args.kw_defaults = [*fn_tree.args.kw_defaults, ast.Constant(None)]
+    return fn_tree
+
+
+def make_yield_expr(call: ast.Call):
+    return ast.Yield(value=make_callop_expr(call).value)
+
+
+def lower_to_generator(fn_tree: ast.FunctionDef, fns: Container[str]):
+    """Rewrites calls to functions in fns to yield a CallOp to the trampoline,
+    which sends back the call's return value, and tail calls to yield a
+    TailCallOp. Also binds the parameters from the frame."""
+    def mapper(stmt):
+        if not matches_tailcallop(stmt, fns):
+            return [expressions.replace_call_expressions(stmt, fns, make_yield_expr)]
+        call = utils.map_expression(stmt.value, lambda field, expression:
+                                    expressions.replace_call_expressions(expression, fns, make_yield_expr))
+        return [ast.Return(value=ast.Yield(value=make_tailcallop_expr(call).value))]
+    fn_tree = mappers.map_scope(fn_tree, mapper)
+
+    params = set(utils.arg_names(fn_tree))
+    fn_tree.body = make_frame_reloads(fn_tree, params, None) + fn_tree.body
+    if not any(isinstance(node, ast.Yield) for node in ast.walk(fn_tree)):
+        # The trampoline always runs the fiber as a generator.
+        fn_tree.body.append(ast.If(test=ast.Constant(False), body=[
+            ast.Expr(value=ast.Yield())], orelse=[]))
+    return fn_tree
+
+
+NATIVE_DEPTH_NAME = "__depth"
+NATIVE_CALL_NAME = "__call_native"
+TRAMPOLINED_NAME = "__trampolined"
+
+
+def native_fn_name(fn):
+    """Returns the name of the plain recursive version of fn."""
+    return f"__fibernative_{fn.__name__}"
+
+
+def make_native(fn_tree: ast.FunctionDef, fn, fns: Container[str], max_depth: int):
+    """Creates a plain recursive version of the fiber that calls fibers in fns
+    natively, passing the depth of the call in an extra keyword only
+    parameter. At max_depth, it runs the fiber on the trampoline instead."""
+    depth = utils.make_lookup(NATIVE_DEPTH_NAME)
+
+    def replace(call):
+        deeper = ast.BinOp(left=depth, op=ast.Add(), right=ast.Constant(1))
+        if call.func.id == fn.__name__:
+            return ast.Call(func=utils.make_lookup(native_fn_name(fn)), args=call.args,
+                            keywords=[*call.keywords, ast.keyword(arg=NATIVE_DEPTH_NAME, value=deeper)])
+        return ast.Call(func=utils.make_lookup(NATIVE_CALL_NAME),
+                        args=[ast.Constant(call.func.id), deeper, *call.args], keywords=call.keywords)
+    native = mappers.map_scope(fn_tree, mappers.replace_calls_m(fns, replace))
+
+    fn_args = fn_tree.args
+    positional = [utils.make_lookup(arg.arg) for arg in [*fn_args.posonlyargs, *fn_args.args]]
+    if fn_args.vararg:
+        positional.append(ast.Starred(value=utils.make_lookup(fn_args.vararg.arg), ctx=ast.Load()))
+    keywords = ast.Dict(keys=[ast.Constant(arg.arg) for arg in fn_args.kwonlyargs],
+                        values=[utils.make_lookup(arg.arg) for arg in fn_args.kwonlyargs])
+    if fn_args.kwarg:
+        keywords.keys.append(None)
+        keywords.values.append(utils.make_lookup(fn_args.kwarg.arg))
+    trampolined = ast.If(
+        test=ast.Compare(left=depth, ops=[ast.GtE()], comparators=[ast.Constant(max_depth)]),
+        body=[ast.Return(value=utils.make_call(
+            TRAMPOLINED_NAME, ast.List(elts=positional, ctx=ast.Load()), keywords))],
+        orelse=[])
+
+    native = ast.FunctionDef(**dict(ast.iter_fields(native)))
+    native.name = native_fn_name(fn)
+    native.args = copy.deepcopy(fn_args)
+    native.args.kwonlyargs.append(ast.arg(arg=NATIVE_DEPTH_NAME))
+    native.args.kw_defaults.append(ast.Constant(0))
+    native.body = [trampolined, *native.body]
+    return native
+
+
+def call_native(name, depth, /, *args, **kwargs):
+    """Calls the fiber named name from the native version of a fiber, natively
+    if the callee has a native version."""
+    metadata = FIBER_FN_NAME_MAP[name]
+    if metadata.leaf:
+        return metadata.fn(*args, **kwargs)
+    if metadata.native is not None:
+        return metadata.native(*args, __depth=depth, **kwargs)
+    return run_trampolined(metadata, args, kwargs)
+
+
+def run_trampolined(metadata: FiberMetadata, args, kwargs):
+    """Runs a fiber on the trampoline, without calling its native version."""
+    import trampoline  # trampoline imports this module.
+    return trampoline.run(metadata.fn, args, kwargs, native=False)
+
+
+def fiber(fns: Container[str] = None, *, locals, recursive=True, slots=False,
+          fast_locals=False, clear_dead=False, reuse_temporaries=False,
+          accumulate=False, slice_views=False, unroll=1, inline_base_cases=False,
+          lazy_frames=False, native_depth=None, profile_threshold=None, backend="jumps"):
     """Returns a decorator that converts a function to a fiber.
 
     A fiber is a userspace scheduled thread. In this fiber implementation, we
@@ -290,48 +1229,436 @@ def fiber(fns: Container[str] = None, *, locals, recursive=True):
     >>> import trampoline
     >>> trampoline.run(fib, [10])
     55
+
+    If slots is True, the frame is a list indexed by a fixed per-local slot
+    (computed statically from the function's locals) instead of a dict keyed
+    by variable name.
+
+    If fast_locals is True, only variables that are live across a recursive
+    call are stored in the frame. They are loaded into Python locals when the
+    function is (re-)entered and stored back right before each call; all other
+    variables are plain Python locals.
+
+    If clear_dead is True, frame entries are set to None once they are dead,
+    so that frames suspended deep in the stack only keep live values alive.
+
+    If reuse_temporaries is True, compiler temporaries whose live ranges don't
+    overlap share a name, so the frame only needs as many temporaries as are
+    simultaneously live.
+
+    If accumulate is True, linear recursion of the form
+    `return fn(...) op operand` with an associative op (+, *, &, |, ^) is
+    rewritten into a tail call with an accumulator, so that it runs in
+    constant stack space. This assumes op is associative for the values it is
+    applied to, and evaluates operand before the recursive call.
+
+    If slice_views is True, slices of parameters passed to recursive calls
+    (e.g. `fn(lst[1:])`) slice a view of the parameter instead of copying it:
+    a memoryview for bytes and bytearrays, and a views.SliceView for lists,
+    tuples and strings. Views only support len, indexing, slicing, iteration,
+    comparison and hashing, and see later mutations of the sequence.
+
+    If unroll is greater than 1, calls the function makes to itself are
+    inlined unroll - 1 levels deep (with renamed locals), so that only every
+    unroll-th level of the recursion returns to the trampoline. The code size
+    grows exponentially in unroll if the function calls itself more than once.
+
+    If inline_base_cases is True, each call to a fiber checks the base cases
+    of the callee inline: the `if test: return value` statements that its
+    body starts with, if they only read parameters and don't call functions.
+    The call is only made if no test is true, in which case the callee
+    evaluates the tests again.
+
+    If lazy_frames is True, calls enter the fiber through a function that
+    takes the call's arguments as Python parameters and runs with Python
+    locals, so calls that return without calling another fiber never create a
+    frame. At its first call to a fiber, it creates its frame from the locals
+    that are live across that call and passes it to the trampoline. Fibers for
+    which such a local may be unassigned at a call always create a frame.
+    Default values of parameters are evaluated once, like in Python.
+
+    If native_depth is given, a plain recursive version of the fiber is also
+    compiled, which trampoline.run calls first. It calls fibers natively
+    (through their own native versions, if they have one) until the calls are
+    native_depth deep. Deeper calls run on the trampoline, which returns their
+    result to the native caller. Shallow calls thus run at native speed, and
+    deep recursion only uses native_depth Python frames before switching.
+
+    If profile_threshold is given, the trampoline counts how often the fiber is
+    resumed at each pc. After that many resumes, the fiber is recompiled to
+    dispatch on the pc with one branch per observed pc, specialized to it and
+    ordered by frequency; pcs that were never observed share a generic branch
+    at the end. Only the jumps backend is profiled.
+
+    backend selects how a function resumes after a call. "jumps" (the default)
+    compiles a single function that checks the pc to jump to the resume
+    point. "continuations" compiles one function per resume point, and calls
+    pass the function to resume at to the trampoline, so there is no pc.
+    "generator" compiles a Python generator that yields calls to the
+    trampoline, using CPython's native frames instead of a heap frame (so the
+    frame options above don't apply).
+
+    A fiber that yields is streaming: trampoline.run returns an iterator over
+    the values it yields, which the trampoline hands to the consumer one at a
+    time. `yield from` a call to another streaming fiber is a call on the
+    trampoline, so the callee's values go straight to the consumer and the
+    stack only holds the frames of the calls in progress. Yields must be
+    statements, be assigned to a name or be returned. `yield from` an iterable
+    that isn't a fiber call evaluates to None. Streaming fibers must only be
+    called with `yield from` (or run), and can't be compiled with the
+    generator backend, lazy frames or a native depth.
     """
 
     if fns is None:
         fns = set()
-    for fiber_fn in FIBER_FN_NAME_MAP:
-        fns = set(fns)
-        fns.add(fiber_fn)
     if callable(fns):
         raise ValueError("Did you forget to call the fiber decorator?")
+    fns = set(fns) | set(FIBER_FN_NAME_MAP)
+    if backend not in ("jumps", "continuations", "generator"):
+        raise ValueError(f"Unknown fiber backend '{backend}'")
+    if backend == "generator" and (slots or fast_locals or clear_dead):
+        raise ValueError("The generator backend doesn't have a heap frame")
+    if unroll < 1 or (backend == "generator" and unroll != 1):
+        raise ValueError(f"Can't unroll {unroll} levels with the {backend} backend")
+    if backend == "generator" and inline_base_cases:
+        raise ValueError("The generator backend can't inline base cases")
+    if lazy_frames and (backend != "jumps" or slots or fast_locals):
+        raise ValueError("Lazy frames need dict frames and the jumps backend")
+    if native_depth is not None and native_depth < 1:
+        raise ValueError(f"Native depth {native_depth} must be positive")
 
     def make_fiber(fn):
         if recursive:
             fns.add(fn.__name__)
+        # Calls to leaf fibers are plain Python calls, not yield points.
+        fiber_fns = set(name for name in fns
+                        if name == fn.__name__ or not is_leaf(name))
 
         tree = get_tree(fn)
         name_iter, fn_tree = utils.dunder_names(), tree.body[0]
         assert isinstance(fn_tree, ast.FunctionDef)
-
-        transforms = [
-            mappers.for_to_while_m(name_iter),
-            mappers.promote_while_cond_m(name_iter),
-            mappers.bool_exps_to_if_m(name_iter),
-            mappers.promote_to_temporary_m(fns, name_iter),
-        ]
-        for t in transforms:
-            fn_tree = mappers.map_scope(fn_tree, t)
+        streaming = any(isinstance(node, (ast.Yield, ast.YieldFrom))
+                        for node in ast.walk(fn_tree))
+        if streaming:
+            if backend == "generator" or lazy_frames or native_depth is not None:
+                raise ValueError("Streaming fibers need the jumps or continuations backend "
+                                 "without lazy frames or a native depth")
+            fn_tree = mappers.map_scope(fn_tree, mappers.lower_yields_m(name_iter, fiber_fns))
+            if not isinstance(fn_tree.body[-1], ast.Return):
+                # Generators usually end without a return statement.
+                fn_tree.body.append(ast.Return(value=ast.Constant(None)))
+            # Yields suspend the fiber like calls.
+            fiber_fns.add(mappers.YIELD_NAME)
+        fn_tree = untail_calls_in_try(fn_tree, fiber_fns)
+        if slice_views:
+            fn_tree = slice_args_to_views(fn_tree, fn.__name__)
+        if accumulate:
+            fn_tree = introduce_accumulator(fn_tree, fn.__name__, fiber_fns)
+        # Calls are bound with the signature after the rewrites above.
+        fn_def = get_tree(fn).body[0]
+        fn_def.args = fn_tree.args
+        defaults = param_defaults(fn, fn_def.args, locals)
+        fn_tree = self_tail_calls_to_loop(fn_tree, fn.__name__)
+
+        if not utils.calls_any(fn_tree, fiber_fns):
+            # A leaf never yields to the trampoline, so compile it natively.
+            tree.body[0] = fn_tree
+            native_fn = compile_tree(tree, fn, locals)
+            return register(fn, FiberMetadata(fn_def, native_fn, has_pc=False, leaf=True))
+
+        native_fn = None
+        if native_depth is not None:
+            env = compile_env(fn, locals)
+            env[NATIVE_CALL_NAME] = call_native
+            # lookup is the fiber's metadata, which is created below.
+            env[TRAMPOLINED_NAME] = lambda args, kwargs: run_trampolined(lookup, args, kwargs)
+            native_tree = make_native(fn_tree, fn, fiber_fns, native_depth)
+            native_fn = compile_tree(ast.Module(body=[native_tree], type_ignores=[]),
+                                     fn, locals, env)
+
+        if backend == "generator":
+            fn_tree = lower_to_generator(fn_tree, fiber_fns)
+            fix_fn_def(fn_tree, fn, ret=False)
+            tree.body[0] = fn_tree
+            fiber_fn = compile_tree(tree, fn, locals)
+            lookup = FiberMetadata(fn_def, fiber_fn, generator=True, native=native_fn,
+                                   defaults=defaults)
+            return register(fn, lookup)
+
+        # These mappers only look at one statement, so they run in one traversal.
+        fn_tree = mappers.map_scope(fn_tree, mappers.fuse_m(
+            mappers.lower_try_m(name_iter, fiber_fns),
+            mappers.for_to_while_m(name_iter, fiber_fns),
+            mappers.promote_while_cond_m(name_iter, fiber_fns),
+            mappers.else_to_if_m(name_iter, fiber_fns),
+            mappers.bool_exps_to_if_m(name_iter, fiber_fns),
+            mappers.promote_to_temporary_m(fiber_fns, name_iter),
+        ))
+        if backend == "continuations" and any(isinstance(node, ast.Try) and utils.calls_any(
+                node, fiber_fns) for node in ast.walk(fn_tree)):
+            raise ValueError("The continuations backend can't call fibers in try statements")
+        if inline_base_cases:
+            callee_defs = {name: FIBER_FN_NAME_MAP[name].fn_def for name in fiber_fns
+                           if name in FIBER_FN_NAME_MAP and not FIBER_FN_NAME_MAP[name].generator}
+            callee_defs[fn.__name__] = fn_def
+            fn_tree = short_circuit_calls(fn_tree, callee_defs, name_iter)
+        fn_tree = unroll_self_calls(fn_tree, fn.__name__, unroll - 1, name_iter)
 
         # These mappers need access to the new tree to preprocess variables.
         fn_tree = mappers.map_scope(fn_tree, mappers.remove_trivial_temporaries_m(fn_tree))
+        if reuse_temporaries:
+            fn_tree = mappers.map_scope(fn_tree, mappers.reuse_temporaries_m(fn_tree, fiber_fns))
+        fn_tree = read_return_values(fn_tree, fiber_fns)
+
+        call_clears, materializations = {}, None
+        if fast_locals:
+            frame_vars, spills, dead = crossing_locals(fn_tree, fiber_fns)
+        else:
+            frame_vars = frame_locals(fn_tree, fiber_fns)
+            if clear_dead:
+                analysis = liveness.Liveness(lambda stmt: matches_callop(stmt, fiber_fns))
+                analysis.analyze(fn_tree)
+                call_clears = clear_dead_locals(fn_tree, analysis, fiber_fns)
+            if lazy_frames:
+                materializations = frame_materializations(fn_tree, fiber_fns, frame_vars)
 
         prev_dict = make_prev_dict(fn_tree)
-        fn_tree.body = insert_jumps(fn_tree, prev_dict, fns)
-        fn_tree = lift_locals_to_frame(fn_tree)
-        add_trampoline_returns(fn_tree, fns)
-        fix_fn_def(fn_tree, fn)
+        fn_tree.body = insert_jumps(fn_tree, prev_dict, fiber_fns)
+        continuation_name = None
+        def yields(stmt): return matches_callop(stmt, fiber_fns)
+        if backend == "continuations":
+            # Specialize the body to each resume point; the pc is a local.
+            def continuation_name(pc): return fiber_fn_name(fn, pc)
+            entries = {pc: jumps.simplify_jumps(fn_tree.body, yields, {pc})
+                       for pc in sorted(jumps.resume_pcs(fn_tree.body, yields))}
+            frame_vars = frame_vars - {jumps.PC_LOCAL_NAME}
+        else:
+            entries = {0: fn_tree.body}
+
+        frame_layout = frame_slots(fn_tree, frame_vars) if slots else None
+        call_stores = None
+        if fast_locals:
+            call_stores = {}
+            for call, names in spills.items():
+                stores = [make_frame_store(name, frame_layout)
+                          for name in [jumps.PC_LOCAL_NAME, *names] if name in frame_vars]
+                if clear_dead:
+                    stores += [make_frame_store(name, frame_layout, ast.Constant(None))
+                               for name in sorted(dead[call])]
+                call_stores[call] = stores
+
+        def compile_entries(entries):
+            tree.body = []
+            for pc, body in entries.items():
+                tree.body.append(make_entry(pc, body))
+            env = compile_env(fn, locals)
+            return compile_tree(tree, fn, locals, env), env
+
+        def make_entry(pc, body):
+            entry_tree = ast.FunctionDef(**dict(ast.iter_fields(fn_tree)))
+            entry_tree.body = body
+            if continuation_name is not None:
+                if reads_pc(entry_tree):
+                    entry_tree.body = [utils.make_assign(
+                        jumps.PC_LOCAL_NAME, ast.Constant(pc))] + entry_tree.body
+                else:
+                    remove_pc_stores(entry_tree, fiber_fns)
+            insert_call_clears(entry_tree, call_clears)
+            if fast_locals:
+                entry_tree.body = make_frame_reloads(
+                    fn_tree, frame_vars, frame_layout) + entry_tree.body
+            else:
+                entry_tree = lift_locals_to_frame(entry_tree, frame_vars, frame_layout)
+            add_trampoline_returns(entry_tree, fiber_fns, frame_layout, call_stores,
+                                   continuation_name)
+            suspend_in_finally(entry_tree)
+            fix_fn_def(entry_tree, fn, pc)
+            return entry_tree
+
+        def make_lazy_entry():
+            # Copy the body so that the main function's rewrites don't see ours.
+            copies = {}
+            entry_tree = ast.FunctionDef(**dict(ast.iter_fields(fn_tree)))
+            entry_tree.body = copy.deepcopy(jumps.simplify_jumps(fn_tree.body, yields, {0}), copies)
+            entry_tree.name = fiber_entry_name(fn)
+            if reads_pc(entry_tree):
+                entry_tree.body = [utils.make_assign(
+                    jumps.PC_LOCAL_NAME, ast.Constant(0))] + entry_tree.body
+            add_trampoline_returns(entry_tree, fiber_fns, call_frames={
+                copies[id(call)]: names for call, names in materializations.items()
+                if id(call) in copies})
+            suspend_in_finally(entry_tree)
+            return compile_tree(ast.Module(body=[entry_tree], type_ignores=[]), fn, locals)
+
+        # Before compiling, as the entries may rewrite the calls in place.
+        handlers = jumps.throw_pcs(fn_tree.body, yields)
+        entry = make_lazy_entry() if materializations is not None else None
+        # Compiling rewrites handlers that don't access the frame in place, so
+        # recompiles start from a copy (with the call maps keyed by the copies).
+        copies = {}
+        profile_body = copy.deepcopy(fn_tree.body, copies) \
+            if profile_threshold is not None else None
+        fiber_fn, env = compile_entries(entries)
+
+        lookup = FiberMetadata(fn_def, fiber_fn, frame_layout, jumps.PC_LOCAL_NAME in frame_vars,
+                               entry=entry, native=native_fn, handlers=handlers or None,
+                               streaming=streaming, defaults=defaults)
+        if backend == "jumps" and not slots and not handlers:
+            lookup.fn_tree, lookup.env = tree.body[0], env
+        if backend == "jumps" and profile_threshold is not None:
+            def recompile(counts):
+                nonlocal call_stores, call_clears
+                if call_stores is not None:
+                    call_stores = {copies[id(call)]: stores
+                                   for call, stores in call_stores.items() if id(call) in copies}
+                call_clears = {copies[id(call)]: clears
+                               for call, clears in call_clears.items() if id(call) in copies}
+                body = profile_dispatch(profile_body, counts, yields)
+                lookup.fn, lookup.env = compile_entries({0: body})
+                lookup.fn_tree = tree.body[0] if lookup.fn_tree is not None else None
+                lookup.profile = None
+                FIBER_FN_COMPILED_MAP[lookup.fn] = lookup
+            lookup.profile = Profile(profile_threshold, recompile,
+                                     frame_key(jumps.PC_LOCAL_NAME, frame_layout))
+        return register(fn, lookup)
 
-        tree.body[0] = fn_tree
-        fiber_fn = compile_tree(tree, fn, locals)
+    return make_fiber
 
-        lookup = FiberMetadata(get_tree(fn).body[0], fiber_fn)
-        FIBER_FN_NAME_MAP[fn.__name__] = lookup
-        FIBER_FN_COMPILED_MAP[fiber_fn] = lookup
-        return fiber_fn
 
-    return make_fiber
+def register(fn, lookup: FiberMetadata):
+    FIBER_FN_NAME_MAP[fn.__name__] = lookup
+    FIBER_FN_COMPILED_MAP[lookup.fn] = lookup
+    return lookup.fn
+
+
+GROUP_ID_NAME = "__fn"
+
+
+def group_fn_name(names):
+    return "__fibergroup_" + "_".join(names)
+
+
+def tailcallop_call(stmt: ast.AST):
+    """Returns the call that a `return TailCallOp(...)` statement makes."""
+    if not (isinstance(stmt, ast.Return) and isinstance(stmt.value, ast.Call) and
+            isinstance(stmt.value.func, ast.Name) and
+            stmt.value.func.id == TailCallOp.__name__):
+        return None
+    fields = {keyword.arg: keyword.value for keyword in stmt.value.keywords}
+    return ast.Call(func=ast.Name(id=fields["func"].value, ctx=ast.Load()),
+                    args=fields["args"].elts,
+                    keywords=[ast.keyword(arg=key.value, value=value) for key, value in
+                              zip(fields["kwargs"].keys, fields["kwargs"].values)])
+
+
+def make_frame_switch(bound, group_id):
+    """Creates statements that rebind the frame to a call of the group member
+    with group_id, and restart the group's dispatch loop."""
+    frame = utils.make_lookup(expressions.FRAME_LOCAL_NAME)
+    stmts = [utils.make_assign(f"__tail_{name}__", value) for name, value in bound]
+    stmts.append(ast.Expr(value=ast.Call(func=ast.Attribute(
+        value=frame, attr="clear", ctx=ast.Load()), args=[], keywords=[])))
+    stmts += [make_frame_store(name, None, utils.make_lookup(f"__tail_{name}__"))
+              for name, _ in bound]
+    stmts.append(make_frame_store(jumps.PC_LOCAL_NAME, None, ast.Constant(0)))
+    stmts.append(make_frame_store(GROUP_ID_NAME, None, ast.Constant(group_id)))
+    stmts.append(ast.Continue())
+    return stmts
+
+
+def group_entry(entry, group_id):
+    """Wraps the lazy entry of a merged fiber (see FiberMetadata.entry) so that
+    the frames it creates select the fiber in its group."""
+    def enter(*args, **kwargs):
+        op = entry(*args, **kwargs)
+        if isinstance(op, CallOp):
+            op.frame[GROUP_ID_NAME] = group_id
+        return op
+    return enter
+
+
+def merge_group(names):
+    """Merges the fibers with the given names into one function that
+    dispatches on the group id in the frame. Tail calls between them that are
+    not inside a loop rebind the frame in place instead of returning to the
+    trampoline."""
+    members = [FIBER_FN_NAME_MAP[name] for name in names]
+    group_ids = {name: i for i, name in enumerate(names)}
+
+    def rewrite(stmts):
+        result = []
+        for stmt in stmts:
+            if isinstance(stmt, ast.If):
+                stmt = ast.If(test=stmt.test, body=rewrite(stmt.body),
+                              orelse=rewrite(stmt.orelse))
+            elif (call := tailcallop_call(stmt)) is not None and \
+                    call.func.id in group_ids and \
+                    (bound := bind_tail_call(FIBER_FN_NAME_MAP[call.func.id].fn_def,
+                                             call)) is not None:
+                result.extend(make_frame_switch(bound, group_ids[call.func.id]))
+                continue
+            result.append(stmt)
+        return result
+
+    dispatch = []
+    for name, member in reversed(list(zip(names, members))):
+        test = ast.Compare(left=ast.Subscript(
+            value=utils.make_lookup(expressions.FRAME_LOCAL_NAME),
+            slice=ast.Constant(GROUP_ID_NAME), ctx=ast.Load()),
+            ops=[ast.Eq()], comparators=[ast.Constant(group_ids[name])])
+        dispatch = [ast.If(test=test, body=rewrite(member.fn_tree.body), orelse=dispatch)]
+    group_tree = ast.FunctionDef(**dict(ast.iter_fields(members[0].fn_tree)))
+    group_tree.name = group_fn_name(names)
+    group_tree.body = [ast.While(test=ast.Constant(True), body=dispatch, orelse=[])]
+
+    # The members share one namespace, so their free variables must agree.
+    free_vars = set(node.id for node in ast.walk(group_tree) if isinstance(node, ast.Name))
+    env, owners = {}, {}
+    for name, member in zip(names, members):
+        for var, value in member.env.items():
+            if var in free_vars and var in env and env[var] is not value:
+                raise ValueError(f"Can't merge {', '.join(names)}: {var!r} refers to "
+                                 f"different objects in {owners[var]} and {name}")
+            env.setdefault(var, value)
+            owners.setdefault(var, name)
+    group_fn = compile_tree(ast.Module(body=[group_tree], type_ignores=[]),
+                            members[0].fn, None, env)
+    for name, member in zip(names, members):
+        entry = group_entry(member.entry, group_ids[name]) \
+            if member.entry is not None else None
+        lookup = FiberMetadata(member.fn_def, group_fn, group_id=group_ids[name],
+                               entry=entry, native=member.native,
+                               streaming=member.streaming, defaults=member.defaults)
+        FIBER_FN_NAME_MAP[name] = lookup
+        # Keep the member's own function as a handle for trampoline.run.
+        FIBER_FN_COMPILED_MAP[member.fn] = lookup
+    return group_fn
+
+
+def merge_sccs(fns=None):
+    """Merges each group of mutually recursive fibers into a single function
+    (see merge_group), so that tail calls within the group don't return to
+    the trampoline.
+
+    Groups are the strongly connected components of the call graph of the
+    given fibers (by default, all fibers), and only fibers compiled with the
+    jumps backend and dict frames are merged. Fibers that are still being
+    profiled are left out until they have been recompiled. Call this after the
+    whole group has been defined. Returns the merged groups, as lists of names.
+    Raises ValueError if the members of a group refer to different objects by
+    the same name (e.g. they are defined in different modules)."""
+    if fns is None:
+        names = set(FIBER_FN_NAME_MAP)
+    else:
+        names = set(FIBER_FN_COMPILED_MAP[fn].fn_def.name for fn in fns)
+    candidates = {name: FIBER_FN_NAME_MAP[name].fn_def for name in names
+                  if FIBER_FN_NAME_MAP[name].fn_tree is not None and
+                  FIBER_FN_NAME_MAP[name].group_id is None and
+                  FIBER_FN_NAME_MAP[name].profile is None}
+    groups = []
+    for component in callgraph.strongly_connected_components(
+            callgraph.call_graph(candidates)):
+        if len(component) > 1:
+            groups.append(sorted(component))
+            merge_group(groups[-1])
+    return groups
@@ -12,9 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ast
 import unittest
 
 import fiber
+import trampoline
 
 
 class TestFiber(unittest.TestCase):
@@ -30,24 +32,20 @@ class TestFiber(unittest.TestCase):
         self.maxDiff = None
 
         want = """
-def __fiberfn_fib(frame):
+def __fiberfn_fib(frame, __ret=None):
     if frame['__pc'] == 0:
         if frame['n'] == 0:
-            if frame['__pc'] == 0:
-                frame['__pc'] = 1
-                return RetOp(value=0)
+            return RetOp(value=0)
         if frame['n'] == 1:
-            if frame['__pc'] == 0:
-                frame['__pc'] = 1
-                return RetOp(value=1)
+            return RetOp(value=1)
         frame['__pc'] = 1
-        return CallOp(func='fib', args=[frame['n'] - 1], kwargs={}, ret_variable='__tmp0__')
+        return CallOp(func='fib', args=[frame['n'] - 1], kwargs={})
     if frame['__pc'] == 1:
+        frame['__tmp0__'] = __ret
         frame['__pc'] = 2
-        return CallOp(func='fib', args=[], kwargs={'n': frame['n'] - 2}, ret_variable='__tmp1__')
-    if frame['__pc'] == 2:
-        frame['__pc'] = 3
-        return RetOp(value=frame['__tmp0__'] + frame['__tmp1__'])
+        return CallOp(func='fib', args=[], kwargs={'n': frame['n'] - 2})
+    __tmp1__ = __ret
+    return RetOp(value=frame['__tmp0__'] + __tmp1__)
         """.strip()
         self.assertEqual(want, fib.__fibercode__)
 
@@ -59,17 +57,409 @@ def __fiberfn_fib(frame):
             return sum(lst[1:], acc + lst[0])
 
         want = """
-def __fiberfn_sum(frame):
+def sum(lst, acc):
+    while True:
+        if not lst:
+            return acc
+        __tail_lst__ = lst[1:]
+        acc = acc + lst[0]
+        lst = __tail_lst__
+        """.strip()
+        self.assertEqual(want, sum.__fibercode__)
+
+    def test_sum_slice_views(self):
+        @fiber.fiber(locals=locals(), slice_views=True)
+        def sum(lst, acc):
+            if not lst:
+                return acc
+            return sum(lst[1:], acc + lst[0])
+
+        want = """
+def sum(lst, acc):
+    while True:
+        if not lst:
+            return acc
+        __tail_lst__ = __slice_view(lst)[1:]
+        acc = acc + lst[0]
+        lst = __tail_lst__
+        """.strip()
+        self.assertEqual(want, sum.__fibercode__)
+
+    def test_fact_accumulate(self):
+        @fiber.fiber(locals=locals(), accumulate=True)
+        def fact(n):
+            if n <= 1:
+                return 1
+            return fact(n - 1) * n
+
+        want = """
+def fact(n, *, __acc=None):
+    while True:
+        if n <= 1:
+            if __acc is None:
+                return 1
+            return 1 * __acc
+        if __acc is None:
+            __tail_n__ = n - 1
+            __acc = n
+            n = __tail_n__
+            continue
+        __tail_n__ = n - 1
+        __acc = n * __acc
+        n = __tail_n__
+        """.strip()
+        self.assertEqual(want, fact.__fibercode__)
+
+    def test_accumulate_mixed_ops(self):
+        @fiber.fiber(locals=locals(), accumulate=True)
+        def f(n):
+            if n <= 1:
+                return 1
+            if n % 2:
+                return f(n - 1) * n
+            return f(n - 1) + n
+        self.assertNotIn("__acc", f.__fibercode__)
+
+    def test_leaf_call(self):
+        @fiber.fiber(locals=locals())
+        def leaf_square(n):
+            return n * n
+
+        @fiber.fiber(locals=locals())
+        def squares(n):
+            if n == 0:
+                return 0
+            return squares(n - 1) + leaf_square(n)
+
+        want = """
+def __fiberfn_squares(frame, __ret=None):
+    if frame['__pc'] == 0:
+        if frame['n'] == 0:
+            return RetOp(value=0)
+        frame['__pc'] = 1
+        return CallOp(func='squares', args=[frame['n'] - 1], kwargs={})
+    __tmp0__ = __ret
+    return RetOp(value=__tmp0__ + leaf_square(frame['n']))
+        """.strip()
+        self.assertEqual(want, squares.__fibercode__)
+
+    def test_fib_slots(self):
+        @fiber.fiber(locals=locals(), slots=True)
+        def fib(n):
+            if n == 0:
+                return 0
+            if n == 1:
+                return 1
+            return fib(n-1) + fib(n=n-2)
+        self.maxDiff = None
+
+        want = """
+def __fiberfn_fib(frame, __ret=None):
+    if frame[0] == 0:
+        if frame[1] == 0:
+            return RetOp(value=0)
+        if frame[1] == 1:
+            return RetOp(value=1)
+        frame[0] = 1
+        return CallOp(func='fib', args=[frame[1] - 1], kwargs={})
+    if frame[0] == 1:
+        frame[2] = __ret
+        frame[0] = 2
+        return CallOp(func='fib', args=[], kwargs={'n': frame[1] - 2})
+    __tmp1__ = __ret
+    return RetOp(value=frame[2] + __tmp1__)
+        """.strip()
+        self.assertEqual(want, fib.__fibercode__)
+
+    def test_fib_fast_locals(self):
+        @fiber.fiber(locals=locals(), fast_locals=True)
+        def fib(n):
+            if n == 0:
+                return 0
+            if n == 1:
+                return 1
+            return fib(n-1) + fib(n=n-2)
+        self.maxDiff = None
+
+        want = """
+def __fiberfn_fib(frame, __ret=None):
+    __pc = frame['__pc']
+    n = frame['n']
+    __tmp0__ = frame.get('__tmp0__')
+    if __pc == 0:
+        if n == 0:
+            return RetOp(value=0)
+        if n == 1:
+            return RetOp(value=1)
+        __pc = 1
+        frame['__pc'] = __pc
+        return CallOp(func='fib', args=[n - 1], kwargs={})
+    if __pc == 1:
+        __tmp0__ = __ret
+        __pc = 2
+        frame['__pc'] = __pc
+        frame['__tmp0__'] = __tmp0__
+        return CallOp(func='fib', args=[], kwargs={'n': n - 2})
+    __tmp1__ = __ret
+    return RetOp(value=__tmp0__ + __tmp1__)
+        """.strip()
+        self.assertEqual(want, fib.__fibercode__)
+
+    def test_sum_clear_dead(self):
+        @fiber.fiber(locals=locals(), clear_dead=True)
+        def sum(lst, acc):
+            if not lst:
+                return acc
+            return sum(lst[1:], acc + lst[0]) + 1
+
+        want = """
+def __fiberfn_sum(frame, __ret=None):
     if frame['__pc'] == 0:
         if not frame['lst']:
-            if frame['__pc'] == 0:
-                frame['__pc'] = 1
-                return RetOp(value=frame['acc'])
+            return RetOp(value=frame['acc'])
         frame['__pc'] = 1
-        return TailCallOp(func='sum', args=[frame['lst'][1:], frame['acc'] + frame['lst'][0]], kwargs={})
+        __op = CallOp(func='sum', args=[frame['lst'][1:], frame['acc'] + frame['lst'][0]], kwargs={})
+        frame['acc'] = None
+        frame['lst'] = None
+        return __op
+    __tmp0__ = __ret
+    return RetOp(value=__tmp0__ + 1)
         """.strip()
         self.assertEqual(want, sum.__fibercode__)
 
+    def test_fib_continuations(self):
+        @fiber.fiber(locals=locals(), backend="continuations")
+        def fib(n):
+            if n == 0:
+                return 0
+            if n == 1:
+                return 1
+            return fib(n-1) + fib(n=n-2)
+        self.maxDiff = None
+
+        want = """
+def __fiberfn_fib(frame, __ret=None):
+    if frame['n'] == 0:
+        return RetOp(value=0)
+    if frame['n'] == 1:
+        return RetOp(value=1)
+    return CallOp(func='fib', args=[frame['n'] - 1], kwargs={}, continuation=__fiberfn_fib__1)
+
+def __fiberfn_fib__1(frame, __ret=None):
+    frame['__tmp0__'] = __ret
+    return CallOp(func='fib', args=[], kwargs={'n': frame['n'] - 2}, continuation=__fiberfn_fib__2)
+
+def __fiberfn_fib__2(frame, __ret=None):
+    __tmp1__ = __ret
+    return RetOp(value=frame['__tmp0__'] + __tmp1__)
+        """.strip()
+        self.assertEqual(want, fib.__fibercode__)
+
+    def test_fib_generator(self):
+        @fiber.fiber(locals=locals(), backend="generator")
+        def fib(n):
+            if n == 0:
+                return 0
+            if n == 1:
+                return 1
+            return fib(n-1) + fib(n=n-2)
+        self.maxDiff = None
+
+        want = """
+def __fiberfn_fib(frame):
+    n = frame['n']
+    if n == 0:
+        return 0
+    if n == 1:
+        return 1
+    return (yield CallOp(func='fib', args=[n - 1], kwargs={})) + (yield CallOp(func='fib', args=[], kwargs={'n': n - 2}))
+        """.strip()
+        self.assertEqual(want, fib.__fibercode__)
+
+    def test_generator_rejects_frame_options(self):
+        with self.assertRaises(ValueError):
+            fiber.fiber(locals=locals(), backend="generator", slots=True)
+        with self.assertRaises(ValueError):
+            fiber.fiber(locals=locals(), backend="generator", unroll=2)
+        with self.assertRaises(ValueError):
+            fiber.fiber(locals=locals(), unroll=0)
+        with self.assertRaises(ValueError):
+            fiber.fiber(locals=locals(), backend="generator", inline_base_cases=True)
+        with self.assertRaises(ValueError):
+            fiber.fiber(locals=locals(), lazy_frames=True, fast_locals=True)
+        with self.assertRaises(ValueError):
+            fiber.fiber(locals=locals(), native_depth=0)
+
+    def test_between_streaming(self):
+        @fiber.fiber(locals=locals())
+        def between(lo, hi):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            yield from between(lo, mid)
+            yield mid
+            yield from between(mid + 1, hi)
+
+        want = """
+def __fiberfn_between(frame, __ret=None):
+    if frame['__pc'] == 0:
+        if frame['lo'] >= frame['hi']:
+            return RetOp(value=None)
+        frame['mid'] = (frame['lo'] + frame['hi']) // 2
+        frame['__pc'] = 1
+        return CallOp(func='between', args=[frame['lo'], frame['mid']], kwargs={})
+    if frame['__pc'] == 1:
+        __tmp0__ = __ret
+        frame['__pc'] = 2
+        return YieldOp(value=frame['mid'])
+    if frame['__pc'] == 2:
+        __tmp1__ = __ret
+        frame['__pc'] = 3
+        return CallOp(func='between', args=[frame['mid'] + 1, frame['hi']], kwargs={})
+    __tmp2__ = __ret
+    return RetOp(value=None)
+        """.strip()
+        self.assertEqual(want, between.__fibercode__)
+
+    def test_streaming_rejects_options(self):
+        def count(n):
+            while n:
+                yield n
+                n -= 1
+
+        for options in [{"backend": "generator"}, {"lazy_frames": True}, {"native_depth": 2}]:
+            with self.subTest(**options), self.assertRaises(ValueError):
+                fiber.fiber(locals=locals(), **options)(count)
+
+    def test_handler_calls_with_finally(self):
+        def caught(n):
+            if n == 0:
+                raise KeyError(0)
+            try:
+                v = caught(n - 1)
+            except KeyError as e:
+                v = n
+                if n > 5:
+                    v = caught(0)
+            finally:
+                v = v + 1
+            return v
+
+        def caught_else(n):
+            if n == 0:
+                raise KeyError(0)
+            try:
+                v = caught_else(n - 1)
+            except KeyError as e:
+                v = len(e.args)
+            else:
+                v = v + caught_else(n - 1)
+            finally:
+                v = v * 2
+            return v
+
+        want = [caught(3), caught_else(3)]
+        for options in [{}, {"fast_locals": True}, {"clear_dead": True}, {"slots": True}]:
+            with self.subTest(**options):
+                fns = [fiber.fiber(locals=locals(), **options)(fn)
+                       for fn in [caught, caught_else]]
+                self.assertEqual(want, [trampoline.run(fn, [3]) for fn in fns])
+
+    def test_base_cases(self):
+        source = """
+def foo(n, lst):
+    if n == 0:
+        return lst[0]
+    if not lst:
+        return
+    if n > len(lst):
+        return 0
+    return foo(n - 1, lst)
+        """.strip()
+        cases = fiber.base_cases(ast.parse(source).body[0])
+        self.assertEqual([("n == 0", "lst[0]"), ("not lst", "None")],
+                         [(ast.unparse(test), ast.unparse(value)) for test, value in cases])
+
+    def test_merge_sccs(self):
+        @fiber.fiber(["is_odd"], locals=locals())
+        def is_even(n):
+            if n == 0:
+                return True
+            return is_odd(n - 1)
+
+        @fiber.fiber(locals=locals())
+        def is_odd(n):
+            if n == 0:
+                return False
+            return is_even(n=n - 1)
+
+        self.assertEqual([["is_even", "is_odd"]], fiber.merge_sccs([is_even, is_odd]))
+        want = """
+def __fibergroup_is_even_is_odd(frame, __ret=None):
+    while True:
+        if frame['__fn'] == 0:
+            if frame['n'] == 0:
+                return RetOp(value=True)
+            __tail_n__ = frame['n'] - 1
+            frame.clear()
+            frame['n'] = __tail_n__
+            frame['__pc'] = 0
+            frame['__fn'] = 1
+            continue
+        elif frame['__fn'] == 1:
+            if frame['n'] == 0:
+                return RetOp(value=False)
+            __tail_n__ = frame['n'] - 1
+            frame.clear()
+            frame['n'] = __tail_n__
+            frame['__pc'] = 0
+            frame['__fn'] = 0
+            continue
+        """.strip()
+        self.assertEqual(want, fiber.FIBER_FN_NAME_MAP["is_even"].fn.__fibercode__)
+
+    def test_merge_sccs_conflicting_free_variables(self):
+        scale = 2
+
+        @fiber.fiber(["scaled_odd"], locals=locals())
+        def scaled_even(n):
+            if n == 0:
+                return scale
+            return scaled_odd(n - 1)
+
+        scale = 3
+
+        @fiber.fiber(locals=locals())
+        def scaled_odd(n):
+            if n == 0:
+                return scale
+            return scaled_even(n - 1)
+
+        with self.assertRaisesRegex(ValueError, "'scale' refers to different objects"):
+            fiber.merge_sccs([scaled_even, scaled_odd])
+
+    def test_merge_sccs_after_profile(self):
+        @fiber.fiber(["profiled_odd"], locals=locals(), profile_threshold=1)
+        def profiled_even(n):
+            if n == 0:
+                return True
+            return profiled_odd(n - 1)
+
+        @fiber.fiber(locals=locals())
+        def profiled_odd(n):
+            if n == 0:
+                return False
+            return profiled_even(n - 1)
+
+        self.assertEqual([], fiber.merge_sccs([profiled_even, profiled_odd]))
+        fiber.FIBER_FN_NAME_MAP["profiled_even"].profile.record({"__pc": 0})
+        self.assertEqual([["profiled_even", "profiled_odd"]],
+                         fiber.merge_sccs([profiled_even, profiled_odd]))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            fiber.fiber(locals=locals(), backend="unknown")
+
 
 if __name__ == '__main__':
     unittest.main()
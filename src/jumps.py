@@ -13,50 +13,109 @@
 # limitations under the License.
 
 import ast
-from typing import List, Callable, Iterable
+from typing import Callable, Iterable, Set
 import utils
 
 PC_LOCAL_NAME = "__pc"
+# Entering a try statement at its throw pc raises the value of this local (the
+# parameter that the trampoline passes call results and exceptions in).
+THROWN_LOCAL_NAME = "__ret"
 
 
 def is_supported_jump_block(b: ast.AST):
-    return any(isinstance(b, t) for t in (ast.While, ast.If))
+    return any(isinstance(b, t) for t in (ast.While, ast.If, ast.Try))
 
 
-def block_has_jump_to(block, jump_to: Callable[[ast.AST], bool]):
-    return any(has_jump_to(stmt, jump_to) for stmt in block.body)
+def mark_jumps(stmts: Iterable[ast.AST], jump_to: Callable[[ast.AST], bool]):
+    """Returns the set of statements (recursively, through if and while
+    bodies) for which jump_to returns True or that contain such a statement.
+    Each statement is visited once."""
+    marked = set()
 
+    def helper(stmts):
+        found = False
+        for stmt in stmts:
+            inner = is_supported_jump_block(stmt) and helper(stmt.body)
+            if jump_to(stmt) or inner:
+                marked.add(stmt)
+                found = True
+        return found
+    helper(stmts)
+    return marked
 
-def has_jump_to(stmt: ast.AST, jump_to: Callable[[ast.AST], bool]):
-    return jump_to(stmt) or (is_supported_jump_block(stmt) and block_has_jump_to(stmt, jump_to))
 
-
-def partition_stmts(stmts: Iterable[ast.AST], jump_to: Callable[[ast.AST], bool]):
-    """Splits statements into partitions with jump_to statements as dividers.
+def partition_stmts(stmts: Iterable[ast.AST], marked: Set[ast.AST]):
+    """Splits statements into partitions with marked statements as dividers.
     The first statement in each partition is one that needs to be jumped to."""
     current = []
     for stmt in stmts:
-        if has_jump_to(stmt, jump_to):
+        if stmt in marked:
             yield current
             current = []
         current.append(stmt)
     yield current
 
 
-def transform_if(stmt: ast.If, jump_to: Callable[[ast.AST], bool], next_pc):
-    body, next_pc = insert_jumps(
-        stmt.body, jump_to, next_pc)
+def transform_if(stmt: ast.If, marked: Set[ast.AST], next_pc):
+    body, next_pc = insert_marked_jumps(stmt.body, marked, next_pc)
     return ast.If(test=stmt.test, body=body, orelse=stmt.orelse), next_pc
 
 
-def transform_while(stmt: ast.While, jump_to: Callable[[ast.AST], bool], next_pc):
+def transform_while(stmt: ast.While, marked: Set[ast.AST], next_pc):
     first_pc = next_pc
-    body, next_pc = insert_jumps(stmt.body, jump_to, next_pc)
+    body, next_pc = insert_marked_jumps(stmt.body, marked, next_pc)
     # While loops jump back to the start of the loop.
+    body = reset_pc_on_continue(body, first_pc)
     body.append(utils.make_assign(PC_LOCAL_NAME, ast.Constant(first_pc)))
     return ast.While(test=stmt.test, body=body, orelse=stmt.orelse), next_pc
 
 
+def transform_try(stmt: ast.Try, marked: Set[ast.AST], next_pc):
+    body, next_pc = insert_marked_jumps(stmt.body, marked, next_pc)
+    # The throw pc is in the range of the enclosing partitions, but of no
+    # partition in the body.
+    body.insert(0, make_throw_check(next_pc))
+    return ast.Try(body=body, handlers=stmt.handlers, orelse=stmt.orelse,
+                   finalbody=stmt.finalbody), next_pc + 1
+
+
+def make_throw_check(pc):
+    return ast.If(test=make_range_test(pc, pc + 1), body=[
+        ast.Raise(exc=utils.make_lookup(THROWN_LOCAL_NAME), cause=None)], orelse=[])
+
+
+def throw_check_pc(stmt: ast.AST):
+    """Returns the pc of a check created by make_throw_check, or None."""
+    if isinstance(stmt, ast.If) and len(stmt.body) == 1 and \
+            isinstance(raised := stmt.body[0], ast.Raise) and \
+            isinstance(raised.exc, ast.Name) and raised.exc.id == THROWN_LOCAL_NAME and \
+            (values := pc_test_values(stmt.test)) is not None and len(values) == 1:
+        return next(iter(values))
+    return None
+
+
+def reset_pc_on_continue(stmts, first_pc):
+    """Stores first_pc before each continue of the loop with body stmts, as the
+    continue may be reached after resuming at a later pc."""
+    new_stmts = []
+    for stmt in stmts:
+        if isinstance(stmt, ast.Continue):
+            new_stmts.append(utils.make_assign(PC_LOCAL_NAME, ast.Constant(first_pc)))
+        elif isinstance(stmt, ast.If):
+            stmt = ast.If(test=stmt.test, body=reset_pc_on_continue(stmt.body, first_pc),
+                          orelse=reset_pc_on_continue(stmt.orelse, first_pc))
+        elif isinstance(stmt, ast.Try):
+            stmt = ast.Try(body=reset_pc_on_continue(stmt.body, first_pc),
+                           handlers=[ast.ExceptHandler(
+                               type=handler.type, name=handler.name,
+                               body=reset_pc_on_continue(handler.body, first_pc))
+                               for handler in stmt.handlers],
+                           orelse=reset_pc_on_continue(stmt.orelse, first_pc),
+                           finalbody=stmt.finalbody)
+        new_stmts.append(stmt)
+    return new_stmts
+
+
 def make_range_test(start_pc, end_pc):
     """Creates an boolean expression AST that checks whether the pc variable is
     in range(start, end)."""
@@ -74,7 +133,7 @@ def make_range_test(start_pc, end_pc):
     )
 
 
-def transform_partition(partition, jump_to, next_pc):
+def transform_partition(partition, marked: Set[ast.AST], next_pc):
     """Recursively transforms the partition, and wraps it in the appropriate if
     statement. Returns the new AST as well as the next pc value."""
     body = []
@@ -84,9 +143,11 @@ def transform_partition(partition, jump_to, next_pc):
         transformed = stmt
         if isinstance(stmt, ast.If):
             # For blocks, the first inner PC is the same PC as the outer PC.
-            transformed, next_pc = transform_if(stmt, jump_to, next_pc-1)
+            transformed, next_pc = transform_if(stmt, marked, next_pc-1)
         elif isinstance(stmt, ast.While):
-            transformed, next_pc = transform_while(stmt, jump_to, next_pc-1)
+            transformed, next_pc = transform_while(stmt, marked, next_pc-1)
+        elif isinstance(stmt, ast.Try) and stmt in marked:
+            transformed, next_pc = transform_try(stmt, marked, next_pc-1)
         body.append(transformed)
     end_pc = next_pc
     body.append(utils.make_assign(PC_LOCAL_NAME, ast.Constant(end_pc)))
@@ -99,16 +160,221 @@ def insert_jumps(stmts: Iterable[ast.AST], jump_to: Callable[[ast.AST], bool], s
     which jump_to returns True has a pc value where entering the sequence with
     that value jumps to that statement.
 
-    Only recursively inserts jumps inside child if and for blocks. If your
-    block has for loops, then use for_to_while_m to rewrite them to while.
+    Only recursively inserts jumps inside child if, while and try blocks. If
+    your block has for loops, then use for_to_while_m to rewrite them to while.
+    A try block that contains a jump target also gets a throw pc, where
+    entering the sequence raises the value of THROWN_LOCAL_NAME inside the try
+    block (see throw_pcs).
 
     Returns a new list of statements and the total number of jumps inserted.
     """
+    stmts = list(stmts)
+    return insert_marked_jumps(stmts, mark_jumps(stmts, jump_to), start_pc)
+
+
+def insert_marked_jumps(stmts: Iterable[ast.AST], marked: Set[ast.AST], start_pc):
     new_stmts = []
     next_pc = start_pc
-    for partition in partition_stmts(stmts, jump_to):
+    for partition in partition_stmts(stmts, marked):
         if not partition:
             continue
-        transformed, next_pc = transform_partition(partition, jump_to, next_pc)
+        transformed, next_pc = transform_partition(partition, marked, next_pc)
         new_stmts.append(transformed)
     return new_stmts, next_pc
+
+
+def pc_test_values(test: ast.AST):
+    """Returns the pc values for which a test created by make_range_test is
+    true, or None if the test is not a pc range test."""
+    if not isinstance(test, ast.Compare):
+        return None
+    if len(test.ops) == 1 and isinstance(test.ops[0], ast.Eq) and \
+            isinstance(test.left, ast.Name) and test.left.id == PC_LOCAL_NAME and \
+            isinstance(test.comparators[0], ast.Constant):
+        return {test.comparators[0].value}
+    if len(test.ops) == 2 and isinstance(test.ops[0], ast.LtE) and \
+            isinstance(test.ops[1], ast.Lt) and \
+            isinstance(test.left, ast.Constant) and \
+            isinstance(test.comparators[0], ast.Name) and \
+            test.comparators[0].id == PC_LOCAL_NAME and \
+            isinstance(test.comparators[1], ast.Constant):
+        return set(range(test.left.value, test.comparators[1].value))
+    return None
+
+
+def pc_assign_value(stmt: ast.AST):
+    """Returns the value assigned by a `__pc = k` statement, or None."""
+    if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and \
+            isinstance(stmt.targets[0], ast.Name) and \
+            stmt.targets[0].id == PC_LOCAL_NAME and \
+            isinstance(stmt.value, ast.Constant):
+        return stmt.value.value
+    return None
+
+
+def assigned_pcs(stmt: ast.AST):
+    return set(value for node in ast.walk(stmt)
+               if (value := pc_assign_value(node)) is not None)
+
+
+def resume_pcs(stmts: Iterable[ast.AST], yields: Callable[[ast.AST], bool]):
+    """Returns the pc values that a function can be entered with: 0, the pc
+    assigned right after each yield point, and the throw pc of each try
+    statement."""
+    pcs = {0}
+
+    def helper(stmts):
+        stmts = list(stmts)
+        for i, stmt in enumerate(stmts):
+            if yields(stmt) and i + 1 < len(stmts):
+                pcs.add(pc_assign_value(stmts[i + 1]))
+            if (pc := throw_check_pc(stmt)) is not None:
+                pcs.add(pc)
+            if utils.is_block(stmt):
+                helper(stmt.body)
+    helper(stmts)
+    return pcs
+
+
+def throw_pcs(stmts: Iterable[ast.AST], yields: Callable[[ast.AST], bool]):
+    """Returns the handler table of a function: a dict that maps the pc after
+    each yield point in a try statement to the throw pc of the innermost one.
+    Resuming at that pc raises an exception that the yield point's callee
+    raised where the handlers of the try statement catch it."""
+    table = {}
+
+    def helper(stmts, throw_pc):
+        stmts = list(stmts)
+        for i, stmt in enumerate(stmts):
+            if yields(stmt) and throw_pc is not None and i + 1 < len(stmts):
+                table[pc_assign_value(stmts[i + 1])] = throw_pc
+            if isinstance(stmt, ast.Try) and stmt.body and \
+                    (pc := throw_check_pc(stmt.body[0])) is not None:
+                helper(stmt.body, pc)
+            elif utils.is_block(stmt):
+                helper(stmt.body, throw_pc)
+                helper(getattr(stmt, "orelse", []), throw_pc)
+    helper(stmts, None)
+    return table
+
+
+def simplify_jumps(stmts: Iterable[ast.AST], yields: Callable[[ast.AST], bool], pcs=None):
+    """Removes redundant pc checks and stores from the output of insert_jumps.
+
+    We propagate the set of values that the pc can have at each statement,
+    starting from the pcs the function can be resumed at. A check is removed
+    (and its body inlined) if it is always true, and removed with its body if
+    it is never true. Stores are removed if the pc already has that value, if
+    they are unreachable (e.g. after a return), or if the pc is not read
+    before the following return. Statements for which yields returns True
+    return to the trampoline, so the pc store that follows them is kept.
+
+    If pcs is given, the statements are specialized to only be entered with
+    those pc values.
+
+    Returns the new list of statements."""
+    if pcs is None:
+        pcs = resume_pcs(stmts, yields)
+    # Removing a store can make other stores and checks redundant, so repeat
+    # until nothing changes.
+    body = list(stmts)
+    while True:
+        new_body, _ = simplify_block(body, set(pcs), yields)
+        if stmt_count(new_body) == stmt_count(body):
+            return new_body
+        body = new_body
+
+
+def stmt_count(stmts):
+    """Counts statements, recursively. Simplification only removes statements,
+    so we don't need to walk expressions."""
+    return sum(1 + stmt_count(getattr(stmt, "body", ())) +
+               stmt_count(getattr(stmt, "orelse", ())) for stmt in stmts)
+
+
+def is_always_true(test: ast.AST):
+    return isinstance(test, ast.Constant) and bool(test.value)
+
+
+def simplify_block(stmts, pcs, yields, loop=None):
+    """Returns the simplified statements and the pcs that they may fall through
+    with. loop is the (continue, break) pcs of the innermost loop, which is
+    updated with the pcs at each continue and break."""
+    new_stmts = []
+    stmts = iter(stmts)
+    for stmt in stmts:
+        if not pcs:
+            break  # Unreachable.
+        if yields(stmt):
+            new_stmts.append(stmt)
+            new_stmts.append(next(stmts))  # The pc to resume at.
+            pcs = set()
+            continue
+        if (value := pc_assign_value(stmt)) is not None:
+            if pcs != {value}:
+                new_stmts.append(stmt)
+            pcs = {value}
+            continue
+        if isinstance(stmt, ast.If) and (values := pc_test_values(stmt.test)) is not None:
+            if not pcs & values:
+                continue
+            body, exit_pcs = simplify_block(stmt.body, pcs & values, yields, loop)
+            if pcs <= values:
+                new_stmts.extend(body)
+            else:
+                new_stmts.append(ast.If(test=stmt.test, body=body, orelse=[]))
+            pcs = (pcs - values) | exit_pcs
+            continue
+        if isinstance(stmt, ast.If):
+            body, body_pcs = simplify_block(stmt.body, pcs, yields, loop)
+            orelse, orelse_pcs = simplify_block(stmt.orelse, pcs, yields, loop)
+            new_stmts.append(ast.If(test=stmt.test, body=body, orelse=orelse))
+            pcs = body_pcs | orelse_pcs
+            continue
+        if isinstance(stmt, ast.While):
+            # Iterate until the pcs at the head of the loop are stable.
+            head = set(pcs)
+            while True:
+                inner = (set(), set())
+                body, exit_pcs = simplify_block(stmt.body, head, yields, inner)
+                if exit_pcs | inner[0] <= head:
+                    break
+                head |= exit_pcs | inner[0]
+            orelse, orelse_pcs = simplify_block(stmt.orelse, head, yields, loop)
+            new_stmts.append(ast.While(test=stmt.test, body=body, orelse=orelse))
+            pcs = inner[1] | (set() if is_always_true(stmt.test) else orelse_pcs)
+            continue
+        if isinstance(stmt, ast.Try):
+            body, body_pcs = simplify_block(stmt.body, pcs, yields, loop)
+            # The body may raise after any of its pc stores.
+            raised = pcs | body_pcs | set().union(*map(assigned_pcs, stmt.body))
+            handlers, exit_pcs = [], set()
+            for handler in stmt.handlers:
+                handler_body, handler_pcs = simplify_block(handler.body, raised, yields, loop)
+                handlers.append(ast.ExceptHandler(type=handler.type, name=handler.name,
+                                                  body=handler_body or [ast.Pass()]))
+                exit_pcs |= handler_pcs
+            orelse, orelse_pcs = simplify_block(stmt.orelse, body_pcs, yields, loop)
+            exit_pcs |= orelse_pcs
+            finalbody, final_pcs = simplify_block(stmt.finalbody, exit_pcs | raised, yields, loop)
+            new_stmts.append(ast.Try(body=body or [ast.Pass()], handlers=handlers,
+                                     orelse=orelse, finalbody=finalbody))
+            pcs = final_pcs if stmt.finalbody else exit_pcs
+            continue
+        new_stmts.append(stmt)
+        if loop is not None and isinstance(stmt, ast.Continue):
+            loop[0].update(pcs)
+        if loop is not None and isinstance(stmt, ast.Break):
+            loop[1].update(pcs)
+        if isinstance(stmt, (ast.Return, ast.Break, ast.Continue, ast.Raise)):
+            pcs = set()
+        else:
+            pcs = pcs | assigned_pcs(stmt)
+
+    # A pc store right before a return or another store is never read.
+    return [stmt for i, stmt in enumerate(new_stmts)
+            if not (pc_assign_value(stmt) is not None and
+                    i + 1 < len(new_stmts) and
+                    (isinstance(new_stmts[i + 1], ast.Return) or
+                     pc_assign_value(new_stmts[i + 1]) is not None) and
+                    not (i > 0 and yields(new_stmts[i - 1])))], pcs
@@ -115,6 +115,174 @@ def fib(__pc, n):
         for i in range(100):
             self.assertEqual(fib(0, i), fib_transformed(0, i))
 
+    def test_mark_jumps_visits_once(self):
+        source = """
+def foo(n):
+    a = 1
+    if n:
+        while n:
+            b = 2
+            print(b)
+        print(n)
+    return a
+        """.strip()
+
+        fn_tree = ast.parse(source).body[0]
+        visits = []
+
+        def jump_to(stmt):
+            visits.append(stmt)
+            return isinstance(stmt, ast.Assign) and stmt.targets[0].id == "b"
+        marked = jumps.mark_jumps(fn_tree.body, jump_to)
+        if_stmt, while_stmt = fn_tree.body[1], fn_tree.body[1].body[0]
+        self.assertEqual({if_stmt, while_stmt, while_stmt.body[0]}, marked)
+        self.assertEqual(len(visits), len(set(map(id, visits))))
+
+    def test_simplify(self):
+        source = """
+def foo(n):
+    if n == 0:
+        return 0
+    a = f(n)
+    b = f(a)
+    return a + b
+        """.strip()
+
+        want = """
+def foo(n):
+    if __pc == 0:
+        if n == 0:
+            return 0
+        a = f(n)
+        __pc = 1
+    if __pc == 1:
+        b = f(a)
+        __pc = 2
+    return a + b
+        """.strip()
+
+        tree = ast.parse(source)
+        fn_tree = tree.body[0]
+        assert isinstance(fn_tree, ast.FunctionDef)
+        calls = [stmt for stmt in fn_tree.body if isinstance(stmt, ast.Assign)]
+        after_calls = [fn_tree.body[fn_tree.body.index(call) + 1] for call in calls]
+        body, _ = jumps.insert_jumps(
+            fn_tree.body, lambda stmt: stmt in after_calls)
+        fn_tree.body = jumps.simplify_jumps(body, lambda stmt: stmt in calls)
+        tree = ast.fix_missing_locations(tree)
+        self.assertEqual(want, ast.unparse(tree))
+
+    def test_simplify_loop(self):
+        source = """
+def foo(n):
+    i = 0
+    while i < n:
+        a = f(i)
+        i = i + a
+    return i
+        """.strip()
+
+        want = """
+def foo(n):
+    if __pc == 0:
+        i = 0
+        __pc = 1
+    while i < n:
+        if __pc == 1:
+            a = f(i)
+            __pc = 2
+        i = i + a
+        __pc = 1
+    return i
+        """.strip()
+
+        tree = ast.parse(source)
+        fn_tree = tree.body[0]
+        loop = fn_tree.body[1]
+        calls = [loop.body[0]]
+        body, _ = jumps.insert_jumps(
+            fn_tree.body, lambda stmt: stmt is loop.body[1])
+        fn_tree.body = jumps.simplify_jumps(body, lambda stmt: stmt in calls)
+        tree = ast.fix_missing_locations(tree)
+        self.assertEqual(want, ast.unparse(tree))
+
+
+    def test_continue_resets_pc(self):
+        source = """
+def foo(n):
+    while True:
+        a = f(n)
+        if a:
+            continue
+        return a
+        """.strip()
+
+        want = """
+def foo(n):
+    while True:
+        if __pc == 0:
+            a = f(n)
+            __pc = 1
+        if a:
+            __pc = 0
+            continue
+        return a
+        """.strip()
+
+        tree = ast.parse(source)
+        fn_tree = tree.body[0]
+        loop = fn_tree.body[0]
+        calls = [loop.body[0]]
+        body, _ = jumps.insert_jumps(
+            fn_tree.body, lambda stmt: stmt is loop.body[1])
+        fn_tree.body = jumps.simplify_jumps(body, lambda stmt: stmt in calls)
+        tree = ast.fix_missing_locations(tree)
+        self.assertEqual(want, ast.unparse(tree))
+
+    def test_throw_pcs(self):
+        source = """
+def foo(n):
+    try:
+        a = f(n)
+        print(a)
+    except ValueError:
+        return 0
+    c = f(n)
+    return a + c
+        """.strip()
+
+        want = """
+def foo(n):
+    if 0 <= __pc < 3:
+        try:
+            if __pc == 2:
+                raise __ret
+            if __pc == 0:
+                a = f(n)
+                __pc = 1
+            if __pc == 1:
+                print(a)
+                __pc = 2
+        except ValueError:
+            return 0
+        c = f(n)
+        __pc = 3
+    if __pc == 3:
+        return a + c
+        __pc = 4
+        """.strip()
+
+        tree = ast.parse(source)
+        fn_tree = tree.body[0]
+        try_stmt = fn_tree.body[0]
+        calls = [try_stmt.body[0], fn_tree.body[1]]
+        body, _ = jumps.insert_jumps(
+            fn_tree.body, lambda stmt: stmt in (try_stmt.body[1], fn_tree.body[2]))
+        fn_tree.body = body
+        tree = ast.fix_missing_locations(tree)
+        self.assertEqual(want, ast.unparse(tree))
+        # Only the call in the try statement resumes at its throw pc.
+        self.assertEqual({1: 2}, jumps.throw_pcs(body, lambda stmt: stmt in calls))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,218 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ast
+from typing import Callable, Dict, Iterable, Set, Tuple, Union
+
+import utils
+
+
+def uses(node: ast.AST):
+    """Returns the set of local names that the node reads."""
+    used = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load):
+            used.add(child.id)
+    if isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+        used.add(node.target.id)
+    return used
+
+
+def defs(node: ast.AST):
+    """Returns the set of local names that the node unconditionally writes."""
+    if isinstance(node, ast.AugAssign):
+        return set()
+    targets = []
+    if isinstance(node, ast.Assign):
+        targets = node.targets
+    elif isinstance(node, ast.AnnAssign) and node.value is not None:
+        targets = [node.target]
+    defined = set()
+    for target in targets:
+        for child in ast.walk(target):
+            if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Store):
+                defined.add(child.id)
+    return defined
+
+
+# (live at a break, live at a continue) of the innermost loop.
+LoopContext = Union[Tuple[Set[str], Set[str]], None]
+
+
+class Liveness:
+    """Backwards liveness analysis over structured (if/while/try) statements.
+
+    After analyze(), live_out maps every statement to the function locals that
+    may be read after it executes before being overwritten, and live_in maps
+    every statement to the locals that may be read from its start.
+
+    insert_jumps resumes a yield point by re-entering every enclosing if and
+    while from its test, so the names read by those tests must stay live at
+    the statements for which is_yield returns True.
+
+    Returns, breaks and continues run the finally blocks of the try statements
+    they leave, so the names live at the start of the enclosing finally blocks
+    (final) are conservatively live at them."""
+
+    def __init__(self, is_yield: Callable[[ast.AST], bool] = lambda stmt: False):
+        self.is_yield = is_yield
+        self.live_out: Dict[ast.AST, Set[str]] = {}
+        self.live_in: Dict[ast.AST, Set[str]] = {}
+        self.local_vars: Set[str] = set()
+
+    def analyze(self, fn_tree: ast.FunctionDef):
+        self.local_vars = utils.local_vars(fn_tree)
+        return self.block(fn_tree.body, set(), None, set(), set())
+
+    def uses(self, node: ast.AST):
+        return uses(node) & self.local_vars
+
+    def block(self, stmts: Iterable[ast.AST], out: Set[str], loop: LoopContext,
+              enclosing: Set[str], final: Set[str]):
+        live = set(out)
+        for stmt in reversed(list(stmts)):
+            live = self.stmt(stmt, live, loop, enclosing, final)
+        return live
+
+    def stmt(self, stmt: ast.AST, out: Set[str], loop: LoopContext, enclosing: Set[str],
+             final: Set[str]):
+        if self.is_yield(stmt):
+            out = out | enclosing
+        self.live_out[stmt] = set(out)
+        self.live_in[stmt] = self.transfer(stmt, out, loop, enclosing, final)
+        return self.live_in[stmt]
+
+    def transfer(self, stmt: ast.AST, out: Set[str], loop: LoopContext, enclosing: Set[str],
+                 final: Set[str]):
+
+        if isinstance(stmt, ast.If):
+            inner = enclosing | self.uses(stmt.test)
+            return self.uses(stmt.test) | self.block(stmt.body, out, loop, inner, final) | \
+                self.block(stmt.orelse, out, loop, enclosing, final)
+        if isinstance(stmt, ast.While):
+            return self.loop(stmt, out, loop, enclosing, final)
+        if isinstance(stmt, ast.For):
+            return self.uses(stmt.iter) | self.for_(stmt, out, loop, enclosing, final)
+        if isinstance(stmt, ast.Try):
+            return self.try_(stmt, out, loop, enclosing, final)
+        if isinstance(stmt, ast.Return):
+            return (self.uses(stmt.value) if stmt.value is not None else set()) | final
+        if isinstance(stmt, ast.Break):
+            assert loop is not None
+            return loop[0] | final
+        if isinstance(stmt, ast.Continue):
+            assert loop is not None
+            return loop[1] | final
+        if utils.is_block(stmt):
+            # Unsupported scopes (e.g. with): assume the body may run or not.
+            return self.uses(stmt) | out
+        return (out - defs(stmt)) | self.uses(stmt)
+
+    def loop(self, stmt: ast.While, out: Set[str], loop: LoopContext, enclosing: Set[str],
+             final: Set[str]):
+        test = self.uses(stmt.test)
+        inner = enclosing | test
+        orelse = self.block(stmt.orelse, out, loop, enclosing, final)
+        head = test | orelse
+        while True:
+            body = self.block(stmt.body, head, (out, head), inner, final)
+            new_head = test | orelse | body
+            if new_head == head:
+                return head
+            head = new_head
+
+    def for_(self, stmt: ast.For, out: Set[str], loop: LoopContext, enclosing: Set[str],
+             final: Set[str]):
+        # The target is assigned at the head of every iteration.
+        target = defs(ast.Assign(targets=[stmt.target], value=stmt.iter))
+        orelse = self.block(stmt.orelse, out, loop, enclosing, final)
+        head = orelse
+        while True:
+            body = self.block(stmt.body, head, (out, head), enclosing, final)
+            new_head = orelse | (body - target)
+            if new_head == head:
+                return head
+            head = new_head
+
+    def try_(self, stmt: ast.Try, out: Set[str], loop: LoopContext, enclosing: Set[str],
+             final: Set[str]):
+        after = self.block(stmt.finalbody, out, loop, enclosing, final)
+        if stmt.finalbody:
+            # The finally block runs when the rest of the statement exits early.
+            final = final | after
+        handlers = set()
+        for handler in stmt.handlers:
+            handlers |= self.block(handler.body, after, loop, enclosing, final)
+            if handler.type is not None:
+                handlers |= self.uses(handler.type)
+        orelse = self.block(stmt.orelse, after, loop, enclosing, final)
+        # An exception may be raised anywhere in the body, so the handlers'
+        # live variables are conservatively live throughout the body.
+        return self.block(stmt.body, orelse | handlers, loop, enclosing, final) | handlers
+
+
+def meet(*assigned: Union[Set[str], None]):
+    """Intersects the definitely assigned names of several paths; None marks an
+    unreachable path."""
+    reachable = [names for names in assigned if names is not None]
+    return set.intersection(*reachable) if reachable else None
+
+
+def definitely_assigned(fn_tree: ast.FunctionDef, is_point: Callable[[ast.AST], bool]):
+    """Forwards analysis that returns a dict mapping every reachable statement
+    for which is_point returns True to the locals that are assigned on every
+    path from the start of the function to it.
+
+    Loop bodies may not run, so only a `while True` loop's breaks add to the
+    names assigned after the loop. Exceptions may leave a try body at any
+    point, so only its finally block does."""
+    points: Dict[ast.AST, Set[str]] = {}
+
+    def block(stmts, assigned, breaks):
+        for stmt in stmts:
+            if assigned is None:
+                break
+            if is_point(stmt):
+                points[stmt] = set(assigned)
+            assigned = transfer(stmt, assigned, breaks)
+        return assigned
+
+    def transfer(stmt, assigned, breaks):
+        if isinstance(stmt, ast.If):
+            return meet(block(stmt.body, assigned, breaks), block(stmt.orelse, assigned, breaks))
+        if isinstance(stmt, (ast.While, ast.For)):
+            inner = []
+            block(stmt.body, assigned, inner)
+            infinite = isinstance(stmt, ast.While) and \
+                isinstance(stmt.test, ast.Constant) and bool(stmt.test.value)
+            done = None if infinite else block(stmt.orelse, assigned, breaks)
+            return meet(done, *inner)
+        if isinstance(stmt, ast.Try):
+            block(stmt.body, assigned, breaks)
+            for handler in stmt.handlers:
+                block(handler.body, assigned, breaks)
+            block(stmt.orelse, assigned, breaks)
+            return block(stmt.finalbody, assigned, breaks)
+        if isinstance(stmt, (ast.Return, ast.Raise, ast.Continue)):
+            return None
+        if isinstance(stmt, ast.Break):
+            breaks.append(assigned)
+            return None
+        if utils.is_block(stmt):
+            block(stmt.body, assigned, breaks)
+            return assigned
+        return assigned | defs(stmt)
+
+    block(fn_tree.body, set(utils.arg_names(fn_tree)), [])
+    return points
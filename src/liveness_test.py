@@ -0,0 +1,167 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ast
+import unittest
+
+import liveness
+
+
+def analyze(source, is_yield=lambda stmt: False):
+    fn_tree = ast.parse(source).body[0]
+    analysis = liveness.Liveness(is_yield)
+    analysis.analyze(fn_tree)
+    live_out = {ast.unparse(stmt): names for stmt,
+                names in analysis.live_out.items()}
+    return analysis, live_out
+
+
+class TestLiveness(unittest.TestCase):
+
+    def test_straight_line(self):
+        source = """
+def foo(a, b):
+    c = a + b
+    d = c * 2
+    e = d + b
+    return e
+        """.strip()
+        _, live_out = analyze(source)
+        self.assertEqual({"c", "b"}, live_out["c = a + b"])
+        self.assertEqual({"d", "b"}, live_out["d = c * 2"])
+        self.assertEqual({"e"}, live_out["e = d + b"])
+        self.assertEqual(set(), live_out["return e"])
+
+    def test_loop(self):
+        source = """
+def foo(n):
+    total = 0
+    i = 0
+    while i < n:
+        t = f(i)
+        total += t
+        i += 1
+    return total
+        """.strip()
+        _, live_out = analyze(source)
+        self.assertEqual({"n", "total"}, live_out["total = 0"])
+        self.assertEqual({"i", "n", "t", "total"}, live_out["t = f(i)"])
+        self.assertEqual({"i", "n", "total"}, live_out["i += 1"])
+
+    def test_break_continue(self):
+        source = """
+def foo(n, m):
+    while n:
+        if m:
+            x = g()
+            break
+        y = h()
+        continue
+    return x
+        """.strip()
+        _, live_out = analyze(source)
+        self.assertEqual({"x"}, live_out["x = g()"])
+        self.assertEqual({"m", "n", "x"}, live_out["y = h()"])
+
+    def test_abrupt_exits_run_finally(self):
+        source = """
+def foo(n, log):
+    while n:
+        try:
+            t = f(n)
+            if t:
+                break
+            x = g(t)
+            return x
+        finally:
+            log.append(n)
+    return 0
+        """.strip()
+        _, live_out = analyze(source)
+        # log is read by the finally block that the break and return run.
+        self.assertEqual({"log", "n", "t"}, live_out["t = f(n)"])
+        self.assertEqual({"log", "n", "x"}, live_out["x = g(t)"])
+
+    def test_yield_keeps_enclosing_tests_live(self):
+        source = """
+def foo(a, b):
+    if a:
+        x = g(b)
+        return x
+    return 0
+        """.strip()
+        _, live_out = analyze(source)
+        self.assertEqual({"x"}, live_out["x = g(b)"])
+
+        _, live_out = analyze(
+            source, is_yield=lambda stmt: isinstance(stmt, ast.Assign))
+        self.assertEqual({"a", "x"}, live_out["x = g(b)"])
+
+    def test_try(self):
+        source = """
+def foo(it, done):
+    while done:
+        try:
+            k = next(it)
+        except StopIteration:
+            done = False
+            continue
+        print(k)
+        """.strip()
+        _, live_out = analyze(source)
+        self.assertEqual({"done", "it", "k"}, live_out["k = next(it)"])
+
+
+    def test_for(self):
+        source = """
+def foo(xs, k):
+    total = 0
+    for x in xs:
+        total += x * k
+    return total
+        """.strip()
+        _, live_out = analyze(source)
+        self.assertEqual({"k", "total", "xs"}, live_out["total = 0"])
+        self.assertEqual({"k", "total"}, live_out["total += x * k"])
+
+    def test_definitely_assigned(self):
+        source = """
+def foo(n, xs):
+    if n:
+        a = 1
+        b = 2
+    else:
+        a = 3
+    r = f(a)
+    while True:
+        c = 4
+        if n:
+            break
+        d = 5
+    s = g(c)
+    for x in xs:
+        e = 6
+    t = h(e)
+        """.strip()
+        fn_tree = ast.parse(source).body[0]
+        assigned = liveness.definitely_assigned(
+            fn_tree, lambda stmt: isinstance(stmt, ast.Assign) and
+            isinstance(stmt.value, ast.Call))
+        assigned = {ast.unparse(stmt): names for stmt, names in assigned.items()}
+        self.assertEqual({"n", "xs", "a"}, assigned["r = f(a)"])
+        self.assertEqual({"n", "xs", "a", "r", "c"}, assigned["s = g(c)"])
+        self.assertEqual({"n", "xs", "a", "r", "c", "s"}, assigned["t = h(e)"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,9 +13,11 @@
 # limitations under the License.
 
 import ast
+from collections import Counter
 from collections.abc import Container
 
 import expressions
+import liveness
 import utils
 
 
@@ -23,16 +25,37 @@ def map_scope(scope, fn):
     """Applies the mapping function to every statement in the scope.
 
     The mapping function should return a list of statements; the returned
-    statements will be flattened together."""
+    statements will be flattened together. If no statement changes, the scope
+    itself is returned."""
     kwargs = {field: value for field, value in ast.iter_fields(scope)}
-    body = []
-    for stmt in scope.body:
-        body.extend(fn(stmt))
-        # TODO(tylerhou): Should we map all scopes?
-        if utils.is_supported_scope(stmt):
-            body[-1] = map_scope(body[-1], fn)
-    kwargs["body"] = body
-    return type(scope)(**kwargs)
+    changed = False
+    for field in utils.SCOPE_FIELDS:
+        if field != "body" and not utils.is_supported_scope(scope) or field not in kwargs:
+            continue
+        if field == "handlers":
+            block = [map_scope(handler, fn) for handler in kwargs[field]]
+        else:
+            block = []
+            for stmt in kwargs[field]:
+                # TODO(tylerhou): Should we map all scopes?
+                block.extend(map_scope(new_stmt, fn) if utils.is_supported_scope(new_stmt)
+                             else new_stmt for new_stmt in fn(stmt))
+        changed = changed or len(block) != len(kwargs[field]) or \
+            any(new is not old for new, old in zip(block, kwargs[field]))
+        kwargs[field] = block
+    return type(scope)(**kwargs) if changed else scope
+
+
+def fuse_m(*mappers):
+    """Creates a function mapper that applies mappers in order, each to every
+    statement returned by the previous one, so that map_scope runs them all in
+    one traversal. Each mapper must only look at the statement it is given."""
+    def mapper(stmt):
+        stmts = [stmt]
+        for m in mappers:
+            stmts = [new_stmt for s in stmts for new_stmt in m(s)]
+        return stmts
+    return mapper
 
 
 def promote_to_temporary_m(fns: Container[str], name_iter):
@@ -46,11 +69,31 @@ def promote_to_temporary_m(fns: Container[str], name_iter):
     return promote_mapper
 
 
+def replace_calls_m(fns: Container[str], replace):
+    """Creates a function mapper that replaces calls to functions in fns with
+    replace(call)."""
+    def mapper(stmt):
+        return [expressions.replace_call_expressions(stmt, fns, replace)]
+    return mapper
+
+
 def remove_trivial_temporaries_m(fn_ast: ast.AST):
     """Creates a function mapper that removes trivial assignments."""
     trivial_temps = set(utils.potentially_trivial_temporaries(fn_ast))
     first_assignment, last_assignment = utils.find_assignments(fn_ast, trivial_temps)
     trivial_temps = set(t for t in trivial_temps if last_assignment[t] is first_assignment[t])
+    # The temporary must only be read by the assignment that replaces it.
+    reads = Counter(node.id for node in ast.walk(fn_ast)
+                    if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load))
+    trivial_temps = set(t for t in trivial_temps if reads[t] == 1)
+    # The temporary must be read in the block where it is assigned (a handler
+    # may assign a temporary that is read after its try statement).
+    blocks = utils.enclosing_blocks(fn_ast)
+    for stmt in utils.iter_scope(fn_ast):
+        if isinstance(stmt, (ast.Return, ast.Assign, ast.AnnAssign)) and \
+                isinstance(stmt.value, ast.Name) and stmt.value.id in trivial_temps and \
+                blocks[id(stmt)] is not blocks[id(last_assignment[stmt.value.id])]:
+            trivial_temps.discard(stmt.value.id)
     trivial_assignments = set(last_assignment[t] for t in trivial_temps)
     to_replace = {temp: last_assignment[temp] for temp in trivial_temps if temp in trivial_temps}
 
@@ -60,44 +103,356 @@ def remove_trivial_temporaries_m(fn_ast: ast.AST):
     return remove_trivial_mapper
 
 
-def for_to_while_m(name_iter):
-    """Creates a function mapper that converts for loops to equivalent while loops."""
+def reuse_temporaries_m(fn_ast: ast.AST, fns: Container[str]):
+    """Creates a function mapper that renames temporaries so that temporaries
+    whose live ranges don't overlap share a name (and so a frame entry)."""
+    def is_call(stmt):
+        return isinstance(stmt, ast.Assign) and \
+            isinstance(stmt.value, ast.Call) and \
+            isinstance(stmt.value.func, ast.Name) and \
+            stmt.value.func.id in fns
+
+    analysis = liveness.Liveness(is_call)
+    analysis.analyze(fn_ast)
+
+    # Two temporaries interfere if one is assigned while the other is live.
+    temps, interference = [], {}
+    for stmt in utils.iter_scope(fn_ast):
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Name) and utils.is_temporary(node.id) and \
+                    node.id not in interference:
+                temps.append(node.id)
+                interference[node.id] = set()
+    for stmt, live_out in analysis.live_out.items():
+        for temp in liveness.defs(stmt) & interference.keys():
+            for other in live_out & interference.keys() - {temp}:
+                interference[temp].add(other)
+                interference[other].add(temp)
+
+    # Greedily color temporaries in order of first appearance. Each color is
+    # named after the first temporary assigned to it.
+    renames = {}
+    for temp in temps:
+        taken = set(renames[other]
+                    for other in interference[temp] if other in renames)
+        renames[temp] = next(
+            (renames[t] for t in temps if t in renames and renames[t] == t and t not in taken), temp)
+
+    def rename(field, expression):
+        if isinstance(expression, ast.Name) and expression.id in renames:
+            return ast.Name(id=renames[expression.id], ctx=expression.ctx)
+        return utils.map_expression(expression, rename)
+
+    def mapper(stmt):
+        return [utils.map_expression(stmt, rename)]
+    return mapper
+
+
+SEQUENCE_FNS = ("list", "tuple", "sorted")
+
+
+def range_step(iterable: ast.AST):
+    """Returns the constant step of a range(...) call with a constant nonzero
+    step, or None if iterable is not such a call."""
+    if not (isinstance(iterable, ast.Call) and isinstance(iterable.func, ast.Name) and
+            iterable.func.id == "range" and not iterable.keywords and
+            1 <= len(iterable.args) <= 3 and
+            not any(isinstance(arg, ast.Starred) for arg in iterable.args)):
+        return None
+    if len(iterable.args) < 3:
+        return 1
+    step = iterable.args[2]
+    if isinstance(step, ast.UnaryOp) and isinstance(step.op, ast.USub):
+        step = ast.Constant(value=-step.operand.value) \
+            if isinstance(step.operand, ast.Constant) else None
+    if isinstance(step, ast.Constant) and type(step.value) is int and step.value:
+        return step.value
+    return None
+
+
+def is_sequence(iterable: ast.AST):
+    """Returns whether iterable is a list or tuple display or a call that
+    builds a list or tuple."""
+    return isinstance(iterable, (ast.List, ast.Tuple)) or \
+        (isinstance(iterable, ast.Call) and isinstance(iterable.func, ast.Name) and
+         iterable.func.id in SEQUENCE_FNS)
+
+
+def make_for_next(target: ast.AST, value: ast.AST, test_n: str, test: ast.AST):
+    """Creates the statements that start an iteration of a lowered for loop:
+    they exit the loop (through its test) if test is false, and otherwise
+    assign value to the loop target."""
+    return [
+        utils.make_assign(test_n, test),
+        ast.If(test=utils.make_not(utils.make_lookup(test_n)),
+               body=[ast.Continue()], orelse=[]),
+        ast.Assign(targets=[target], value=value),
+    ]
+
+
+def loop_else(loop: ast.While, test_n: str, orelse, fns: Container[str] = None):
+    """Returns the statements that run loop, whose test is the variable test_n,
+    with the else block orelse. If orelse calls a function in fns, it runs in
+    an if statement after the loop instead, as jumps can't be inserted into
+    the else block of a loop: the loop only exits with a false test when it
+    didn't break."""
+    if fns is None or not any(utils.calls_any(s, fns) for s in orelse):
+        loop.orelse = orelse
+        return [loop]
+    return [loop, ast.If(test=utils.make_not(utils.make_lookup(test_n)),
+                         body=orelse, orelse=[])]
+
+
+def range_to_while(stmt: ast.For, step: int, name_iter, fns: Container[str] = None):
+    counter_n, stop_n, test_n = next(name_iter), next(name_iter), next(name_iter)
+    args = stmt.iter.args
+    start, stop = (ast.Constant(value=0), args[0]) if len(args) == 1 else args[:2]
+    test = ast.Compare(left=utils.make_lookup(counter_n),
+                       ops=[ast.Lt() if step > 0 else ast.Gt()],
+                       comparators=[utils.make_lookup(stop_n)])
+    increment = utils.make_assign(counter_n, ast.BinOp(
+        left=utils.make_lookup(counter_n), op=ast.Add() if step > 0 else ast.Sub(),
+        right=ast.Constant(value=abs(step))))
+    body = make_for_next(stmt.target, utils.make_lookup(counter_n), test_n, test) + \
+        [increment] + stmt.body
+    return [
+        utils.make_assign(counter_n, start),
+        utils.make_assign(stop_n, stop),
+        utils.make_assign(test_n, ast.Constant(value=True)),
+        *loop_else(ast.While(test=utils.make_lookup(test_n), body=body, orelse=[]),
+                   test_n, stmt.orelse, fns),
+    ]
+
+
+def sequence_to_while(stmt: ast.For, name_iter, fns: Container[str] = None):
+    seq_n, index_n, test_n = next(name_iter), next(name_iter), next(name_iter)
+    test = ast.Compare(left=utils.make_lookup(index_n), ops=[ast.Lt()],
+                       comparators=[utils.make_call("len", utils.make_lookup(seq_n))])
+    item = ast.Subscript(value=utils.make_lookup(seq_n),
+                         slice=utils.make_lookup(index_n), ctx=ast.Load())
+    increment = utils.make_assign(index_n, ast.BinOp(
+        left=utils.make_lookup(index_n), op=ast.Add(), right=ast.Constant(value=1)))
+    body = make_for_next(stmt.target, item, test_n, test) + [increment] + stmt.body
+    return [
+        utils.make_assign(seq_n, stmt.iter),
+        utils.make_assign(index_n, ast.Constant(value=0)),
+        utils.make_assign(test_n, ast.Constant(value=True)),
+        *loop_else(ast.While(test=utils.make_lookup(test_n), body=body, orelse=[]),
+                   test_n, stmt.orelse, fns),
+    ]
+
+
+def for_to_while_m(name_iter, fns: Container[str] = None):
+    """Creates a function mapper that converts for loops to equivalent while loops.
+
+    Loops over range(...) with a constant step use an integer counter, and
+    loops over lists and tuples use an index, instead of an iterator and
+    StopIteration. This assumes range, list, tuple and sorted are the builtins.
+
+    If fns is given, only loops that call a function in fns are converted."""
     def mapper(stmt):
         if not isinstance(stmt, ast.For):
             return [stmt]
+        if fns is not None and not utils.calls_any(stmt, fns):
+            return [stmt]
+        if (step := range_step(stmt.iter)) is not None:
+            return range_to_while(stmt, step, name_iter, fns)
+        if is_sequence(stmt.iter):
+            return sequence_to_while(stmt, name_iter, fns)
         iter_n, test_n = next(name_iter), next(name_iter)
         body = [utils.make_for_try(stmt.target, iter_n, test_n)] + stmt.body
         return [
             utils.make_assign(iter_n, utils.make_call("iter", stmt.iter)),
             utils.make_assign(test_n, ast.Constant(value=True)),
-            ast.While(test=utils.make_lookup(test_n),
-                      body=body, orelse=stmt.orelse),
+            *loop_else(ast.While(test=utils.make_lookup(test_n), body=body, orelse=[]),
+                       test_n, stmt.orelse, fns),
         ]
     return mapper
 
 
-def promote_while_cond_m(name_iter):
-    """Creates a function mapper that promotes the test in while loops to a variable."""
+def promote_while_cond_m(name_iter, fns: Container[str] = None):
+    """Creates a function mapper that promotes the test in while loops to a variable.
+
+    If fns is given, only loops that call a function in fns are rewritten, as
+    the test of other loops is never re-evaluated on resume."""
     def mapper(stmt):
         if not isinstance(stmt, ast.While):
             return [stmt]
-        if isinstance(stmt.test, ast.Name):
+        # An else block that calls a function in fns runs after the loop, which
+        # needs the test in a variable even if it is a name.
+        else_calls = fns is not None and any(utils.calls_any(s, fns) for s in stmt.orelse)
+        if (isinstance(stmt.test, (ast.Name, ast.Constant)) and not else_calls) or \
+                (fns is not None and not utils.calls_any(stmt, fns)):
             return [stmt]
             # TODO(tylerhou): Add a test for this.
         condition_n = next(name_iter)
         test_assign = utils.make_assign(condition_n, stmt.test)
-        body = stmt.body + [test_assign]
-        return [test_assign, ast.While(test=utils.make_lookup(condition_n), body=body, orelse=stmt.orelse)]
+        # The test is assigned in two places, so they must be distinct nodes.
+        body = stmt.body + [utils.make_assign(condition_n, stmt.test)]
+        return [test_assign, *loop_else(
+            ast.While(test=utils.make_lookup(condition_n), body=body, orelse=[]),
+            condition_n, stmt.orelse, fns)]
+    return mapper
+
+
+def else_to_if_m(name_iter, fns: Container[str]):
+    """Creates a function mapper that rewrites if statements whose else block
+    calls a function in fns into two if statements on a temporary, as jumps can
+    only be inserted into the body of an if statement."""
+    def mapper(stmt):
+        if not isinstance(stmt, ast.If) or \
+                not any(utils.calls_any(s, fns) for s in stmt.orelse):
+            return [stmt]
+        test_n = next(name_iter)
+        return [
+            utils.make_assign(test_n, stmt.test),
+            ast.If(test=utils.make_lookup(test_n), body=stmt.body, orelse=[]),
+            ast.If(test=utils.make_not(utils.make_lookup(test_n)),
+                   body=stmt.orelse, orelse=[]),
+        ]
     return mapper
 
 
-def bool_exps_to_if_m(name_iter):
+EXCEPTION_LOCAL_NAME = "__exc"
+
+
+def reraise(stmts, name: str):
+    """Replaces bare raise statements of a handler body with `raise name`. Does
+    not descend into the handlers of nested try statements."""
+    new_stmts = []
+    for stmt in stmts:
+        if isinstance(stmt, ast.Raise) and stmt.exc is None:
+            stmt = ast.Raise(exc=utils.make_lookup(name), cause=None)
+        elif utils.is_supported_scope(stmt):
+            kwargs = dict(ast.iter_fields(stmt))
+            for field in ("body", "orelse", "finalbody"):
+                if field in kwargs:
+                    kwargs[field] = reraise(kwargs[field], name)
+            stmt = type(stmt)(**kwargs)
+        new_stmts.append(stmt)
+    return new_stmts
+
+
+def lower_try_m(name_iter, fns: Container[str]):
+    """Creates a function mapper that rewrites try statements so that calls to
+    functions in fns are only in try bodies, as jumps can only be inserted into
+    the body of a try statement.
+
+    Handlers bind the exception to EXCEPTION_LOCAL_NAME, which stays a Python
+    local, and assign it to their own name. A try statement with a finally
+    block and handlers or an else block is split into a try/finally around a
+    try statement without one. If a handler or the else block calls a
+    function in fns, the handlers only record which handler caught the
+    exception, and the handlers and the else block run after the try
+    statement (so bare raise statements raise the recorded exception)."""
+    def name_handler(handler):
+        if handler.name is None or handler.name == EXCEPTION_LOCAL_NAME:
+            return handler
+        return ast.ExceptHandler(type=handler.type, name=EXCEPTION_LOCAL_NAME, body=[
+            utils.make_assign(handler.name, utils.make_lookup(EXCEPTION_LOCAL_NAME)),
+            *handler.body])
+
+    def mapper(stmt):
+        if not isinstance(stmt, ast.Try):
+            return [stmt]
+        if any(utils.calls_any(s, fns) for s in stmt.finalbody):
+            raise ValueError("Calls to fibers in finally blocks aren't supported")
+        handlers = [name_handler(handler) for handler in stmt.handlers]
+        moved = any(utils.calls_any(s, fns)
+                    for s in [*stmt.orelse, *(s for h in stmt.handlers for s in h.body)])
+        if stmt.finalbody and (handlers or stmt.orelse) and \
+                (moved or any(utils.calls_any(s, fns) for s in stmt.body)):
+            # The inner try statement is lowered again, which names its handlers.
+            inner = ast.Try(body=stmt.body, handlers=stmt.handlers, orelse=stmt.orelse,
+                            finalbody=[])
+            return [ast.Try(body=[inner], handlers=[], orelse=[], finalbody=stmt.finalbody)]
+        if not moved:
+            if all(new is old for new, old in zip(handlers, stmt.handlers)):
+                return [stmt]
+            return [ast.Try(body=stmt.body, handlers=handlers, orelse=stmt.orelse,
+                            finalbody=stmt.finalbody)]
+
+        handler_n, caught_n = next(name_iter), next(name_iter)
+        record = ast.Try(body=stmt.body, handlers=[
+            ast.ExceptHandler(type=handler.type, name=EXCEPTION_LOCAL_NAME, body=[
+                utils.make_assign(handler_n, ast.Constant(i)),
+                utils.make_assign(caught_n, utils.make_lookup(EXCEPTION_LOCAL_NAME))])
+            for i, handler in enumerate(stmt.handlers, 1)], orelse=[], finalbody=[])
+
+        def when(i, body):
+            return ast.If(test=ast.Compare(left=utils.make_lookup(handler_n), ops=[ast.Eq()],
+                                           comparators=[ast.Constant(i)]), body=body, orelse=[])
+        stmts = [utils.make_assign(handler_n, ast.Constant(0)), record]
+        if stmt.orelse:
+            stmts.append(when(0, stmt.orelse))
+        for i, handler in enumerate(stmt.handlers, 1):
+            bind = [utils.make_assign(handler.name, utils.make_lookup(caught_n))] \
+                if handler.name is not None else []
+            stmts.append(when(i, bind + reraise(handler.body, caught_n)))
+        return stmts
+    return mapper
+
+
+YIELD_NAME = "__yield"
+
+
+def lower_yields_m(name_iter, fns: Container[str]):
+    """Creates a function mapper that rewrites yields as calls: `yield value`
+    as a call to YIELD_NAME with the value (the call returns the value sent to
+    the yield), and `yield from` a call to a function in fns as a plain call,
+    so the callee yields to the same consumer and the call returns its return
+    value. `yield from` another iterable becomes a loop that yields each item
+    and evaluates to None. Bare return statements return None.
+
+    Yields must be expression statements, or be the value of an assignment or
+    a return statement."""
+    def lower(value):
+        """Returns the statements to run before the yield and the expression
+        that replaces it."""
+        if isinstance(value, ast.Yield):
+            item = value.value if value.value is not None else ast.Constant(None)
+            return [], utils.make_call(YIELD_NAME, item)
+        if isinstance(value.value, ast.Call) and isinstance(value.value.func, ast.Name) and \
+                value.value.func.id in fns:
+            return [], value.value
+        item = next(name_iter)
+        return [ast.For(target=ast.Name(id=item, ctx=ast.Store()), iter=value.value,
+                        body=[ast.Expr(value=ast.Yield(value=utils.make_lookup(item)))],
+                        orelse=[])], ast.Constant(None)
+
+    def is_yield(node):
+        return isinstance(node, (ast.Yield, ast.YieldFrom))
+
+    def mapper(stmt):
+        if isinstance(stmt, ast.Return) and stmt.value is None:
+            # Generators often return without a value.
+            return [ast.Return(value=ast.Constant(None))]
+        if isinstance(stmt, ast.Expr) and is_yield(stmt.value):
+            stmts, value = lower(stmt.value)
+            return [*stmts, utils.make_assign(next(name_iter), value)]
+        if isinstance(stmt, (ast.Assign, ast.AugAssign, ast.Return)) and is_yield(stmt.value):
+            stmts, value = lower(stmt.value)
+            return [*stmts, type(stmt)(**dict(ast.iter_fields(stmt), value=value))]
+        for field, value in ast.iter_fields(stmt):
+            if utils.is_supported_scope(stmt) and field in utils.SCOPE_FIELDS:
+                continue
+            for node in value if isinstance(value, list) else [value]:
+                if isinstance(node, ast.AST) and any(map(is_yield, ast.walk(node))):
+                    raise ValueError("Yields must be statements, assigned or returned")
+        return [stmt]
+    return mapper
+
+
+def bool_exps_to_if_m(name_iter, fns: Container[str] = None):
     """Creates a function mapper that rewrites boolean expressions as if
-    statements so promotion to temporaries doesn't change evaluation order."""
+    statements so promotion to temporaries doesn't change evaluation order.
+
+    If fns is given, only boolean expressions that call a function in fns are
+    rewritten."""
     def mapper(stmt):
         stmts = []
         stmts.append(expressions.promote_boolean_expression_operands(
-            stmt, name_iter, stmts))  # Mutates stmts
+            stmt, name_iter, stmts, fns))  # Mutates stmts
         return stmts
     return mapper
 
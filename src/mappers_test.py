@@ -96,6 +96,19 @@ def foo():
         result = ast.unparse(tree)
         self.assertEqual(result, want)
 
+    def test_remove_trivial_temporaries_m_read_twice(self):
+        source = """
+def foo(n):
+    __tmp0__ = n - 1
+    if __tmp0__ <= 1:
+        t = __tmp0__
+    return t
+        """.strip()
+
+        tree = ast.parse(source).body[0]
+        mapper = mappers.remove_trivial_temporaries_m(tree)
+        self.assertEqual(source, ast.unparse(mappers.map_scope(tree, mapper)))
+
     def test_remove_trivial_temporaries_m_tail_call(self):
         source = """
 def sum(lst, acc):
@@ -118,11 +131,44 @@ def sum(lst, acc):
         result = ast.unparse(tree)
         self.assertEqual(result, want)
 
+    def test_reuse_temporaries_m(self):
+        source = """
+def foo(n):
+    __tmp0__ = bar(n)
+    a = __tmp0__ + 1
+    __tmp1__ = bar(a)
+    __tmp2__ = bar(n)
+    b = __tmp1__ + __tmp2__
+    __tmp3__ = n
+    if __tmp3__:
+        __tmp3__ = bar(b)
+    return __tmp3__
+        """.strip()
+
+        want = """
+def foo(n):
+    __tmp0__ = bar(n)
+    a = __tmp0__ + 1
+    __tmp0__ = bar(a)
+    __tmp2__ = bar(n)
+    b = __tmp0__ + __tmp2__
+    __tmp0__ = n
+    if __tmp0__:
+        __tmp0__ = bar(b)
+    return __tmp0__
+        """.strip()
+        tree = ast.parse(source).body[0]
+        mapper = mappers.reuse_temporaries_m(tree, ["bar"])
+        tree = mappers.map_scope(tree, mapper)
+        tree = ast.fix_missing_locations(tree)
+        result = ast.unparse(tree)
+        self.assertEqual(result, want)
+
     def test_for_to_while_m(self):
         source = """
-def bar():
+def bar(items):
     pre = 1
-    for i in range(10):
+    for i in items:
         print(pre, i)
         if i == 5:
             break
@@ -133,9 +179,9 @@ def bar():
         """.strip()
 
         want = """
-def bar():
+def bar(items):
     pre = 1
-    __tmp0__ = iter(range(10))
+    __tmp0__ = iter(items)
     __tmp1__ = True
     while __tmp1__:
         try:
@@ -156,6 +202,126 @@ def bar():
         result = map_function(source, mapper)
         self.assertEqual(result, want)
 
+    def test_for_to_while_m_else_calls(self):
+        source = """
+def bar(items):
+    for i in range(items):
+        if i == 5:
+            break
+    else:
+        foo(items)
+    return items
+        """.strip()
+
+        want = """
+def bar(items):
+    __tmp0__ = 0
+    __tmp1__ = items
+    __tmp2__ = True
+    while __tmp2__:
+        __tmp2__ = __tmp0__ < __tmp1__
+        if not __tmp2__:
+            continue
+        i = __tmp0__
+        __tmp0__ = __tmp0__ + 1
+        if i == 5:
+            break
+    if not __tmp2__:
+        foo(items)
+    return items
+        """.strip()
+
+        mapper = mappers.for_to_while_m(utils.dunder_names(), {"foo"})
+        result = map_function(source, mapper)
+        self.assertEqual(result, want)
+
+    def test_fns_keep_yield_free_constructs(self):
+        source = """
+def bar(xs):
+    for x in xs:
+        total = x and x + 1
+    while total:
+        total = foo(total) or baz()
+    return total
+        """.strip()
+
+        want = """
+def bar(xs):
+    for x in xs:
+        total = x and x + 1
+    while total:
+        __tmp0__ = foo(total)
+        if not __tmp0__:
+            __tmp0__ = baz()
+        total = __tmp0__
+    return total
+        """.strip()
+
+        fns, name_iter = {"foo"}, utils.dunder_names()
+        for mapper in (mappers.for_to_while_m(name_iter, fns),
+                       mappers.promote_while_cond_m(name_iter, fns),
+                       mappers.bool_exps_to_if_m(name_iter, fns)):
+            source = map_function(source, mapper)
+        self.assertEqual(want, source)
+
+    def test_for_range_to_while_m(self):
+        source = """
+def bar(n):
+    for i in range(n, 0, -2):
+        if i == 5:
+            continue
+        print(i)
+    else:
+        print('else')
+        """.strip()
+
+        want = """
+def bar(n):
+    __tmp0__ = n
+    __tmp1__ = 0
+    __tmp2__ = True
+    while __tmp2__:
+        __tmp2__ = __tmp0__ > __tmp1__
+        if not __tmp2__:
+            continue
+        i = __tmp0__
+        __tmp0__ = __tmp0__ - 2
+        if i == 5:
+            continue
+        print(i)
+    else:
+        print('else')
+        """.strip()
+
+        mapper = mappers.for_to_while_m(utils.dunder_names())
+        result = map_function(source, mapper)
+        self.assertEqual(result, want)
+
+    def test_for_sequence_to_while_m(self):
+        source = """
+def bar(items):
+    for a, b in sorted(items):
+        print(a, b)
+        """.strip()
+
+        want = """
+def bar(items):
+    __tmp0__ = sorted(items)
+    __tmp1__ = 0
+    __tmp2__ = True
+    while __tmp2__:
+        __tmp2__ = __tmp1__ < len(__tmp0__)
+        if not __tmp2__:
+            continue
+        a, b = __tmp0__[__tmp1__]
+        __tmp1__ = __tmp1__ + 1
+        print(a, b)
+        """.strip()
+
+        mapper = mappers.for_to_while_m(utils.dunder_names())
+        result = map_function(source, mapper)
+        self.assertEqual(result, want)
+
     def test_promote_while_cond_m(self):
         source = """
 def bar():
@@ -185,6 +351,78 @@ def bar():
         result = map_function(source, mapper)
         self.assertEqual(result, want)
 
+    def test_map_scope_keeps_unchanged_nodes(self):
+        source = """
+def bar(n):
+    while n:
+        n = n - 1
+    if n:
+        x = foo(n) + 1
+    return n
+        """.strip()
+
+        tree = ast.parse(source).body[0]
+        mapper = mappers.promote_to_temporary_m({"foo"}, utils.dunder_names())
+        new_tree = mappers.map_scope(tree, mapper)
+        self.assertIsNot(tree, new_tree)
+        self.assertIs(tree.body[0], new_tree.body[0])
+        self.assertIs(tree.body[2], new_tree.body[2])
+        self.assertIsNot(tree.body[1], new_tree.body[1])
+
+        unchanged = mappers.map_scope(tree, lambda stmt: [stmt])
+        self.assertIs(tree, unchanged)
+
+    def test_fuse_m(self):
+        source = """
+def bar(xs):
+    for x in xs:
+        total = foo(x) and foo(total)
+    return total
+        """.strip()
+
+        fns = {"foo"}
+        name_iter = utils.dunder_names()
+        passes = [mappers.for_to_while_m(name_iter, fns),
+                  mappers.bool_exps_to_if_m(name_iter, fns),
+                  mappers.promote_to_temporary_m(fns, name_iter)]
+        separate = source
+        for mapper in passes:
+            separate = map_function(separate, mapper)
+
+        name_iter = utils.dunder_names()
+        fused = mappers.fuse_m(mappers.for_to_while_m(name_iter, fns),
+                               mappers.bool_exps_to_if_m(name_iter, fns),
+                               mappers.promote_to_temporary_m(fns, name_iter))
+        self.assertEqual(separate, map_function(source, fused))
+
+    def test_else_to_if_m(self):
+        source = """
+def bar(n):
+    if n == 0:
+        return 0
+    elif n == 1:
+        x = foo(n)
+    else:
+        x = baz(n)
+    return x
+        """.strip()
+
+        want = """
+def bar(n):
+    __tmp0__ = n == 0
+    if __tmp0__:
+        return 0
+    if not __tmp0__:
+        if n == 1:
+            x = foo(n)
+        else:
+            x = baz(n)
+    return x
+        """.strip()
+
+        mapper = mappers.else_to_if_m(utils.dunder_names(), {"foo"})
+        self.assertEqual(want, map_function(source, mapper))
+
     def test_bool_exps_to_if_m(self):
         source = """
 def bar():
@@ -218,6 +456,42 @@ def bar():
         result = map_function(source, mapper)
         self.assertEqual(result, want)
 
+    def test_lower_yields_m(self):
+        source = """
+def bar(tree):
+    if tree is None:
+        return
+    yield tree
+    n = yield from bar(tree.left)
+    n += yield from tree.values
+    return (yield n)
+        """.strip()
+
+        want = """
+def bar(tree):
+    if tree is None:
+        return None
+    __tmp0__ = __yield(tree)
+    n = bar(tree.left)
+    for __tmp1__ in tree.values:
+        __tmp2__ = __yield(__tmp1__)
+    n += None
+    return __yield(n)
+        """.strip()
+
+        mapper = mappers.lower_yields_m(utils.dunder_names(), {"bar"})
+        self.assertEqual(want, map_function(source, mapper))
+
+    def test_lower_yields_m_rejects_nested_yields(self):
+        source = """
+def bar(n):
+    print((yield n))
+        """.strip()
+
+        mapper = mappers.lower_yields_m(utils.dunder_names(), {"bar"})
+        with self.assertRaises(ValueError):
+            map_function(source, mapper)
+
     def test_lift_to_frame_m(self):
         source = """
 def bar(arg1, arg2):
@@ -241,6 +515,59 @@ def bar(arg1, arg2):
         result = map_function(source, mapper)
         self.assertEqual(result, want)
 
+    def test_lower_try_m(self):
+        source = """
+def bar(n):
+    try:
+        x = foo(n)
+    except ValueError as e:
+        x = foo(e)
+        raise
+    except KeyError:
+        x = 0
+    else:
+        x = baz(x)
+    return x
+        """.strip()
+
+        want = """
+def bar(n):
+    __tmp0__ = 0
+    try:
+        x = foo(n)
+    except ValueError as __exc:
+        __tmp0__ = 1
+        __tmp1__ = __exc
+    except KeyError as __exc:
+        __tmp0__ = 2
+        __tmp1__ = __exc
+    if __tmp0__ == 0:
+        x = baz(x)
+    if __tmp0__ == 1:
+        e = __tmp1__
+        x = foo(e)
+        raise __tmp1__
+    if __tmp0__ == 2:
+        x = 0
+    return x
+        """.strip()
+
+        mapper = mappers.lower_try_m(utils.dunder_names(), {"foo"})
+        self.assertEqual(want, map_function(source, mapper))
+
+    def test_lower_try_m_rejects_calls_in_finally(self):
+        source = """
+def bar(n):
+    try:
+        x = foo(n)
+    finally:
+        foo(0)
+        """.strip()
+
+        mapper = mappers.lower_try_m(utils.dunder_names(), {"foo"})
+        with self.assertRaises(ValueError):
+            map_function(source, mapper)
+
 
 if __name__ == '__main__':
     unittest.main()
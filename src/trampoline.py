@@ -19,31 +19,76 @@ import itertools
 
 import fiber
 import jumps
+import utils
 
 
 @dataclass
 class StackFrame:
-    frame: Dict[str, Any]
+    frame: Union[Dict[str, Any], List[Any]]
     fn: Any
-    ret_variable: Union[str, None]
+    # Counts the resumes of profiled fibers.
+    profile: Any = None
 
 
-def pos_with_defaults(args: ast.arguments):
-    num_non_defaults = len(args.posonlyargs) + \
-        len(args.args) - len(args.defaults)
-    args_iter = itertools.chain(iter(args.posonlyargs), iter(args.args))
-    for _ in range(num_non_defaults):
-        yield next(args_iter), None
-    for default in args.defaults:
-        yield next(args_iter), default
+def resume_generator(generator, value):
+    """Resumes a fiber compiled with the generator backend, whose frame is its
+    generator, like the function of a fiber with a heap frame: sends the
+    return value of its call and returns the op it yields, or a RetOp when it
+    returns."""
+    try:
+        return generator.send(value)
+    except StopIteration as stop:
+        return fiber.RetOp(value=stop.value)
 
 
-def bind_frame(positional_args, keyword_args, fn_tree: ast.FunctionDef):
+def throw_generator(generator, exc):
+    """Like resume_generator, but throws the exception that its call raised
+    into the generator (see unwind)."""
+    try:
+        op = generator.throw(exc)
+    except StopIteration as stop:
+        return fiber.RetOp(value=stop.value)
+    if isinstance(op, fiber.CallOp):
+        op.continuation = resume_generator
+    return op
+
+
+def new_frame(metadata: fiber.FiberMetadata, args, kwargs):
+    """Returns the frame of a new call to the fiber and the function that
+    resumes it."""
+    if metadata.generator:
+        frame = bind_frame(args, kwargs, metadata.fn_def, has_pc=False,
+                           defaults=metadata.defaults)
+        return metadata.fn(frame), resume_generator
+    return bind_frame(args, kwargs, metadata.fn_def, metadata.slots, metadata.has_pc,
+                      metadata.group_id, metadata.defaults), metadata.fn
+
+
+def literal_defaults(fn_args: ast.arguments):
+    """Returns the values of parameter defaults that are literals, by name."""
+    positional = [*fn_args.posonlyargs, *fn_args.args]
+    return {arg.arg: ast.literal_eval(default) for arg, default in
+            [*zip(reversed(positional), reversed(fn_args.defaults)),
+             *zip(fn_args.kwonlyargs, fn_args.kw_defaults)] if default is not None}
+
+
+def bind_frame(positional_args, keyword_args, fn_tree: ast.FunctionDef, slots=None, has_pc=True,
+               group_id=None, defaults=None):
+    """Binds the call arguments to a new frame for fn_tree. Parameters that
+    aren't passed get their value in defaults (see FiberMetadata.defaults), or
+    by default their literal default. If slots is given, returns a list frame
+    with each local stored at its slot index (see bind_slots). If group_id is
+    given, the frame selects that function of a merged group."""
+    if defaults is None:
+        defaults = literal_defaults(fn_tree.args)
+    if slots is not None:
+        return bind_slots(positional_args, keyword_args, fn_tree, slots, has_pc, group_id,
+                          defaults)
     frame = {}
     # Reverse the list of args because we pop args from the front of the
     # original list, which is the back of the reversed list.
     positional_args, fn_args = list(reversed(positional_args)), fn_tree.args
-    for needed_arg, default in pos_with_defaults(fn_args):
+    for needed_arg in itertools.chain(fn_args.posonlyargs, fn_args.args):
         name: str = needed_arg.arg
         if positional_args:  # If we can still take args
             frame[name] = positional_args.pop()
@@ -57,9 +102,9 @@ def bind_frame(positional_args, keyword_args, fn_tree: ast.FunctionDef):
             del keyword_args[name]
             continue
 
-        elif not default:
+        elif name not in defaults:
             raise TypeError(f"{fn_tree.name} had too few positional arguments")
-        frame[name] = default
+        frame[name] = defaults[name]
 
     if fn_args.vararg:
         # Unreverse the list as from the beginning.
@@ -76,43 +121,450 @@ def bind_frame(positional_args, keyword_args, fn_tree: ast.FunctionDef):
                 f"{fn_tree.name} got multiple values for argument '{kwarg}'")
         frame[kwarg] = keyword_args[kwarg]
 
-    for kwarg, default in zip(fn_args.kwonlyargs, fn_args.kw_defaults):
-        if default is None and kwarg.arg not in frame:
+    for kwarg in fn_args.kwonlyargs:
+        if kwarg.arg in frame:
+            continue
+        if kwarg.arg not in defaults:
+            raise TypeError(
+                f"{fn_tree.name} missing required keyword only argument '{kwarg.arg}'")
+        frame[kwarg.arg] = defaults[kwarg.arg]
+
+    if has_pc:
+        frame[jumps.PC_LOCAL_NAME] = 0
+    if group_id is not None:
+        frame[fiber.GROUP_ID_NAME] = group_id
+    return frame
+
+
+def bind_slots(positional_args, keyword_args, fn_tree: ast.FunctionDef, slots, has_pc=True,
+               group_id=None, defaults=None):
+    """Like bind_frame, but binds the arguments directly into a list frame
+    with each local stored at its slot index."""
+    if defaults is None:
+        defaults = literal_defaults(fn_tree.args)
+    frame = [None] * len(slots)
+    fn_args = fn_tree.args
+    params = [*fn_args.posonlyargs, *fn_args.args]
+    bound = min(len(positional_args), len(params))
+    for param, value in zip(params, positional_args):
+        frame[slots[param.arg]] = value
+    for param in params[bound:]:
+        name = param.arg
+        if name in keyword_args:
+            if param in fn_args.posonlyargs:
+                raise TypeError(
+                    f"{fn_tree.name}: got positional only argument {name} as a keyword")
+            frame[slots[name]] = keyword_args[name]
+        elif name not in defaults:
+            raise TypeError(f"{fn_tree.name} had too few positional arguments")
+        else:
+            frame[slots[name]] = defaults[name]
+
+    if fn_args.vararg:
+        frame[slots[fn_args.vararg.arg]] = list(positional_args[bound:])
+
+    if keyword_args:
+        offset = len(fn_args.posonlyargs)
+        positional = {param.arg: offset + i for i, param in enumerate(fn_args.args)}
+        kwonly = set(arg.arg for arg in fn_args.kwonlyargs)
+        for kwarg, value in keyword_args.items():
+            if kwarg in positional:
+                if positional[kwarg] < bound:
+                    raise TypeError(
+                        f"{fn_tree.name} got multiple values for argument '{kwarg}'")
+                continue  # Bound above.
+            if kwarg not in kwonly:
+                raise TypeError(
+                    f"{fn_tree.name} got invalid keyword argument '{kwarg}'")
+            frame[slots[kwarg]] = value
+
+    for kwarg in fn_args.kwonlyargs:
+        if kwarg.arg in keyword_args:
+            continue
+        if kwarg.arg not in defaults:
             raise TypeError(
                 f"{fn_tree.name} missing required keyword only argument '{kwarg.arg}'")
-        if default is not None and kwarg.arg not in frame:
-            frame[kwarg.arg] = ast.literal_eval(default)
+        frame[slots[kwarg.arg]] = defaults[kwarg.arg]
 
-    frame[jumps.PC_LOCAL_NAME] = 0
+    if has_pc:
+        frame[slots[jumps.PC_LOCAL_NAME]] = 0
+    if group_id is not None:
+        frame[slots[fiber.GROUP_ID_NAME]] = group_id
     return frame
 
 
-def run(fn, args=None, kwargs=None, *, __max_stack_size=float('inf')):
+def run(fn, args=None, kwargs=None, *, native=True, __max_stack_size=float('inf')):
+    """Runs the fiber fn on the trampoline; if native is True and the fiber
+    has a native version (see fiber's native_depth), runs that instead. If the
+    fiber is streaming, returns an iterator over the values it yields."""
     if args is None:
         args = []
     if kwargs is None:
         kwargs = {}
 
-    frame = bind_frame(args, kwargs, fiber.FIBER_FN_COMPILED_MAP[fn].fn_def)
-    stack: List[StackFrame] = [StackFrame(frame, fn, None)]
+    metadata = fiber.FIBER_FN_COMPILED_MAP[fn]
+    if metadata.leaf:
+        return fn(*args, **kwargs)
+    if native and metadata.native is not None:
+        return metadata.native(*args, **kwargs)
+    if metadata.generator:
+        return run_generator(fn, args, kwargs, __max_stack_size=__max_stack_size)
+    steps = run_stack(metadata, args, kwargs, __max_stack_size)
+    if metadata.streaming:
+        return steps
+    return drain(metadata, steps)
+
+
+def drain(metadata: fiber.FiberMetadata, steps):
+    """Returns the return value of the run_stack steps of a fiber that is not
+    streaming."""
+    try:
+        next(steps)
+    except StopIteration as stop:
+        return stop.value
+    steps.close()
+    raise TypeError(f"{metadata.fn_def.name} called a streaming fiber without yield from")
+
+
+def run_stack(metadata: fiber.FiberMetadata, args, kwargs, max_stack_size, stack=None):
+    """Runs the fiber of metadata on the trampoline, yielding the values that
+    streaming fibers yield (see fiber.YieldOp) and sending back the values
+    sent to it. Returns the fiber's return value. If stack is given, resumes
+    its top frame instead of calling the fiber."""
+    # The fiber that returned op if it was entered without a frame (see
+    # FiberMetadata.entry), else None.
+    entered = None
+    if stack is not None:
+        pass
+    elif metadata.entry is not None:
+        stack = []
+        op, entered = metadata.entry(*args, **kwargs), metadata
+    else:
+        stack = [StackFrame(*new_frame(metadata, args, kwargs), metadata.profile)]
+    # The return value of the last call, which is passed to the resumed fiber.
+    value = None
     while True:
-        assert len(stack) <= __max_stack_size
-        top = stack[-1]
-        op = top.fn(top.frame)
+        assert len(stack) <= max_stack_size
+        if entered is None:
+            top = stack[-1]
+            if top.profile is not None:
+                top.profile.record(top.frame)
+            try:
+                op = top.fn(top.frame, value)
+            except BaseException as exc:
+                stack.pop()
+                value = unwind(stack, exc)
+                continue
+        if isinstance(op, fiber.RetOp):
+            if entered is None:
+                stack.pop()
+            entered = None
+            if not stack:
+                return op.value
+            value = op.value
+            continue
         if isinstance(op, fiber.CallOp):
-            metadata = fiber.FIBER_FN_NAME_MAP[op.func]
-            top.ret_variable = op.ret_variable
-            frame = bind_frame(op.args, op.kwargs, metadata.fn_def)
-            stack.append(StackFrame(frame, metadata.fn, None))
-        elif isinstance(op, fiber.TailCallOp):
+            if entered is not None:
+                # The entered fiber calls another fiber, so it created its frame.
+                stack.append(StackFrame(op.frame, entered.fn, entered.profile))
+            elif op.continuation is not None:
+                stack[-1].fn = op.continuation
+        elif isinstance(op, fiber.YieldOp):
+            if op.continuation is not None:
+                stack[-1].fn = op.continuation
+            value = yield op.value
+            continue
+        elif entered is None:
             stack.pop()  # Tail call, so we can discard the frame.
-            metadata = fiber.FIBER_FN_NAME_MAP[op.func]
-            frame = bind_frame(op.args, op.kwargs, metadata.fn_def)
-            stack.append(StackFrame(frame, metadata.fn, None))
-        elif isinstance(op, fiber.RetOp):
+        entered = None
+        metadata = fiber.FIBER_FN_NAME_MAP[op.func]
+        try:
+            if metadata.leaf:
+                value = metadata.fn(*op.args, **op.kwargs)
+                if not stack:
+                    return value
+                continue
+            if metadata.entry is not None:
+                op, entered = metadata.entry(*op.args, **op.kwargs), metadata
+                continue
+            frame, fn = new_frame(metadata, op.args, op.kwargs)
+        except BaseException as exc:
+            # The caller (if any) is the top frame.
+            value = unwind(stack, exc)
+            continue
+        stack.append(StackFrame(frame, fn, metadata.profile))
+        value = None
+
+
+def run_generator(fn, args=None, kwargs=None, *, __max_stack_size=float('inf')):
+    """Runs a fiber compiled with the generator backend. The stack holds
+    suspended generators; the return value of a call is sent to its caller.
+    Once a fiber calls a fiber with a heap frame, the rest of the run is
+    handed to run_stack."""
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+
+    top = metadata = fiber.FIBER_FN_COMPILED_MAP[fn]
+    stack = [fn(bind_frame(args, kwargs, metadata.fn_def, has_pc=False,
+                           defaults=metadata.defaults))]
+    # The exception that the last call raised, which is thrown into its caller.
+    value, exc = None, None
+    while True:
+        assert len(stack) <= __max_stack_size
+        thrown, exc = exc, None
+        try:
+            op = stack[-1].send(value) if thrown is None else stack[-1].throw(thrown)
+        except StopIteration as stop:
             stack.pop()
+            if not stack:
+                return stop.value
+            value = stop.value
+            continue
+        except BaseException as raised:
+            stack.pop()
+            if not stack:
+                raise
+            exc = raised
+            continue
+        metadata = fiber.FIBER_FN_NAME_MAP[op.func]
+        try:
+            if metadata.leaf:
+                value = metadata.fn(*op.args, **op.kwargs)
+            else:
+                frame, resume = new_frame(metadata, op.args, op.kwargs)
+        except BaseException as raised:
+            exc = raised
+        if isinstance(op, fiber.TailCallOp):
+            stack.pop().close()  # Tail call, so we can discard the generator.
+        if exc is not None and not stack:
+            raise exc
+        if exc is not None or metadata.leaf:
+            if not stack:
+                return value
+            continue
+        if resume is not resume_generator:
+            frames = [StackFrame(generator, resume_generator) for generator in stack]
+            frames.append(StackFrame(frame, resume, metadata.profile))
+            return drain(top, run_stack(None, None, None, __max_stack_size, frames))
+        stack.append(frame)
+        value = None
+
+
+def throw(fn, frame):
+    """If the pending call of the frame of the compiled fiber fn is in a try
+    statement, sets the pc to the throw pc of the innermost one, so that
+    resuming the frame with an exception raises it there, and returns True."""
+    metadata = fiber.FIBER_FN_COMPILED_MAP.get(fn)
+    if metadata is None or metadata.handlers is None:
+        return False
+    key = fiber.frame_key(jumps.PC_LOCAL_NAME, metadata.slots)
+    pc = metadata.handlers.get(frame[key])
+    if pc is None:
+        return False
+    frame[key] = pc
+    return True
+
+
+def unwind(stack: List[StackFrame], exc: BaseException):
+    """Pops the frames that don't handle exc (see throw), and returns exc to
+    resume the top frame with. Raises exc if no frame handles it. Generators
+    may handle any exception, so it is thrown into them."""
+    while stack:
+        if stack[-1].fn is resume_generator:
+            stack[-1].fn = throw_generator
+            return exc
+        if throw(stack[-1].fn, stack[-1].frame):
+            return exc
+        stack.pop()
+    raise exc
+
+
+def simple_signature(fn_def: ast.FunctionDef):
+    """Returns whether the fiber only takes positional parameters without
+    defaults, so that a call with exactly that many positional arguments
+    binds them in order."""
+    fn_args = fn_def.args
+    return not (fn_args.vararg or fn_args.kwarg or fn_args.kwonlyargs or fn_args.defaults)
+
+
+def frame_literal(metadata: fiber.FiberMetadata):
+    """Returns the source of a frame display for a call with exactly the
+    positional parameters of a fiber with a simple signature, which are in
+    a local called args."""
+    values = {name: f"args[{i}]" for i, name in enumerate(utils.arg_names(metadata.fn_def))}
+    if metadata.has_pc:
+        values[jumps.PC_LOCAL_NAME] = "0"
+    if metadata.group_id is not None:
+        values[fiber.GROUP_ID_NAME] = repr(metadata.group_id)
+    if metadata.slots is None:
+        return "{" + ", ".join(f"{name!r}: {value}" for name, value in values.items()) + "}"
+    slots = ["None"] * len(metadata.slots)
+    for name, value in values.items():
+        slots[metadata.slots[name]] = value
+    return "[" + ", ".join(slots) + "]"
+
+
+def binder_source(index: int, metadata: fiber.FiberMetadata):
+    """Returns the source of a function that binds a call's arguments to a new
+    frame for the fiber."""
+    lines = [f"def __bind_{index}(args, kwargs):"]
+    if simple_signature(metadata.fn_def):
+        count = len(list(utils.arg_names(metadata.fn_def)))
+        lines += [f"    if not kwargs and len(args) == {count}:",
+                  f"        return {frame_literal(metadata)}"]
+    lines.append(f"    return bind_frame(args, kwargs, METADATA[{index}].fn_def, "
+                 f"METADATA[{index}].slots, METADATA[{index}].has_pc, "
+                 f"METADATA[{index}].group_id, METADATA[{index}].defaults)")
+    return "\n".join(lines)
+
+
+def callee(name: str):
+    """Returns the (function, binder, entry, profile) tuple for calls to the
+    fiber; the binder is None for leaves, which are called directly, the
+    entry is None unless the fiber has lazy frames and the profile is None
+    unless the fiber is being profiled."""
+    metadata = fiber.FIBER_FN_NAME_MAP[name]
+    if metadata.leaf:
+        return metadata.fn, None, None, None
+    if metadata.generator:
+        return resume_generator, lambda args, kwargs: new_frame(
+            metadata, args, kwargs)[0], None, None
+    return metadata.fn, lambda args, kwargs: new_frame(
+        metadata, args, kwargs)[0], metadata.entry, metadata.profile
+
+
+DRIVER_TEMPLATE = """
+def __fiber_driver(fn, args=None, kwargs=None):
+    metadata = FIBER_FN_COMPILED_MAP[fn]
+    if metadata.leaf or metadata.generator or metadata.native is not None or \
+            metadata.streaming:
+        return run(fn, args, kwargs{run_limit})
+    stack = []
+    entered = None
+    if metadata.entry is not None:
+        op = metadata.entry(*(args or []), **(kwargs or {{}}))
+        entered = metadata.fn, metadata.profile
+    else:
+        top = [*new_frame(metadata, list(args or []), dict(kwargs or {{}})), metadata.profile]
+        stack.append(top)
+    value = None
+    while True:
+        if entered is None:
+            if top[2] is not None:
+                top[2].record(top[0])
+            try:
+                op = top[1](top[0], value)
+            except BaseException as exc:
+                stack.pop()
+                top, value = unwind_entries(stack, exc), exc
+                continue
+        cls = type(op)
+        if cls is RetOp:
+            if entered is None:
+                stack.pop()
+            entered = None
             if not stack:
                 return op.value
             top = stack[-1]
-            assert top.ret_variable is not None
-            top.frame[top.ret_variable] = op.value
+            value = op.value
+            continue
+        if cls is YieldOp:
+            raise TypeError(f"{{metadata.fn_def.name}} called a streaming fiber without yield from")
+        fn, bind, entry, profile = CALLEES.get(op.func) or callee(op.func)
+        if cls is CallOp:
+            if entered is not None:
+                top = [op.frame, *entered]
+                stack.append(top){entered_check}
+                entered = None
+            elif op.continuation is not None:
+                top[1] = op.continuation
+        elif entered is None:
+            stack.pop()
+        else:
+            entered = None
+        try:
+            if bind is None:
+                value = fn(*op.args, **op.kwargs)
+                if not stack:
+                    return value
+                top = stack[-1]
+                continue
+            if entry is not None:
+                op, entered = entry(*op.args, **op.kwargs), (fn, profile)
+                continue
+            frame = bind(op.args, op.kwargs)
+        except BaseException as exc:
+            top, value = unwind_entries(stack, exc), exc
+            continue
+        top = [frame, fn, profile]
+        stack.append(top){check}
+        value = None
+"""
+
+
+def unwind_entries(stack: List[List[Any]], exc: BaseException):
+    """Like unwind, for the stack of a compiled driver, whose entries are
+    [frame, fn, profile] lists. Returns the new top entry."""
+    while stack:
+        if stack[-1][1] is resume_generator:
+            stack[-1][1] = throw_generator
+            return stack[-1]
+        if throw(stack[-1][1], stack[-1][0]):
+            return stack[-1]
+        stack.pop()
+    raise exc
+
+
+def compile_driver(max_stack_size=None):
+    """Compiles a driver that runs fibers like run, specialized to the fibers
+    that are defined when it is compiled.
+
+    Each known callee gets a binder that builds its frame directly when a
+    call passes exactly its positional parameters, the dispatch uses one dict
+    lookup per call, and the stack size check is only compiled in if
+    max_stack_size is given. Fibers defined later are looked up and bound
+    generically. Like run, the driver records the resumes of fibers that are
+    being profiled, and raises TypeError if a fiber calls a streaming fiber
+    without yield from.
+
+    >>> driver = compile_driver()
+    >>> driver(fib, [10])  # doctest: +SKIP
+    55
+    """
+    names = sorted(fiber.FIBER_FN_NAME_MAP)
+    metadata = [fiber.FIBER_FN_NAME_MAP[name] for name in names]
+    binders = [binder_source(i, m) for i, m in enumerate(metadata)
+               if not m.leaf and not m.generator]
+    # Fibers that are being profiled are looked up on each call, so that
+    # calls after the recompile run the recompiled function. Generators are
+    # bound generically, as binding also creates the generator.
+    callees = ", ".join(
+        f"{name!r}: callee({name!r})" if m.generator else
+        f"{name!r}: (METADATA[{i}].fn, {'None' if m.leaf else f'__bind_{i}'}, "
+        f"METADATA[{i}].entry, None)"
+        for i, (name, m) in enumerate(zip(names, metadata)) if m.profile is None)
+    check, entered_check, run_limit = "", "", ""
+    if max_stack_size is not None:
+        check = f"\n        assert len(stack) <= {max_stack_size!r}"
+        entered_check = f"\n                assert len(stack) <= {max_stack_size!r}"
+        run_limit = f", __max_stack_size={max_stack_size!r}"
+    source = "\n\n".join([*binders, f"CALLEES = {{{callees}}}",
+                          DRIVER_TEMPLATE.format(check=check, entered_check=entered_check,
+                                                 run_limit=run_limit).strip()])
+
+    env = {
+        "METADATA": metadata,
+        "FIBER_FN_COMPILED_MAP": fiber.FIBER_FN_COMPILED_MAP,
+        "bind_frame": bind_frame,
+        "new_frame": new_frame,
+        "callee": callee,
+        "unwind_entries": unwind_entries,
+        "run": run,
+        **fiber.OP_MAP,
+    }
+    exec(compile(source, "<fiber driver>", "exec"), env)
+    driver = env["__fiber_driver"]
+    driver.__drivercode__ = source
+    return driver
@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ast
+import re
 import sys
+import tracemalloc
 import unittest
 
 import fiber
@@ -20,11 +23,12 @@ import trampoline
 
 
 class TestTrampoline(unittest.TestCase):
+    options = {}
 
     def test_fib(self):
         cache = {}
 
-        @fiber.fiber(locals=locals())
+        @fiber.fiber(locals=locals(), **self.options)
         def fib(n):
             if n in cache:
                 return cache[n]
@@ -38,7 +42,7 @@ class TestTrampoline(unittest.TestCase):
         self.assertLess(0, trampoline.run(fib, [1002], {}))
 
     def test_sum(self):
-        @fiber.fiber(locals=locals())
+        @fiber.fiber(locals=locals(), **self.options)
         def sum(lst, acc):
             if not lst:
                 return acc
@@ -48,6 +52,177 @@ class TestTrampoline(unittest.TestCase):
         got = trampoline.run(sum, [list(range(1, n+1)), 0], __max_stack_size=1)
         self.assertEqual(want, got)
 
+    def test_fib_slots(self):
+        @fiber.fiber(locals=locals(), **self.options, slots=True)
+        def fib(n):
+            if n <= 1:
+                return n
+            return fib(n-1) + fib(n=n-2)
+        self.assertEqual(55, trampoline.run(fib, [10], {}))
+        self.assertEqual(55, trampoline.run(fib, [], {"n": 10}))
+
+    def test_pop_balloons_slots(self):
+        def pop_balloons(balloons):
+            balloons = [1] + balloons + [1]
+
+            @fiber.fiber(locals=locals(), **self.options, slots=True)
+            def pop_balloons__helper(i, j):
+                if i == j:
+                    return 0
+                max_profit = float('-inf')
+                for k in range(i, j):
+                    profit = pop_balloons__helper(i, k)
+                    profit += pop_balloons__helper(k+1, j)
+                    profit += balloons[i-1] * balloons[k] * balloons[j]
+                    max_profit = max(max_profit, profit)
+                return max_profit
+
+            return trampoline.run(pop_balloons__helper, [1, len(balloons) - 1])
+        self.assertEqual(175, pop_balloons([4, 5, 7]))
+
+    def test_pop_balloons_fast_locals(self):
+        def pop_balloons(balloons, slots):
+            balloons = [1] + balloons + [1]
+
+            @fiber.fiber(locals=locals(), **self.options, fast_locals=True, slots=slots)
+            def pop_balloons__helper(i, j):
+                if i == j:
+                    return 0
+                max_profit = float('-inf')
+                for k in range(i, j):
+                    profit = pop_balloons__helper(i, k)
+                    profit += pop_balloons__helper(k+1, j)
+                    profit += balloons[i-1] * balloons[k] * balloons[j]
+                    max_profit = max(max_profit, profit)
+                return max_profit
+
+            return trampoline.run(pop_balloons__helper, [1, len(balloons) - 1])
+        self.assertEqual(175, pop_balloons([4, 5, 7], slots=False))
+        self.assertEqual(175, pop_balloons([4, 5, 7], slots=True))
+
+    def test_tree_recursion_fast_locals(self):
+        from collections import namedtuple
+        Tree = namedtuple("Tree", ["left", "right"])
+
+        @fiber.fiber(locals=locals(), **self.options, fast_locals=True)
+        def all_zeroes(tree):
+            if tree == 0:
+                return True
+            if not isinstance(tree, Tree):
+                return False
+            return all_zeroes(tree.left) and all_zeroes(tree.right)
+
+        zeroes = Tree(Tree(0, 0), Tree(Tree(Tree(0, 0), 0), Tree(0, 0)))
+        one = Tree(Tree(0, 0), Tree(Tree(Tree(1, 0), 0), Tree(0, 0)))
+        self.assertTrue(trampoline.run(all_zeroes, [zeroes]))
+        self.assertFalse(trampoline.run(all_zeroes, [one]))
+
+    def test_self_tail_call_after_call(self):
+        @fiber.fiber(locals=locals(), **self.options)
+        def count(n, acc=0):
+            if n == 0:
+                return acc
+            x = count(0, acc=n)
+            return count(n - 1, acc + x)
+        n = sys.getrecursionlimit() + 1
+        got = trampoline.run(count, [n], __max_stack_size=2)
+        self.assertEqual(n * (n + 1) // 2, got)
+
+    def test_native_loops_around_calls(self):
+        @fiber.fiber(locals=locals(), **self.options)
+        def weight(n):
+            if n == 0:
+                return 0
+            total = 0
+            for i in range(n):
+                total += i if i % 2 and i > 1 else 1
+            rest = weight(n - 1)
+            for j in range(2):
+                total += j
+            return total + rest + i
+        want = 0
+        for n in range(1, 6):
+            total = sum(i if i % 2 and i > 1 else 1 for i in range(n)) + 1
+            want += total + n - 1
+        self.assertEqual(want, trampoline.run(weight, [5]))
+
+    def test_sequence_loop_with_calls(self):
+        @fiber.fiber(locals=locals(), **self.options)
+        def depth(tree):
+            best = 0
+            for name, child in list(tree.items()):
+                best = max(best, depth(child) + len(name))
+            return best
+        tree = {"a": {"bc": {}, "d": {"efg": {}}}, "hi": {}}
+        self.assertEqual(5, trampoline.run(depth, [tree]))
+
+    def test_non_literal_defaults(self):
+        limit, pad = 3, [0, 0]
+
+        def total(n, scale=limit + 1, *, offset=len(pad)):
+            if n == 0:
+                return offset
+            return total(n - 1) + n * scale
+
+        want = [total(4), total(4, 2), total(4, offset=5)]
+        fn = fiber.fiber(locals=locals(), **self.options)(total)
+        self.assertEqual({"scale": 4, "offset": 2}, fiber.FIBER_FN_COMPILED_MAP[fn].defaults)
+        self.assertEqual(want, [trampoline.run(fn, [4]), trampoline.run(fn, [4, 2]),
+                                trampoline.run(fn, [4], {"offset": 5})])
+        self.assertEqual(want[0], trampoline.compile_driver()(fn, [4]))
+
+    def test_loop_else_calls(self):
+        def first_multiples(xs, k):
+            found = []
+            for x in range(len(xs)):
+                if xs[x] % k == 0:
+                    break
+            else:
+                if k > 1:
+                    found.append(first_multiples(xs, k - 1))
+            for x in xs:
+                if x % k == 0:
+                    found.append(x)
+                    break
+            else:
+                if k > 1:
+                    found.append(first_multiples(xs, k - 1))
+            for x in iter(xs):
+                if x == k:
+                    break
+            else:
+                if k > 1:
+                    found.append(first_multiples(xs, k - 1))
+            n = len(xs)
+            while n:
+                n -= 1
+                if xs[n] == k:
+                    break
+            else:
+                if k > 1:
+                    found.append(first_multiples(xs, k - 1))
+            return found
+
+        want = first_multiples([3, 5, 7], 4)
+        fn = fiber.fiber(locals=locals(), **self.options)(first_multiples)
+        self.assertEqual(want, trampoline.run(fn, [[3, 5, 7], 4]))
+
+    def test_leaf_called_through_trampoline(self):
+        # count_even is compiled before is_even is known to be a leaf.
+        @fiber.fiber(["is_even"], locals=locals(), **self.options)
+        def count_even(lst):
+            if not lst:
+                return 0
+            return is_even(lst[0]) + count_even(lst[1:])
+
+        @fiber.fiber(locals=locals(), **self.options)
+        def is_even(n):
+            return int(n % 2 == 0)
+
+        self.assertEqual(3, trampoline.run(count_even, [[1, 2, 4, 5, 6]]))
+        self.assertEqual(1, trampoline.run(is_even, [2]))
+        self.assertEqual(1, is_even(4))
+
     def test_sum_recursion_exceeded(self):
         def sum(lst, acc):
             if not lst:
@@ -57,7 +232,7 @@ class TestTrampoline(unittest.TestCase):
         self.assertRaises(RecursionError, sum, list(range(1, n+1)), 0)
 
     def test_sum_non_tailcall(self):
-        @fiber.fiber(locals=locals())
+        @fiber.fiber(locals=locals(), **self.options)
         def sum(lst, acc):
             if not lst:
                 return acc
@@ -67,14 +242,97 @@ class TestTrampoline(unittest.TestCase):
         got = trampoline.run(sum, [list(range(1, n+1)), 0])
         self.assertEqual(want, got)
 
+    def test_sum_non_tailcall_accumulate(self):
+        @fiber.fiber(locals=locals(), **self.options, accumulate=True)
+        def sum(lst, acc):
+            if not lst:
+                return acc
+            return sum(lst[1:], acc + lst[0]) + 1
+        n = sys.getrecursionlimit() + 1
+        want = n * (n + 1) / 2 + n
+        got = trampoline.run(sum, [list(range(1, n+1)), 0], __max_stack_size=1)
+        self.assertEqual(want, got)
+
+    def test_concat_accumulate_keeps_order(self):
+        @fiber.fiber(locals=locals(), **self.options, accumulate=True)
+        def spell(n):
+            if n == 0:
+                return "."
+            return spell(n - 1) + str(n)
+        self.assertEqual(".123", trampoline.run(spell, [3], __max_stack_size=1))
+
+    def test_sum_clear_dead_peak_memory(self):
+        def peak_memory(**options):
+            @fiber.fiber(locals=locals(), **self.options, **options)
+            def sum(lst, acc):
+                if not lst:
+                    return acc
+                return sum(lst[1:], acc + lst[0]) + 1
+
+            n = 2000
+            tracemalloc.start()
+            got = trampoline.run(sum, [list(range(1, n+1)), 0])
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.assertEqual(n * (n + 1) / 2 + n, got)
+            return peak
+
+        # Without clearing, every suspended frame keeps its slice of the list.
+        for options in ({}, {"slots": True}, {"fast_locals": True}):
+            self.assertLess(peak_memory(clear_dead=True, **options) * 4,
+                            peak_memory(**options))
+
+    def test_unused_local_clear_dead_peak_memory(self):
+        def peak_memory(**options):
+            @fiber.fiber(locals=locals(), **self.options, **options)
+            def count(n):
+                if n == 0:
+                    return 0
+                big = [n] * 100
+                return count(n - 1) + 1
+
+            n = 2000
+            tracemalloc.start()
+            got = trampoline.run(count, [n])
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.assertEqual(n, got)
+            return peak
+
+        # big is never read, so it is dead as soon as it is assigned.
+        for options in ({}, {"slots": True}):
+            self.assertLess(peak_memory(clear_dead=True, **options) * 2,
+                            peak_memory(**options))
+
+    def test_pop_balloons_clear_dead(self):
+        def pop_balloons(balloons, **options):
+            balloons = [1] + balloons + [1]
+
+            @fiber.fiber(locals=locals(), **self.options, clear_dead=True, **options)
+            def pop_balloons__helper(i, j):
+                if i == j:
+                    return 0
+                max_profit = float('-inf')
+                for k in range(i, j):
+                    profit = pop_balloons__helper(i, k)
+                    profit += pop_balloons__helper(k+1, j)
+                    profit += balloons[i-1] * balloons[k] * balloons[j]
+                    max_profit = max(max_profit, profit)
+                return max_profit
+
+            return trampoline.run(pop_balloons__helper, [1, len(balloons) - 1])
+        self.assertEqual(175, pop_balloons([4, 5, 7]))
+        self.assertEqual(175, pop_balloons([4, 5, 7], slots=True))
+        self.assertEqual(175, pop_balloons([4, 5, 7], fast_locals=True))
+
     def test_mutual_recursion(self):
-        @fiber.fiber(["b"], locals=locals())
+        @fiber.fiber(["b"], locals=locals(), **self.options)
         def a(n):
             if n == 0:
                 return 1
             return b(n-1) * 2
 
-        @fiber.fiber(locals=locals())
+        @fiber.fiber(locals=locals(), **self.options)
         def b(n):
             if n == 0:
                 return 1
@@ -82,9 +340,188 @@ class TestTrampoline(unittest.TestCase):
         got = trampoline.run(a, [10])
         self.assertEqual(2**5 * 3**5, got)
 
+    def test_merged_mutual_tail_recursion(self):
+        @fiber.fiber(["is_odd"], locals=locals(), **self.options)
+        def is_even(n):
+            if n == 0:
+                return True
+            return is_odd(n - 1)
+
+        @fiber.fiber(locals=locals(), **self.options)
+        def is_odd(n):
+            if n == 0:
+                return False
+            return is_even(n=n - 1)
+
+        fiber.merge_sccs([is_even, is_odd])
+        n = sys.getrecursionlimit() + 1
+        self.assertEqual(n % 2 == 0, trampoline.run(is_even, [n], __max_stack_size=1))
+        self.assertTrue(trampoline.run(is_odd, [7]))
+
+    def test_merged_mutual_recursion(self):
+        @fiber.fiber(["b"], locals=locals(), **self.options)
+        def a(n):
+            if n == 0:
+                return 1
+            return b(n-1) * 2
+
+        @fiber.fiber(locals=locals(), **self.options)
+        def b(n):
+            if n == 0:
+                return 1
+            return a(n-1) * 3
+
+        fiber.merge_sccs([a, b])
+        self.assertEqual(2**5 * 3**5, trampoline.run(a, [10]))
+        self.assertEqual(3**5 * 2**4, trampoline.run(b, [9]))
+
+    def test_merged_frame_options(self):
+        for options in [{"lazy_frames": True}, {"native_depth": 3}]:
+            with self.subTest(options=options):
+                @fiber.fiber(["b"], locals=locals(), **options, **self.options)
+                def a(n):
+                    if n == 0:
+                        return 1
+                    return b(n-1) * 2
+
+                @fiber.fiber(locals=locals(), **options, **self.options)
+                def b(n):
+                    if n == 0:
+                        return 1
+                    return a(n-1) * 3
+
+                self.assertEqual([["a", "b"]], fiber.merge_sccs([a, b]))
+                metadata = fiber.FIBER_FN_COMPILED_MAP[a]
+                for option, field in [("lazy_frames", "entry"), ("native_depth", "native")]:
+                    if option in options:
+                        self.assertIsNotNone(getattr(metadata, field))
+                self.assertEqual(2**5 * 3**5, trampoline.run(a, [10]))
+                self.assertEqual(2**5 * 3**5, trampoline.run(a, [10], native=False))
+                self.assertEqual(3**5 * 2**4, trampoline.run(b, [9], native=False))
+
+    def test_compiled_driver(self):
+        @fiber.fiber(locals=locals(), **self.options)
+        def fib(n):
+            if n <= 1:
+                return n
+            return fib(n-1) + fib(n=n-2)
+
+        @fiber.fiber(locals=locals(), **self.options)
+        def count(lst, acc=0):
+            if not lst:
+                return acc
+            return count(lst[1:]) + 1
+
+        driver = trampoline.compile_driver()
+        self.assertNotIn("assert", driver.__drivercode__)
+        self.assertEqual(55, driver(fib, [10]))
+        self.assertEqual(55, driver(fib, [], {"n": 10}))
+        self.assertEqual(3, driver(count, [[1, 2, 3]]))
+
+        limited = trampoline.compile_driver(max_stack_size=5)
+        self.assertEqual(5, limited(fib, [5]))
+        self.assertRaises(AssertionError, limited, fib, [6])
+
+    def test_slice_views(self):
+        @fiber.fiber(locals=locals(), slice_views=True, **self.options)
+        def count_digits(s):
+            if not s:
+                return 0
+            return count_digits(s[1:]) + (s[0] in "0123456789")
+
+        @fiber.fiber(locals=locals(), slice_views=True, **self.options)
+        def checksum(data, acc=0):
+            if not data:
+                return acc
+            return checksum(data[1:], acc ^ data[0])
+
+        @fiber.fiber(locals=locals(), slice_views=True, **self.options)
+        def evens(lst):
+            if not lst:
+                return []
+            return evens(lst[2:]) + [lst[0]]
+
+        self.assertEqual(500, trampoline.run(count_digits, ["a1" * 500]))
+        self.assertEqual(1 ^ 2 ^ 3, trampoline.run(checksum, [b"\x01\x02\x03" * 501]))
+        self.assertEqual(list(range(0, 10, 2))[::-1], trampoline.run(evens, [list(range(10))]))
+
+    def test_profile_recompile(self):
+        @fiber.fiber(locals=locals(), profile_threshold=20, **self.options)
+        def tribonacci(n):
+            if n == 0:
+                return 0
+            elif n <= 2:
+                return 1
+            else:
+                return tribonacci(n-1) + tribonacci(n-2) + tribonacci(n-3)
+
+        self.assertEqual(149, trampoline.run(tribonacci, [10]))
+        self.assertIsNone(fiber.FIBER_FN_NAME_MAP["tribonacci"].profile)
+        self.assertEqual(149, trampoline.run(tribonacci, [10]))
+        self.assertEqual(3136, trampoline.run(tribonacci, [15]))
+
+    def test_profile_recompile_driver(self):
+        @fiber.fiber(locals=locals(), profile_threshold=20, **self.options)
+        def tribonacci(n):
+            if n == 0:
+                return 0
+            elif n <= 2:
+                return 1
+            else:
+                return tribonacci(n-1) + tribonacci(n-2) + tribonacci(n-3)
+
+        @fiber.fiber(["tribonacci"], locals=locals(), **self.options)
+        def twice(n):
+            return tribonacci(n) * 2
+
+        driver = trampoline.compile_driver()
+        self.assertEqual(298, driver(twice, [10]))
+        self.assertIsNone(fiber.FIBER_FN_NAME_MAP["tribonacci"].profile)
+        self.assertEqual(3136, driver(tribonacci, [15]))
+
+    def test_profile_recompile_frame_options(self):
+        for options in [{"fast_locals": True}, {"clear_dead": True},
+                        {"fast_locals": True, "clear_dead": True}]:
+            with self.subTest(**options):
+                @fiber.fiber(locals=locals(), profile_threshold=3, **options, **self.options)
+                def fib(n):
+                    if n <= 1:
+                        return n
+                    big = [n] * 10
+                    return fib(n - 1) + fib(n - 2) + len(big) - 10
+
+                self.assertEqual(610, trampoline.run(fib, [15]))
+                metadata = fiber.FIBER_FN_NAME_MAP["fib"]
+                self.assertIsNone(metadata.profile)
+                self.assertEqual(610, trampoline.run(fib, [15]))
+                if options.get("clear_dead") and "backend" not in self.options:
+                    # The recompiled fiber still clears dead locals.
+                    self.assertIn("= None", metadata.fn.__fibercode__)
+
     def test_edit_distance(self):
         def edit_distance(first, second):
-            @fiber.fiber(locals=locals())
+            @fiber.fiber(locals=locals(), **self.options)
+            def edit_distance__helper(f, s):
+                if f == len(first):
+                    return len(second) - s
+                if s == len(second):
+                    return len(first) - f
+
+                if first[f] == second[s]:
+                    return edit_distance__helper(f+1, s+1)
+
+                del_f = edit_distance__helper(f+1, s) + 1
+                replace = edit_distance__helper(f+1, s+1) + 1
+                del_s = edit_distance__helper(f, s+1) + 1
+
+                return min(del_f, replace, del_s)
+
+            return trampoline.run(edit_distance__helper, [0, 0])
+        self.assertEqual(3, edit_distance("kitten", "sitting"))
+
+    def test_edit_distance_reuse_temporaries(self):
+        def edit_distance(first, second):
+            @fiber.fiber(locals=locals(), **self.options, reuse_temporaries=True)
             def edit_distance__helper(f, s):
                 if f == len(first):
                     return len(second) - s
@@ -102,12 +539,14 @@ class TestTrampoline(unittest.TestCase):
 
             return trampoline.run(edit_distance__helper, [0, 0])
         self.assertEqual(3, edit_distance("kitten", "sitting"))
+        code = fiber.FIBER_FN_NAME_MAP["edit_distance__helper"].fn.__fibercode__
+        self.assertEqual(1, len(set(re.findall(r"__tmp\d+__", code))))
 
     def test_pop_balloons(self):
         def pop_balloons(balloons):
             balloons = [1] + balloons + [1]
 
-            @fiber.fiber(locals=locals())
+            @fiber.fiber(locals=locals(), **self.options)
             def pop_balloons__helper(i, j):
                 if i == j:
                     return 0
@@ -126,7 +565,30 @@ class TestTrampoline(unittest.TestCase):
         from collections import namedtuple
         Tree = namedtuple("Tree", ["left", "right"])
 
-        @fiber.fiber(locals=locals())
+        @fiber.fiber(locals=locals(), **self.options)
+        def all_zeroes(tree):
+            if tree == 0:
+                return True
+            if not isinstance(tree, Tree):
+                return False
+            return all_zeroes(tree.left) and all_zeroes(tree.right)
+
+        zeroes = Tree(Tree(0, 0), Tree(Tree(Tree(0, 0), 0), Tree(0, 0)))
+        one = Tree(Tree(0, 0), Tree(Tree(Tree(1, 0), 0), Tree(0, 0)))
+        self.assertTrue(trampoline.run(all_zeroes, [zeroes]))
+        self.assertFalse(trampoline.run(all_zeroes, [one]))
+
+    def test_unroll(self):
+        from collections import namedtuple
+        Tree = namedtuple("Tree", ["left", "right"])
+
+        @fiber.fiber(locals=locals(), unroll=3, **self.options)
+        def fib(n):
+            if n <= 1:
+                return n
+            return fib(n-1) + fib(n=n-2)
+
+        @fiber.fiber(locals=locals(), unroll=2, **self.options)
         def all_zeroes(tree):
             if tree == 0:
                 return True
@@ -134,10 +596,400 @@ class TestTrampoline(unittest.TestCase):
                 return False
             return all_zeroes(tree.left) and all_zeroes(tree.right)
 
+        @fiber.fiber(locals=locals(), unroll=2, **self.options)
+        def first_negative(lst, i):
+            while i < len(lst):
+                if lst[i] < 0:
+                    return i
+                i = i + 1
+            return None if i > 100 else first_negative(lst + [-1], i)
+
+        self.assertEqual(6765, trampoline.run(fib, [20]))
         zeroes = Tree(Tree(0, 0), Tree(Tree(Tree(0, 0), 0), Tree(0, 0)))
         one = Tree(Tree(0, 0), Tree(Tree(Tree(1, 0), 0), Tree(0, 0)))
         self.assertTrue(trampoline.run(all_zeroes, [zeroes]))
         self.assertFalse(trampoline.run(all_zeroes, [one]))
+        self.assertEqual(3, trampoline.run(first_negative, [[1, 2, 3], 0]))
+
+    def test_inline_base_cases(self):
+        from collections import namedtuple
+        Tree = namedtuple("Tree", ["left", "right"])
+
+        @fiber.fiber(locals=locals(), inline_base_cases=True, **self.options)
+        def size(tree, empty=None):
+            if tree is empty:
+                return 0
+            if tree.left is None and tree.right is None:
+                return 1
+            return size(tree.left) + size(tree.right) + 1
+
+        @fiber.fiber(locals=locals(), inline_base_cases=True, **self.options)
+        def binomial(n, k, /):
+            if k == 0 or k == n:
+                return 1
+            return binomial(n - 1, k - 1) + binomial(n - 1, k)
+
+        @fiber.fiber(["size"], locals=locals(), inline_base_cases=True, **self.options)
+        def sizes(trees):
+            if not trees:
+                return 0
+            first = size(trees[0])
+            return first + sizes(trees[1:])
+
+        leaf = Tree(None, None)
+        tree = Tree(Tree(leaf, None), Tree(leaf, Tree(leaf, leaf)))
+        self.assertEqual(8, trampoline.run(size, [tree]))
+        self.assertEqual(1, trampoline.run(size, [leaf]))
+        self.assertEqual(252, trampoline.run(binomial, [10, 5]))
+        self.assertEqual(10, trampoline.run(sizes, [[tree, leaf, None, leaf]]))
+
+    def test_lazy_frames(self):
+        @fiber.fiber(locals=locals(), lazy_frames=True, **self.options)
+        def fib(n):
+            if n <= 1:
+                return n
+            return fib(n-1) + fib(n=n-2)
+
+        @fiber.fiber(locals=locals(), lazy_frames=True, **self.options)
+        def count(lst, *, step=1, seen=()):
+            if not lst:
+                return len(seen)
+            return count(lst[step:], step=step, seen=(*seen, lst[0]))
+
+        @fiber.fiber(locals=locals(), lazy_frames=True, **self.options)
+        def odd_halves(n):
+            if n % 2:
+                half = n // 2
+            if n == 0:
+                return 0
+            rest = odd_halves(n - 1)
+            if n % 2:
+                return rest + half
+            return rest
+
+        self.assertIsNotNone(fiber.FIBER_FN_COMPILED_MAP[fib].entry)
+        self.assertEqual(55, trampoline.run(fib, [10]))
+        # The calls with n <= 1 return without creating a frame.
+        self.assertEqual(55, trampoline.run(fib, [10], __max_stack_size=9))
+        self.assertEqual(3, trampoline.run(count, [[1, 2, 3, 4, 5]], {"step": 2}))
+        self.assertEqual(3, trampoline.compile_driver(max_stack_size=0)(count, [[1, 2, 3]]))
+        self.assertEqual(55, trampoline.compile_driver(max_stack_size=9)(fib, [10]))
+        self.assertRaises(TypeError, trampoline.run, count, [[1]], {"stride": 2})
+        # half is live across the call but may be unassigned at it.
+        self.assertIsNone(fiber.FIBER_FN_COMPILED_MAP[odd_halves].entry)
+        self.assertEqual(6, trampoline.run(odd_halves, [7]))
+
+    def test_native_depth(self):
+        @fiber.fiber(locals=locals(), native_depth=20, **self.options)
+        def fib(n):
+            if n <= 1:
+                return n
+            return fib(n-1) + fib(n=n-2)
+
+        @fiber.fiber(["odd_count"], locals=locals(), native_depth=8, **self.options)
+        def even_count(lst, *rest, bias=0):
+            if not lst:
+                return bias
+            return odd_count(lst[1:]) + (lst[0] % 2 == 0)
+
+        @fiber.fiber(locals=locals(), **self.options)
+        def odd_count(lst):
+            if not lst:
+                return 0
+            return even_count(lst[1:]) + (lst[0] % 2 == 1)
+
+        # Shallow calls never reach the trampoline.
+        self.assertEqual(610, trampoline.run(fib, [15], __max_stack_size=0))
+        self.assertEqual(610, trampoline.compile_driver()(fib, [15]))
+        n = sys.getrecursionlimit() * 2
+        self.assertEqual(n, trampoline.run(even_count, [list(range(n))]))
+        self.assertEqual(n, trampoline.run(odd_count, [list(range(1, n + 1))]))
+        self.assertEqual(1, trampoline.run(even_count, [[], 2], {"bias": 1}))
+
+    def check_exceptions(self, **options):
+        log = []
+
+        @fiber.fiber(locals=locals(), **options)
+        def depth(n):
+            if n == 0:
+                raise ValueError("bottom")
+            return depth(n - 1) + 1
+
+        @fiber.fiber(["depth"], locals=locals(), **options)
+        def safe(n, fallback):
+            try:
+                d = depth(n)
+            except ValueError as e:
+                log.append(str(e))
+                return fallback
+            else:
+                return d
+            finally:
+                log.append("finally")
+
+        @fiber.fiber(["safe"], locals=locals(), **options)
+        def loop(n):
+            total = 0
+            for i in range(n):
+                try:
+                    total += safe(i, -1)
+                    if i == 2:
+                        raise KeyError(i)
+                except KeyError:
+                    total += 100
+            return total
+
+        @fiber.fiber(locals=locals(), **options)
+        def retry(n):
+            try:
+                if n % 2:
+                    raise IndexError(n)
+                return n
+            except IndexError as e:
+                if n > 10:
+                    raise
+                return retry(e.args[0] - 1) * 10
+
+        n = sys.getrecursionlimit() * 2
+        driver = trampoline.compile_driver()
+        for run in [trampoline.run, driver]:
+            log.clear()
+            self.assertEqual(-1, run(safe, [n, -1]))
+            self.assertEqual(["bottom", "finally"], log)
+            # The finally block doesn't run when the call suspends the fiber.
+            log.clear()
+            self.assertEqual(96, run(loop, [4]))
+            self.assertEqual(["bottom", "finally"] * 4, log)
+            self.assertEqual(40, run(retry, [5]))
+            with self.assertRaises(IndexError):
+                run(retry, [11])
+            with self.assertRaisesRegex(ValueError, "bottom"):
+                run(depth, [n])
+
+    def test_exceptions(self):
+        self.check_exceptions(**self.options)
+
+    def test_finally_after_return_and_break(self):
+        for options in [{}, {"fast_locals": True}, {"clear_dead": True}, {"lazy_frames": True}]:
+            with self.subTest(**options):
+                @fiber.fiber(locals=locals(), **options, **self.options)
+                def depth(n, log):
+                    if n == 0:
+                        return 0
+                    try:
+                        return depth(n - 1, log) + 1
+                    finally:
+                        log.append(n)
+
+                @fiber.fiber(locals=locals(), **options, **self.options)
+                def count(n, log):
+                    total = 0
+                    while True:
+                        try:
+                            if n == 0:
+                                break
+                            total += count(n - 1, log)
+                            n -= 1
+                        finally:
+                            log.append(n)
+                    return total + 1
+
+                n, log = sys.getrecursionlimit() * 2, []
+                self.assertEqual(n, trampoline.run(depth, [n, log]))
+                self.assertEqual(list(range(1, n + 1)), log)
+                log = []
+                self.assertEqual(8, trampoline.run(count, [3, log]))
+                self.assertEqual([0, 0, 0, 1, 0, 0, 0, 2, 0, 0, 0, 1, 0, 0, 0], log)
+
+    def test_exceptions_frame_options(self):
+        for options in [{"slots": True}, {"fast_locals": True}, {"clear_dead": True},
+                        {"lazy_frames": True}, {"native_depth": 10},
+                        {"profile_threshold": 2}]:
+            with self.subTest(**options):
+                self.check_exceptions(**options, **self.options)
+
+    def test_streaming(self):
+        @fiber.fiber(locals=locals(), **self.options)
+        def walk(tree):
+            if tree is None:
+                return 0
+            left, value, right = tree
+            count = yield from walk(left)
+            yield value
+            count += yield from walk(right)
+            return count + 1
+
+        @fiber.fiber(locals=locals(), **self.options)
+        def between(lo, hi):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            yield from between(lo, mid)
+            yield mid
+            yield from between(mid + 1, hi)
+
+        @fiber.fiber(locals=locals(), **self.options)
+        def echo(items):
+            total = 0
+            for item in items:
+                received = yield item
+                if received is not None:
+                    total += received
+                    yield from [received] * 2
+            return total
+
+        @fiber.fiber(["walk"], locals=locals(), **self.options)
+        def size(tree):
+            return walk(tree)
+
+        n = sys.getrecursionlimit() * 2
+        tree = None
+        for k in range(n, 0, -1):
+            tree = (None, k, tree)
+        stream = trampoline.run(walk, [tree])
+        self.assertEqual(list(range(1, n + 1)), [next(stream) for _ in range(n)])
+        with self.assertRaises(StopIteration) as stop:
+            next(stream)
+        self.assertEqual(n, stop.exception.value)
+        self.assertEqual([0, 1, 2], list(trampoline.compile_driver()(between, [0, 3])))
+
+        stream = trampoline.run(echo, [[1, 2]])
+        self.assertEqual([1, 2, 2, 2], [next(stream), stream.send(2), next(stream), next(stream)])
+        with self.assertRaises(StopIteration) as stop:
+            next(stream)
+        self.assertEqual(2, stop.exception.value)
+
+        with self.assertRaises(TypeError):
+            trampoline.run(size, [tree])
+        with self.assertRaisesRegex(TypeError, "size called a streaming fiber"):
+            trampoline.compile_driver()(size, [tree])
+
+        # Values are streamed one at a time, so memory only grows with the depth.
+        tracemalloc.start()
+        self.assertEqual(sum(range(10000)), sum(trampoline.run(between, [0, 10000])))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertLess(peak, 10000)
+
+
+class TestTrampolineContinuations(TestTrampoline):
+    options = {"backend": "continuations"}
+
+    test_lazy_frames = unittest.skip("no pc")(TestTrampoline.test_lazy_frames)
+    test_merged_frame_options = unittest.skip("not merged")(
+        TestTrampoline.test_merged_frame_options)
+    test_exceptions_frame_options = unittest.skip("no try statements")(
+        TestTrampoline.test_exceptions_frame_options)
+    test_finally_after_return_and_break = unittest.skip("no try statements")(
+        TestTrampoline.test_finally_after_return_and_break)
+
+    def test_exceptions(self):
+        with self.assertRaisesRegex(ValueError, "try statements"):
+            self.check_exceptions(**self.options)
+
+
+class TestTrampolineGenerator(TestTrampoline):
+    options = {"backend": "generator"}
+
+    # Generators don't have a heap frame to configure.
+    test_fib_slots = unittest.skip("no heap frame")(TestTrampoline.test_fib_slots)
+    test_pop_balloons_slots = unittest.skip("no heap frame")(
+        TestTrampoline.test_pop_balloons_slots)
+    test_pop_balloons_fast_locals = unittest.skip("no heap frame")(
+        TestTrampoline.test_pop_balloons_fast_locals)
+    test_tree_recursion_fast_locals = unittest.skip("no heap frame")(
+        TestTrampoline.test_tree_recursion_fast_locals)
+    test_sum_clear_dead_peak_memory = unittest.skip("no heap frame")(
+        TestTrampoline.test_sum_clear_dead_peak_memory)
+    test_pop_balloons_clear_dead = unittest.skip("no heap frame")(
+        TestTrampoline.test_pop_balloons_clear_dead)
+    test_unused_local_clear_dead_peak_memory = unittest.skip("no heap frame")(
+        TestTrampoline.test_unused_local_clear_dead_peak_memory)
+    test_unroll = unittest.skip("no inlining")(TestTrampoline.test_unroll)
+    test_inline_base_cases = unittest.skip("no inlining")(
+        TestTrampoline.test_inline_base_cases)
+    test_edit_distance_reuse_temporaries = unittest.skip("no temporaries")(
+        TestTrampoline.test_edit_distance_reuse_temporaries)
+    test_lazy_frames = unittest.skip("no heap frame")(TestTrampoline.test_lazy_frames)
+    test_merged_frame_options = unittest.skip("not merged")(
+        TestTrampoline.test_merged_frame_options)
+    test_profile_recompile_frame_options = unittest.skip("no heap frame")(
+        TestTrampoline.test_profile_recompile_frame_options)
+    test_exceptions_frame_options = unittest.skip("no heap frame")(
+        TestTrampoline.test_exceptions_frame_options)
+    test_finally_after_return_and_break = unittest.skip("no heap frame")(
+        TestTrampoline.test_finally_after_return_and_break)
+
+    def test_streaming(self):
+        with self.assertRaises(ValueError):
+            @fiber.fiber(locals=locals(), **self.options)
+            def count(n):
+                while n:
+                    yield n
+                    n -= 1
+
+
+class TestMixedBackends(unittest.TestCase):
+    def test_mixed_backends(self):
+        @fiber.fiber(["count_b"], locals=locals())
+        def count_a(n):
+            if n == 0:
+                raise ValueError(n)
+            try:
+                return count_b(n - 1) + 1
+            except ValueError:
+                return 0
+
+        @fiber.fiber(["count_c"], locals=locals(), backend="generator")
+        def count_b(n):
+            if n == 0:
+                raise ValueError(n)
+            return count_c(n - 1) + 1
+
+        @fiber.fiber(["count_a"], locals=locals(), backend="continuations")
+        def count_c(n):
+            if n == 0:
+                raise ValueError(n)
+            return count_a(n - 1) + 1
+
+        # The innermost count_a catches the error, so callers count from there.
+        n = sys.getrecursionlimit() * 3 + 1
+        driver = trampoline.compile_driver()
+        for run in [trampoline.run, driver]:
+            with self.subTest(run=run.__name__):
+                self.assertEqual([n - 1, n - 2, n - 3],
+                                 [run(fn, [n]) for fn in [count_a, count_b, count_c]])
+                self.assertEqual(0, run(count_a, [1]))
+                for fn in [count_b, count_c]:
+                    with self.assertRaises(ValueError):
+                        run(fn, [1])
+
+
+class TestBindFrame(unittest.TestCase):
+    def test_slots_match_dict(self):
+        fn_tree = ast.parse("def f(p, /, a, b=3, *r, k, m=4): pass").body[0]
+        names = ["p", "a", "b", "r", "k", "m", "__pc"]
+        slots = {name: i for i, name in enumerate(names)}
+        calls = [
+            ([1, 2], {"k": 1}),
+            ([1], {"a": 2, "k": 1}),
+            ([1, 2, 3, 4, 5], {"k": 0, "m": 9}),
+            ([1, 2], {"p": 1, "k": 1}),
+            ([1, 2], {"a": 1, "k": 1}),
+            ([1, 2], {}),
+            ([1], {"k": 1}),
+            ([], {"p": 1, "a": 2, "k": 0}),
+        ]
+        for args, kwargs in calls:
+            with self.subTest(args=args, kwargs=kwargs):
+                try:
+                    frame = trampoline.bind_frame(args, dict(kwargs), fn_tree)
+                except TypeError as e:
+                    with self.assertRaisesRegex(TypeError, re.escape(str(e))):
+                        trampoline.bind_frame(args, dict(kwargs), fn_tree, slots)
+                    continue
+                slot_frame = trampoline.bind_frame(args, dict(kwargs), fn_tree, slots)
+                self.assertEqual([frame[name] for name in names], slot_frame)
 
 
 if __name__ == '__main__':
@@ -13,12 +13,14 @@
 # limitations under the License.
 
 import ast
+from collections.abc import Container
 import itertools
 import re
 
-# We don't support exceptions (ast.Try) or async for/while.
-# Exception support is fairly easy to add; async is harder.
-FN_INNER_SCOPE_NODES = [ast.For, ast.While, ast.If, ast.While]
+# We don't support async for/while.
+FN_INNER_SCOPE_NODES = [ast.For, ast.While, ast.If, ast.While, ast.Try]
+# The fields of a scope that hold statements (handlers hold except handlers).
+SCOPE_FIELDS = ("body", "orelse", "finalbody", "handlers")
 
 
 def dunder_names():
@@ -34,36 +36,66 @@ def is_temporary(name):
 
 
 def is_supported_scope(tree):
-    return any(isinstance(tree, scope_type) for scope_type in FN_INNER_SCOPE_NODES)
+    return isinstance(tree, tuple(FN_INNER_SCOPE_NODES))
 
 
 def map_expression(statement: ast.AST, fn):
     """Recursively transforms an expression by applying the mapping function to
-    all attributes that are AST nodes.
+    all attributes that are AST nodes. If the mapping function returns every
+    attribute unchanged, the statement itself is returned.
 
-    Does not recursively transform scope bodies (while, for, try) as one would
-    usually call this function from a mapper in map_scope, which itself already
-    iterates through scope bodies."""
-    kwargs = {}
+    Does not recursively transform scope bodies, else blocks or handlers
+    (while, for, if, try) as one would usually call this function from a
+    mapper in map_scope, which itself already iterates through scope bodies."""
+    kwargs, changed = {}, False
     for field, value in ast.iter_fields(statement):
         result = value
-        if is_supported_scope(statement) and field == "body":
+        if is_supported_scope(statement) and field in SCOPE_FIELDS:
             result = value
         elif isinstance(value, list):
             result = [fn(field, v)
                       for v in value if isinstance(v, ast.AST)]
+            changed = changed or len(result) != len(value) or \
+                any(r is not v for r, v in zip(result, value))
         elif isinstance(value, ast.AST):
             result = fn(field, value)
+            changed = changed or result is not value
         kwargs[field] = result
-    return type(statement)(**kwargs)
+    return type(statement)(**kwargs) if changed else statement
 
 
 def iter_scope(scope):
     """Iterates through every statement in the scope, recursively."""
-    for stmt in scope.body:
-        yield stmt
-        if is_supported_scope(stmt):
-            yield from iter_scope(stmt)
+    for field in SCOPE_FIELDS:
+        for stmt in getattr(scope, field, []):
+            if isinstance(stmt, ast.ExceptHandler):
+                yield from iter_scope(stmt)
+                continue
+            yield stmt
+            if is_supported_scope(stmt):
+                yield from iter_scope(stmt)
+
+
+def enclosing_blocks(scope, blocks=None):
+    """Maps the id of every statement in the scope, recursively, to the list of
+    statements that contains it."""
+    blocks = {} if blocks is None else blocks
+    for field in SCOPE_FIELDS:
+        for stmt in getattr(scope, field, []):
+            if isinstance(stmt, ast.ExceptHandler):
+                enclosing_blocks(stmt, blocks)
+                continue
+            blocks[id(stmt)] = getattr(scope, field)
+            if is_supported_scope(stmt):
+                enclosing_blocks(stmt, blocks)
+    return blocks
+
+
+def calls_any(node: ast.AST, fns: Container[str]):
+    """Returns whether the node contains a call to a function in fns."""
+    return any(isinstance(child, ast.Call) and
+               isinstance(child.func, ast.Name) and
+               child.func.id in fns for child in ast.walk(node))
 
 
 def potentially_trivial_temporaries(fn):
@@ -157,26 +189,39 @@ def is_block(block: ast.AST):
     return hasattr(block, "body") and isinstance(block.body, list)
 
 
-def _locals_impl(fn: ast.AST):
+def arg_names(fn: ast.AST):
+    """Yields the names of the function's parameters in declaration order."""
     assert isinstance(fn, ast.FunctionDef)
     args = fn.args
     for arg in itertools.chain(args.posonlyargs, args.args, args.kwonlyargs, (args.vararg, args.kwarg)):
         if arg is not None:
             yield arg.arg
 
+
+def _locals_impl(fn: ast.AST):
+    yield from arg_names(fn)
+
     def helper(block: ast.AST):
         for node in block.body:
             if isinstance(node, ast.Assign):
                 for target in node.targets:
-                    if isinstance(target, ast.Name):
-                        yield target.id
+                    for child in ast.walk(target):
+                        if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Store):
+                            yield child.id
             if isinstance(node, ast.AnnAssign) or \
                     isinstance(node, ast.AugAssign) or \
                     isinstance(node, ast.NamedExpr):
                 if isinstance(node.target, ast.Name):
                     yield node.target.id
+            if isinstance(node, ast.For):
+                for child in ast.walk(node.target):
+                    if isinstance(child, ast.Name):
+                        yield child.id
             if is_block(node) and not isinstance(node, ast.FunctionDef):
                 yield from helper(node)
+            if isinstance(node, ast.Try):
+                for block in [*node.handlers, ast.Module(body=node.orelse + node.finalbody)]:
+                    yield from helper(block)
     yield from helper(fn)
 
 
@@ -0,0 +1,66 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections.abc import Sequence
+
+
+class SliceView(Sequence):
+    """A read only view of seq[start:stop] that doesn't copy seq. Slicing a
+    view with step 1 returns another view; other steps copy. A view equals
+    (and hashes like) the slice of the sequence type it views."""
+    __slots__ = ("seq", "start", "stop")
+
+    def __init__(self, seq, start=0, stop=None):
+        self.seq, self.start = seq, start
+        self.stop = len(seq) if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                items = [self.seq[self.start + i] for i in range(start, stop, step)]
+                return "".join(items) if isinstance(self.seq, str) else type(self.seq)(items)
+            return SliceView(self.seq, self.start + start, self.start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("view index out of range")
+        return self.seq[self.start + index]
+
+    def __eq__(self, other):
+        if isinstance(other, SliceView) and type(other.seq) is not type(self.seq) or \
+                not isinstance(other, (SliceView, type(self.seq))):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __hash__(self):
+        # Equal to the slice it views, so hash like it (lists are unhashable).
+        return hash(self.seq[self.start:self.stop])
+
+    def __repr__(self):
+        return f"SliceView({self.seq[self.start:self.stop]!r})"
+
+
+def slice_view(seq):
+    """Returns an object that slices like seq without copying: a memoryview for
+    bytes-like objects and a SliceView for lists, tuples and strings. Other
+    objects (and views) are returned unchanged."""
+    if isinstance(seq, (bytes, bytearray)):
+        return memoryview(seq)
+    if isinstance(seq, (list, tuple, str)):
+        return SliceView(seq)
+    return seq
@@ -0,0 +1,72 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import views
+
+
+class TestViews(unittest.TestCase):
+
+    def test_slice_view(self):
+        lst = list(range(10))
+        view = views.slice_view(lst)[2:8]
+        self.assertIsInstance(view, views.SliceView)
+        self.assertEqual(lst[2:8], view)
+        self.assertEqual(lst[2:8][1:-1], view[1:-1])
+        self.assertEqual(lst[2:8][::2], view[::2])
+        self.assertEqual(lst[2:8][5:1], view[5:1])
+        self.assertEqual(7, view[-1])
+        self.assertEqual(6, len(view))
+        self.assertIn(5, view)
+        self.assertFalse(view[6:])
+        self.assertRaises(IndexError, lambda: view[6])
+
+    def test_negative_step(self):
+        for seq in [list(range(10)), tuple(range(10)), "abcdefghij"]:
+            view = views.slice_view(seq)[2:8]
+            for index in [slice(None, None, -1), slice(None, None, -2), slice(4, 1, -1),
+                          slice(None, 2, -3)]:
+                with self.subTest(seq=seq, index=index):
+                    self.assertEqual(seq[2:8][index], view[index])
+                    self.assertIsInstance(view[index], type(seq))
+
+    def test_hash(self):
+        memo = {views.slice_view("hello")[1:]: 1, views.slice_view((1, 2, 3))[:2]: 2}
+        self.assertEqual(1, memo["ello"])
+        self.assertEqual(2, memo[(1, 2)])
+        self.assertEqual(hash("ello"), hash(views.slice_view("hello")[1:]))
+        self.assertNotEqual(views.slice_view("ab"), views.slice_view(["a", "b"]))
+        with self.assertRaises(TypeError):
+            hash(views.slice_view([1, 2]))
+
+    def test_string_view(self):
+        view = views.slice_view("hello")[1:]
+        self.assertEqual("ello", view)
+        self.assertEqual("l", view[1])
+        self.assertNotEqual(["e", "l", "l", "o"], view)
+
+    def test_bytes_view(self):
+        view = views.slice_view(b"hello")[1:]
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(b"ello", view)
+        self.assertIs(view, views.slice_view(view))
+
+    def test_other(self):
+        numbers = range(5)
+        self.assertIs(numbers, views.slice_view(numbers))
+
+
+if __name__ == '__main__':
+    unittest.main()